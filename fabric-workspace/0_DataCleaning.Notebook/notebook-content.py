@@ -20,6 +20,253 @@
 # META   }
 # META }
 
+# PARAMETERS CELL ********************
+
+# "incremental" merges new/changed documents, "full" rebuilds the fact table
+load_mode = "incremental"
+# Debug only: also write the cast layer to accounts_payable_staging
+persist_staging = False
+# Set by the pipeline (@pipeline().RunId), logged to etl_run_log
+pipeline_run_id = ""
+# Warn about document keys with this many times the average line count
+key_skew_factor = 50
+# Days between ZORDER runs on the fact (every load only compacts small files)
+zorder_interval_days = 7
+# Direct Lake model whose changed tables this run reframes ("" to rely on
+# the model's automatic updates instead)
+semantic_model = "Accounts Payable"
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+spark.conf.set("ap.load_mode", load_mode)
+
+# Stage 1 joins BSEG and BKPF on the document key: let adaptive execution
+# split skewed keys and switch to a broadcast join when the changed lines
+# of an incremental run turn out to be small
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Run log: one etl_run_log row per stage with start/end time, rows read and
+# written, files/bytes added to Delta tables, shuffle bytes and Spark job IDs.
+# next_stage() closes the stage that ran since the previous call.
+import json
+import time
+import urllib.request
+import uuid
+from datetime import datetime
+
+# Delta tables written by each stage (their commits are attributed to it)
+STAGE_OUTPUTS = {
+    "change_detection": ["ap_load_watermark", "ap_vendor_snapshot"],
+    "staging": ["accounts_payable_staging"],
+    "reconciliation": ["ap_document_reconciliation"],
+    "dimensions": ["dim_vendor", "dim_document_type", "dim_date", "dim_company_code"],
+    "fact": ["accounts_payable_fact"],
+    "clearing": ["ap_clearing_pairs", "ap_open_items"],
+    "snapshots": ["ap_aging_snapshot", "ap_payment_stats_monthly"],
+    "summaries": ["ap_dq_daily_stats", "ap_vendor_stats", "dq_rules", "dq_results",
+                  "ap_data_quality_summary", "ap_vendor_summary"],
+    "watermark": ["ap_load_watermark", "ap_vendor_snapshot"],
+    "model_refresh": [],
+}
+
+spark.sql("""
+    CREATE TABLE IF NOT EXISTS etl_run_log (
+        run_id STRING,
+        pipeline_run_id STRING,
+        load_mode STRING,
+        stage STRING,
+        start_time TIMESTAMP,
+        end_time TIMESTAMP,
+        duration_s DOUBLE,
+        rows_in BIGINT,
+        rows_out BIGINT,
+        files_written BIGINT,
+        bytes_written BIGINT,
+        merge_scan_time_ms BIGINT,
+        merge_rewrite_time_ms BIGINT,
+        shuffle_read_bytes BIGINT,
+        shuffle_write_bytes BIGINT,
+        spark_job_ids ARRAY<INT>,
+        output_tables ARRAY<STRING>
+    ) USING DELTA
+""")
+
+
+def _table_version(table_name):
+    if not spark.catalog.tableExists(table_name):
+        return -1
+    return spark.sql(f"DESCRIBE HISTORY {table_name} LIMIT 1").first()["version"]
+
+
+def _delta_writes(table_name, after_version):
+    """Rows, files and bytes of the commits after after_version"""
+    totals = {"rows": 0, "files": 0, "bytes": 0, "scan_ms": 0, "rewrite_ms": 0}
+    if not spark.catalog.tableExists(table_name):
+        return totals
+    for commit in spark.sql(f"DESCRIBE HISTORY {table_name} LIMIT 50").collect():
+        if commit["version"] <= after_version:
+            continue
+        m = {k: int(v) for k, v in (commit["operationMetrics"] or {}).items() if v.isdigit()}
+        if "numTargetRowsInserted" in m:  # MERGE
+            totals["rows"] += (m["numTargetRowsInserted"] + m.get("numTargetRowsUpdated", 0)
+                               + m.get("numTargetRowsDeleted", 0))
+        else:
+            totals["rows"] += m.get("numOutputRows", m.get("numDeletedRows", 0))
+        totals["files"] += m.get("numTargetFilesAdded", m.get("numAddedFiles", m.get("numFiles", 0)))
+        totals["bytes"] += m.get("numTargetBytesAdded", m.get("numAddedBytes", m.get("numOutputBytes", 0)))
+        totals["scan_ms"] += m.get("scanTimeMs", 0)
+        totals["rewrite_ms"] += m.get("rewriteTimeMs", 0)
+    return totals
+
+
+def _spark_jobs(start, end):
+    """Job IDs, input records and shuffle bytes of the jobs submitted in [start, end]
+
+    Read from the Spark UI REST API of this session; None when it is not reachable.
+    """
+    sc = spark.sparkContext
+    base = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}"
+
+    def get(path):
+        with urllib.request.urlopen(base + path, timeout=10) as response:
+            return json.load(response)
+
+    def submitted(job):
+        stamp = job["submissionTime"].replace("GMT", "+0000")
+        return datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+
+    try:
+        jobs = [job for job in get("/jobs") if start <= submitted(job) <= end]
+        stage_ids = {stage_id for job in jobs for stage_id in job["stageIds"]}
+        stages = [stage for stage in get("/stages") if stage["stageId"] in stage_ids]
+    except Exception as exc:
+        print(f"Spark UI not reachable, no job metrics: {exc}")
+        return None, None, None, None
+    return (
+        sorted(job["jobId"] for job in jobs),
+        sum(stage["inputRecords"] for stage in stages),
+        sum(stage["shuffleReadBytes"] for stage in stages),
+        sum(stage["shuffleWriteBytes"] for stage in stages),
+    )
+
+
+class RunLog:
+    def __init__(self):
+        self.stage = None
+
+    def next_stage(self, stage=None):
+        """Log the current stage and start the next one (None: last stage)"""
+        if self.stage:
+            self._write()
+        self.stage = stage
+        if stage:
+            self.versions = {t: _table_version(t) for t in STAGE_OUTPUTS[stage]}
+            self.start = time.time()
+
+    def _write(self):
+        end = time.time()
+        writes = [_delta_writes(t, v) for t, v in self.versions.items()]
+        job_ids, rows_in, shuffle_read, shuffle_write = _spark_jobs(self.start, end)
+        row = (
+            run_id, pipeline_run_id, load_mode, self.stage,
+            datetime.fromtimestamp(self.start), datetime.fromtimestamp(end),
+            round(end - self.start, 3), rows_in,
+            sum(w["rows"] for w in writes), sum(w["files"] for w in writes),
+            sum(w["bytes"] for w in writes), sum(w["scan_ms"] for w in writes),
+            sum(w["rewrite_ms"] for w in writes), shuffle_read, shuffle_write,
+            job_ids, list(self.versions),
+        )
+        schema = spark.table("etl_run_log").schema
+        spark.createDataFrame([row], schema).write.mode("append").saveAsTable("etl_run_log")
+
+
+run_id = str(uuid.uuid4())
+run_log = RunLog()
+run_log.next_stage("change_detection")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Run cache: the fingerprint of a run covers the Delta versions of its inputs,
+# the notebook's code, its parameters and the date (CURRENT_DATE() is part of
+# the aging snapshot). When it equals the last completed run and no output
+# table was written since, this run would produce the same tables: it exits.
+# Without the notebook definition there is no fingerprint: every run is
+# executed, but its output versions are still recorded for model_refresh.
+import hashlib
+from datetime import date
+
+from notebookutils import mssparkutils
+
+CACHE_INPUTS = ["bkpf", "bseg", "lfa1"]
+CACHE_OUTPUTS = sorted({t for tables in STAGE_OUTPUTS.values() for t in tables})
+
+spark.sql("""
+    CREATE TABLE IF NOT EXISTS etl_run_cache (
+        fingerprint STRING,
+        output_versions STRING,
+        run_id STRING,
+        completed_at TIMESTAMP
+    ) USING DELTA
+""")
+
+
+def _output_versions():
+    return json.dumps({t: _table_version(t) for t in CACHE_OUTPUTS}, sort_keys=True)
+
+
+try:
+    notebook_code = mssparkutils.notebook.getDefinition(mssparkutils.runtime.context["currentNotebookName"])
+except Exception as exc:
+    notebook_code = None
+    print(f"Notebook definition not readable, run cache disabled: {exc}")
+
+run_fingerprint = None
+if notebook_code is not None:
+    run_fingerprint = hashlib.sha256(json.dumps({
+        "inputs": {t: _table_version(t) for t in CACHE_INPUTS},
+        "code": notebook_code,
+        "parameters": [load_mode, persist_staging, key_skew_factor],
+        "date": date.today().isoformat(),
+    }, sort_keys=True).encode()).hexdigest()
+    last_run = spark.table("etl_run_cache").first()
+    if (last_run and last_run.fingerprint == run_fingerprint
+            and last_run.output_versions == _output_versions()):
+        print(f"Inputs and code unchanged since run {last_run.run_id} "
+              f"({last_run.completed_at}), tables are current")
+        run_log.next_stage(None)
+        mssparkutils.notebook.exit("cached")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
 # CELL ********************
 
 # MAGIC %%sql
@@ -27,19 +274,160 @@
 # MAGIC -- Accounts Payable Fact Table Transformation
 # MAGIC -- TWO-STAGE APPROACH
 # MAGIC -- =====================================================
-# MAGIC -- Stage 1: Data Type Casting (Staging Table)
+# MAGIC -- Stage 1: Data Type Casting (Staging View)
+# MAGIC -- Reconciliation: Document balance, lines vs. headers
 # MAGIC -- Stage 2: Business Logic Transformation (Final Fact Table)
 # MAGIC -- =====================================================
+# MAGIC -- Load modes (ap.load_mode):
+# MAGIC --   incremental: MERGE only new/changed documents (default)
+# MAGIC --   full:        rebuild the fact table from all of BSEG/BKPF
+# MAGIC -- =====================================================
 # MAGIC 
 # MAGIC -- =====================================================
-# MAGIC -- STAGE 1: Data Type Casting Layer
+# MAGIC -- CHANGE DETECTION
 # MAGIC -- =====================================================
-# MAGIC -- Purpose: Cast all string columns to proper data types
-# MAGIC -- Handles various date formats and null/empty values
+# MAGIC -- Purpose: Limit the refresh to documents entered since
+# MAGIC -- the last run, reversed documents and documents of
+# MAGIC -- vendors added to or removed from the master data
 # MAGIC -- =====================================================
 # MAGIC 
-# MAGIC CREATE OR REPLACE TABLE accounts_payable_staging AS
+# MAGIC CREATE TABLE IF NOT EXISTS ap_load_watermark (
+# MAGIC     table_name STRING,
+# MAGIC     last_entry_date STRING,  -- BKPF.CPUDT (YYYYMMDD) of the last load
+# MAGIC     updated_at TIMESTAMP
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC CREATE TABLE IF NOT EXISTS ap_vendor_snapshot (
+# MAGIC     MANDT STRING,
+# MAGIC     LIFNR STRING,
+# MAGIC     vendor_hash STRING
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC -- No watermark yet (first run) behaves like a full load.
+# MAGIC -- The last 3 entry days are read again to pick up late
+# MAGIC -- postings; the MERGE makes reprocessing them idempotent.
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_load_scope AS
 # MAGIC SELECT
+# MAGIC     '${ap.load_mode}' = 'full' OR w.last_entry_date IS NULL AS is_full_load,
+# MAGIC     DATE_SUB(TO_DATE(w.last_entry_date, 'yyyyMMdd'), 3) AS since_entry_date
+# MAGIC FROM (SELECT 'accounts_payable_staging' AS table_name) t
+# MAGIC LEFT JOIN ap_load_watermark w
+# MAGIC     ON w.table_name = t.table_name;
+# MAGIC 
+# MAGIC -- New documents plus the originals of new reversals:
+# MAGIC -- FB08 fills STBLG/STJAH on the reversed header (same key,
+# MAGIC -- old CPUDT), so the new reversal points us to it
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_changed_documents AS
+# MAGIC SELECT DISTINCT MANDT, BUKRS, BELNR, GJAHR
+# MAGIC FROM (
+# MAGIC     SELECT bkpf.MANDT, bkpf.BUKRS, bkpf.BELNR, bkpf.GJAHR
+# MAGIC     FROM bkpf
+# MAGIC     CROSS JOIN ap_load_scope s
+# MAGIC     WHERE s.is_full_load
+# MAGIC         OR bkpf.CPUDT >= s.since_entry_date
+# MAGIC 
+# MAGIC     UNION ALL
+# MAGIC 
+# MAGIC     SELECT bkpf.MANDT, bkpf.BUKRS, bkpf.STBLG AS BELNR, bkpf.STJAH AS GJAHR
+# MAGIC     FROM bkpf
+# MAGIC     CROSS JOIN ap_load_scope s
+# MAGIC     WHERE NOT s.is_full_load
+# MAGIC         AND bkpf.CPUDT >= s.since_entry_date
+# MAGIC         AND TRIM(bkpf.STBLG) <> ''
+# MAGIC );
+# MAGIC 
+# MAGIC -- Vendor master changes: compare LFA1 with the snapshot of
+# MAGIC -- the last load (new, changed and deleted vendors)
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_vendor_hash AS
+# MAGIC SELECT
+# MAGIC     MANDT,
+# MAGIC     LIFNR,
+# MAGIC     SHA2(TO_JSON(ARRAY(
+# MAGIC         NAME1, NAME2, SORTL, ORT01, LAND1,
+# MAGIC         REGIO, PSTLZ, STRAS, STCD1, STCD2,
+# MAGIC         STCEG, KTOKK, BRSCH, LOEVM, SPERR
+# MAGIC     )), 256) AS vendor_hash
+# MAGIC FROM lfa1;
+# MAGIC 
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_changed_vendors AS
+# MAGIC SELECT
+# MAGIC     COALESCE(cur.MANDT, prev.MANDT) AS MANDT,
+# MAGIC     COALESCE(cur.LIFNR, prev.LIFNR) AS LIFNR,
+# MAGIC     cur.vendor_hash IS NULL OR prev.vendor_hash IS NULL AS is_added_or_removed
+# MAGIC FROM ap_vendor_hash cur
+# MAGIC FULL OUTER JOIN ap_vendor_snapshot prev
+# MAGIC     ON cur.MANDT = prev.MANDT
+# MAGIC     AND cur.LIFNR = prev.LIFNR
+# MAGIC CROSS JOIN ap_load_scope s
+# MAGIC WHERE NOT s.is_full_load
+# MAGIC     AND (cur.vendor_hash IS NULL
+# MAGIC          OR prev.vendor_hash IS NULL
+# MAGIC          OR cur.vendor_hash <> prev.vendor_hash);
+# MAGIC 
+# MAGIC -- BSEG lines to refresh (each line at most once). Only
+# MAGIC -- vendors added to or removed from LFA1 change fact rows
+# MAGIC -- (is_vendor_not_in_master); other master data changes
+# MAGIC -- are written to dim_vendor alone
+# MAGIC CREATE OR REPLACE TEMP VIEW bseg_changes AS
+# MAGIC SELECT bseg.*
+# MAGIC FROM bseg
+# MAGIC LEFT SEMI JOIN ap_changed_documents d
+# MAGIC     ON bseg.MANDT = d.MANDT
+# MAGIC     AND bseg.BUKRS = d.BUKRS
+# MAGIC     AND bseg.BELNR = d.BELNR
+# MAGIC     AND bseg.GJAHR = d.GJAHR
+# MAGIC 
+# MAGIC UNION ALL
+# MAGIC 
+# MAGIC SELECT bseg.*
+# MAGIC FROM bseg
+# MAGIC LEFT SEMI JOIN ap_changed_vendors v
+# MAGIC     ON bseg.MANDT = v.MANDT
+# MAGIC     AND bseg.LIFNR = v.LIFNR
+# MAGIC     AND v.is_added_or_removed
+# MAGIC LEFT ANTI JOIN ap_changed_documents d
+# MAGIC     ON bseg.MANDT = d.MANDT
+# MAGIC     AND bseg.BUKRS = d.BUKRS
+# MAGIC     AND bseg.BELNR = d.BELNR
+# MAGIC     AND bseg.GJAHR = d.GJAHR;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+run_log.next_stage("staging")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
+# MAGIC -- =====================================================
+# MAGIC -- STAGE 1: Data Type Casting Layer
+# MAGIC -- =====================================================
+# MAGIC -- Purpose: Clean and name the landing columns. Dates,
+# MAGIC -- amounts and day counts land typed (schema registry
+# MAGIC -- in sap_fields.py); only defaults and exact types are
+# MAGIC -- applied here, text fields are cleaned
+# MAGIC -- Joins: LFA1 (vendor master, small) is broadcast, so
+# MAGIC -- only BSEG and BKPF are shuffled on the document key;
+# MAGIC -- adaptive execution splits skewed document keys and
+# MAGIC -- broadcasts the changed lines of incremental runs
+# MAGIC -- =====================================================
+# MAGIC 
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_staging_changes AS
+# MAGIC SELECT /*+ BROADCAST(lfa1) */
+# MAGIC     -- BEGIN GENERATED: staging columns (sample-data/scripts/sap_fields.py)
 # MAGIC     -- Document Keys (Text to keep leading zeros)
 # MAGIC     bseg.MANDT AS mandt,
 # MAGIC     bseg.BUKRS AS company_code,
@@ -49,132 +437,445 @@
 # MAGIC 
 # MAGIC     -- Document Header Information
 # MAGIC     bkpf.BLART AS document_type_code,
-# MAGIC 
-# MAGIC     -- Dates: Use TRY_CAST with multiple fallback formats
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bkpf.BLDAT IS NULL OR TRIM(bkpf.BLDAT) = '' THEN NULL
-# MAGIC             WHEN LENGTH(TRIM(bkpf.BLDAT)) = 8 THEN
-# MAGIC                 CONCAT(SUBSTRING(bkpf.BLDAT, 1, 4), '-',
-# MAGIC                        SUBSTRING(bkpf.BLDAT, 5, 2), '-',
-# MAGIC                        SUBSTRING(bkpf.BLDAT, 7, 2))
-# MAGIC             ELSE bkpf.BLDAT
-# MAGIC         END AS DATE
-# MAGIC     ) AS document_date,
-# MAGIC 
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bkpf.BUDAT IS NULL OR TRIM(bkpf.BUDAT) = '' THEN NULL
-# MAGIC             WHEN LENGTH(TRIM(bkpf.BUDAT)) = 8 THEN
-# MAGIC                 CONCAT(SUBSTRING(bkpf.BUDAT, 1, 4), '-',
-# MAGIC                        SUBSTRING(bkpf.BUDAT, 5, 2), '-',
-# MAGIC                        SUBSTRING(bkpf.BUDAT, 7, 2))
-# MAGIC             ELSE bkpf.BUDAT
-# MAGIC         END AS DATE
-# MAGIC     ) AS posting_date,
-# MAGIC 
-# MAGIC     -- Text fields
+# MAGIC     bkpf.BLDAT AS document_date,
+# MAGIC     bkpf.BUDAT AS posting_date,
 # MAGIC     bkpf.WAERS AS currency,
 # MAGIC     bkpf.USNAM AS user_name,
 # MAGIC     bkpf.BKTXT AS document_header_text,
 # MAGIC     bkpf.XBLNR AS reference_document,
 # MAGIC     bkpf.TCODE AS transaction_code,
+# MAGIC     bkpf.CPUDT AS entry_date,
+# MAGIC 
+# MAGIC     -- Status fields
+# MAGIC     CASE WHEN TRIM(bkpf.BSTAT) = '' THEN NULL ELSE bkpf.BSTAT END AS document_status,
+# MAGIC     CASE WHEN TRIM(bkpf.STBLG) = '' THEN NULL ELSE bkpf.STBLG END AS reversal_document,
+# MAGIC     CASE WHEN TRIM(bkpf.STJAH) = '' THEN NULL ELSE bkpf.STJAH END AS reversal_fiscal_year,
 # MAGIC 
 # MAGIC     -- Line Item Information
 # MAGIC     bseg.SHKZG AS debit_credit_indicator,
 # MAGIC     bseg.KOART AS account_type,
 # MAGIC     CASE WHEN TRIM(bseg.LIFNR) = '' THEN NULL ELSE bseg.LIFNR END AS vendor_number,
 # MAGIC     bseg.HKONT AS gl_account,
+# MAGIC     CAST(COALESCE(bseg.DMBTR, 0) AS DECIMAL(15,2)) AS amount_local_currency,
+# MAGIC     CAST(COALESCE(bseg.WRBTR, 0) AS DECIMAL(15,2)) AS amount_document_currency,
+# MAGIC     CAST(COALESCE(bseg.MWSTS, 0) AS DECIMAL(15,2)) AS tax_amount,
+# MAGIC     bseg.ZUONR AS assignment_reference,
+# MAGIC     bseg.SGTXT AS line_item_text,
 # MAGIC 
-# MAGIC     -- Amounts: Handle various decimal formats
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.DMBTR IS NULL OR TRIM(bseg.DMBTR) = '' THEN '0'
-# MAGIC             ELSE REPLACE(REPLACE(bseg.DMBTR, ',', ''), ' ', '')
-# MAGIC         END AS DECIMAL(15,2)
-# MAGIC     ) AS amount_local_currency,
+# MAGIC     -- Payment Terms
+# MAGIC     bseg.ZFBDT AS baseline_payment_date,
+# MAGIC     CAST(bseg.ZBD1T AS INT) AS cash_discount_days_1,
+# MAGIC     CAST(bseg.ZBD2T AS INT) AS cash_discount_days_2,
+# MAGIC     CAST(bseg.ZBD3T AS INT) AS net_payment_terms_days,
+# MAGIC     CASE WHEN TRIM(bseg.ZTERM) = '' THEN NULL ELSE bseg.ZTERM END AS payment_terms,
+# MAGIC     CAST(COALESCE(bseg.SKFBT, 0) AS DECIMAL(15,2)) AS cash_discount_amount,
 # MAGIC 
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.WRBTR IS NULL OR TRIM(bseg.WRBTR) = '' THEN '0'
-# MAGIC             ELSE REPLACE(REPLACE(bseg.WRBTR, ',', ''), ' ', '')
-# MAGIC         END AS DECIMAL(15,2)
-# MAGIC     ) AS amount_document_currency,
+# MAGIC     -- Quality check flag
+# MAGIC     CASE WHEN lfa1.LIFNR IS NULL THEN 1 ELSE 0 END AS is_vendor_not_in_master
+# MAGIC     -- END GENERATED: staging columns
 # MAGIC 
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.MWSTS IS NULL OR TRIM(bseg.MWSTS) = '' THEN '0'
-# MAGIC             ELSE REPLACE(REPLACE(bseg.MWSTS, ',', ''), ' ', '')
-# MAGIC         END AS DECIMAL(15,2)
-# MAGIC     ) AS tax_amount,
+# MAGIC FROM
+# MAGIC     bseg_changes AS bseg
 # MAGIC 
-# MAGIC     bseg.ZUONR AS assignment_reference,
-# MAGIC     bseg.SGTXT AS line_item_text,
+# MAGIC INNER JOIN bkpf
+# MAGIC     ON bseg.MANDT = bkpf.MANDT
+# MAGIC     AND bseg.BUKRS = bkpf.BUKRS
+# MAGIC     AND bseg.BELNR = bkpf.BELNR
+# MAGIC     AND bseg.GJAHR = bkpf.GJAHR
 # MAGIC 
-# MAGIC     -- Payment Terms
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.ZFBDT IS NULL OR TRIM(bseg.ZFBDT) = '' THEN NULL
-# MAGIC             WHEN LENGTH(TRIM(bseg.ZFBDT)) = 8 THEN
-# MAGIC                 CONCAT(SUBSTRING(bseg.ZFBDT, 1, 4), '-',
-# MAGIC                        SUBSTRING(bseg.ZFBDT, 5, 2), '-',
-# MAGIC                        SUBSTRING(bseg.ZFBDT, 7, 2))
-# MAGIC             ELSE bseg.ZFBDT
-# MAGIC         END AS DATE
-# MAGIC     ) AS baseline_payment_date,
-# MAGIC 
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.ZBD1T IS NULL OR TRIM(bseg.ZBD1T) = '' THEN NULL
-# MAGIC             ELSE bseg.ZBD1T
-# MAGIC         END AS INT
-# MAGIC     ) AS cash_discount_days_1,
+# MAGIC LEFT JOIN lfa1
+# MAGIC     ON bseg.MANDT = lfa1.MANDT
+# MAGIC     AND bseg.LIFNR = lfa1.LIFNR
 # MAGIC 
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.ZBD2T IS NULL OR TRIM(bseg.ZBD2T) = '' THEN NULL
-# MAGIC             ELSE bseg.ZBD2T
-# MAGIC         END AS INT
-# MAGIC     ) AS cash_discount_days_2,
+# MAGIC WHERE
+# MAGIC     bseg.KOART IN ('K', 'S');  -- K = Vendor, S = G/L Account
 # MAGIC 
-# MAGIC     CASE WHEN TRIM(bseg.ZTERM) = '' THEN NULL ELSE bseg.ZTERM END AS payment_terms,
+# MAGIC -- Single pass: the cast layer stays a cached view and
+# MAGIC -- feeds Stage 2 directly, without a staging table write
+# MAGIC CACHE TABLE ap_staging_changes;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Key-skew check: all lines of a document key meet in one shuffle partition
+# of the BSEG x BKPF join, so documents with far more lines than average
+# (or blank keys) become hot spots. Reads the cached cast layer, no BSEG scan.
+skew = spark.sql("""
+    SELECT
+        AVG(line_count) AS avg_lines,
+        MAX(line_count) AS max_lines,
+        MAX_BY(CONCAT_WS('/', mandt, company_code, document_number, fiscal_year), line_count) AS hot_key,
+        SUM(CASE WHEN TRIM(document_number) = '' THEN line_count ELSE 0 END) AS blank_key_lines
+    FROM (
+        SELECT mandt, company_code, document_number, fiscal_year, COUNT(*) AS line_count
+        FROM ap_staging_changes
+        GROUP BY mandt, company_code, document_number, fiscal_year
+    )
+""").first()
+if skew.max_lines and skew.max_lines > key_skew_factor * skew.avg_lines:
+    print(f"Key skew: document {skew.hot_key} has {skew.max_lines:,} lines "
+          f"(average {skew.avg_lines:.1f})")
+if skew.blank_key_lines:
+    print(f"Key skew: {skew.blank_key_lines:,} lines with a blank document number")
+
+# Debug only: persist the cast layer as accounts_payable_staging
+if persist_staging:
+    spark.sql("""
+        CREATE TABLE IF NOT EXISTS accounts_payable_staging AS
+        SELECT * FROM ap_staging_changes WHERE 1 = 0
+    """)
+    if load_mode == "full":
+        spark.sql("DELETE FROM accounts_payable_staging")
+    spark.sql("""
+        MERGE INTO accounts_payable_staging AS target
+        USING ap_staging_changes AS source
+        ON target.mandt = source.mandt
+            AND target.company_code = source.company_code
+            AND target.document_number = source.document_number
+            AND target.fiscal_year = source.fiscal_year
+            AND target.line_item_number = source.line_item_number
+        WHEN MATCHED THEN UPDATE SET *
+        WHEN NOT MATCHED THEN INSERT *
+    """)
+
+run_log.next_stage("reconciliation")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
+# MAGIC -- =====================================================
+# MAGIC -- DOCUMENT RECONCILIATION
+# MAGIC -- =====================================================
+# MAGIC -- Purpose: Check the documents of this run against SAP's
+# MAGIC -- posting rules: every document balances (debits S =
+# MAGIC -- credits H in local currency), every BSEG line has a
+# MAGIC -- BKPF header and every header has lines. Stage 1 drops
+# MAGIC -- lines without a header in its inner join, so they are
+# MAGIC -- only visible here
+# MAGIC -- Approach: BSEG lines and BKPF headers are unioned into
+# MAGIC -- one stream and grouped by document key in a single
+# MAGIC -- aggregation; there is no BSEG x BKPF join. A full load
+# MAGIC -- scans BSEG without any join, an incremental run reads
+# MAGIC -- the lines of the changed documents (semi join with the
+# MAGIC -- changed keys, as in bseg_changes). Lines of vendor
+# MAGIC -- master changes belong to unchanged documents and are
+# MAGIC -- not checked again
+# MAGIC -- Output: ap_document_reconciliation (1 row per document
+# MAGIC -- with an issue; documents that pass are removed)
+# MAGIC -- =====================================================
 # MAGIC 
-# MAGIC     TRY_CAST(
-# MAGIC         CASE
-# MAGIC             WHEN bseg.SKFBT IS NULL OR TRIM(bseg.SKFBT) = '' THEN '0'
-# MAGIC             ELSE REPLACE(REPLACE(bseg.SKFBT, ',', ''), ' ', '')
-# MAGIC         END AS DECIMAL(15,2)
-# MAGIC     ) AS cash_discount_amount,
+# MAGIC CREATE TABLE IF NOT EXISTS ap_document_reconciliation (
+# MAGIC     mandt STRING,
+# MAGIC     company_code STRING,
+# MAGIC     document_number STRING,
+# MAGIC     fiscal_year INT,
+# MAGIC     issue STRING,  -- unbalanced, lines_without_header, header_without_lines
+# MAGIC     line_count BIGINT,
+# MAGIC     debit_amount DECIMAL(17,2),
+# MAGIC     credit_amount DECIMAL(17,2),
+# MAGIC     balance DECIMAL(17,2),  -- debit - credit
+# MAGIC     checked_at TIMESTAMP
+# MAGIC ) USING DELTA;
 # MAGIC 
-# MAGIC     -- Vendor Master Data (keep as text, clean only)
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_document_checks AS
+# MAGIC SELECT
+# MAGIC     mandt,
+# MAGIC     company_code,
+# MAGIC     document_number,
+# MAGIC     fiscal_year,
+# MAGIC     CASE
+# MAGIC         WHEN header_count = 0 THEN 'lines_without_header'
+# MAGIC         WHEN line_count = 0 THEN 'header_without_lines'
+# MAGIC         WHEN debit_amount <> credit_amount THEN 'unbalanced'
+# MAGIC     END AS issue,
+# MAGIC     line_count,
+# MAGIC     debit_amount,
+# MAGIC     credit_amount,
+# MAGIC     CAST(debit_amount - credit_amount AS DECIMAL(17,2)) AS balance,
+# MAGIC     CURRENT_TIMESTAMP() AS checked_at
+# MAGIC FROM (
+# MAGIC     SELECT
+# MAGIC         MANDT AS mandt,
+# MAGIC         BUKRS AS company_code,
+# MAGIC         BELNR AS document_number,
+# MAGIC         TRY_CAST(GJAHR AS INT) AS fiscal_year,
+# MAGIC         SUM(is_line) AS line_count,
+# MAGIC         SUM(1 - is_line) AS header_count,
+# MAGIC         CAST(SUM(CASE WHEN SHKZG = 'S' THEN DMBTR ELSE 0 END) AS DECIMAL(17,2)) AS debit_amount,
+# MAGIC         CAST(SUM(CASE WHEN SHKZG = 'H' THEN DMBTR ELSE 0 END) AS DECIMAL(17,2)) AS credit_amount
+# MAGIC     FROM (
+# MAGIC         SELECT bseg.MANDT, bseg.BUKRS, bseg.BELNR, bseg.GJAHR,
+# MAGIC                1 AS is_line, bseg.SHKZG, COALESCE(bseg.DMBTR, 0) AS DMBTR
+# MAGIC         FROM bseg
+# MAGIC         CROSS JOIN ap_load_scope s
+# MAGIC         WHERE s.is_full_load
+# MAGIC 
+# MAGIC         UNION ALL
+# MAGIC 
+# MAGIC         SELECT bseg.MANDT, bseg.BUKRS, bseg.BELNR, bseg.GJAHR,
+# MAGIC                1 AS is_line, bseg.SHKZG, COALESCE(bseg.DMBTR, 0) AS DMBTR
+# MAGIC         FROM bseg
+# MAGIC         LEFT SEMI JOIN ap_changed_documents d
+# MAGIC             ON bseg.MANDT = d.MANDT
+# MAGIC             AND bseg.BUKRS = d.BUKRS
+# MAGIC             AND bseg.BELNR = d.BELNR
+# MAGIC             AND bseg.GJAHR = d.GJAHR
+# MAGIC         CROSS JOIN ap_load_scope s
+# MAGIC         WHERE NOT s.is_full_load
+# MAGIC 
+# MAGIC         UNION ALL
+# MAGIC 
+# MAGIC         -- Headers of the changed documents (all of BKPF on a
+# MAGIC         -- full load), including the originals of reversals
+# MAGIC         SELECT bkpf.MANDT, bkpf.BUKRS, bkpf.BELNR, bkpf.GJAHR,
+# MAGIC                0 AS is_line, NULL AS SHKZG, 0 AS DMBTR
+# MAGIC         FROM bkpf
+# MAGIC         LEFT SEMI JOIN ap_changed_documents d
+# MAGIC             ON bkpf.MANDT = d.MANDT
+# MAGIC             AND bkpf.BUKRS = d.BUKRS
+# MAGIC             AND bkpf.BELNR = d.BELNR
+# MAGIC             AND bkpf.GJAHR = d.GJAHR
+# MAGIC     ) document_rows
+# MAGIC     GROUP BY MANDT, BUKRS, BELNR, GJAHR
+# MAGIC ) documents;
+# MAGIC 
+# MAGIC DELETE FROM ap_document_reconciliation WHERE '${ap.load_mode}' = 'full';
+# MAGIC 
+# MAGIC -- Documents checked again replace their earlier result
+# MAGIC MERGE INTO ap_document_reconciliation AS target
+# MAGIC USING ap_document_checks AS source
+# MAGIC ON target.mandt = source.mandt
+# MAGIC     AND target.company_code = source.company_code
+# MAGIC     AND target.document_number = source.document_number
+# MAGIC     AND target.fiscal_year <=> source.fiscal_year
+# MAGIC WHEN MATCHED AND source.issue IS NULL THEN DELETE
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED AND source.issue IS NOT NULL THEN INSERT *;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Open issues of the reconciliation table (documents that pass are not kept)
+for row in spark.sql("""
+    SELECT issue, COUNT(*) AS documents
+    FROM ap_document_reconciliation
+    GROUP BY issue
+    ORDER BY issue
+""").collect():
+    print(f"Reconciliation: {row.documents:,} documents {row.issue.replace('_', ' ')}")
+
+run_log.next_stage("dimensions")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
+# MAGIC -- =====================================================
+# MAGIC -- DIMENSIONS: Vendor, Document Type, Date
+# MAGIC -- =====================================================
+# MAGIC -- Purpose: Keep descriptive attributes out of the fact
+# MAGIC -- table; it stores integer keys, the dimensions hold the
+# MAGIC -- texts once per vendor, document type and day
+# MAGIC -- Keys: vendor_key and document_type_key are surrogate
+# MAGIC -- keys, assigned once per natural key and kept across
+# MAGIC -- loads (full loads included), so fact rows of earlier
+# MAGIC -- loads stay valid. date_key is the date as yyyyMMdd.
+# MAGIC -- vendor_key -1 stands for lines without a vendor
+# MAGIC -- Output: dim_vendor, dim_document_type, dim_date,
+# MAGIC --         dim_company_code
+# MAGIC -- =====================================================
+# MAGIC 
+# MAGIC -- All vendors: the master records, vendor numbers posted
+# MAGIC -- without one, and member -1 (G/L lines)
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_vendor_attributes AS
+# MAGIC SELECT /*+ BROADCAST(lfa1) */
+# MAGIC     v.MANDT,
+# MAGIC     v.LIFNR AS vendor_number,
+# MAGIC     -- BEGIN GENERATED: vendor columns (sample-data/scripts/sap_fields.py)
 # MAGIC     CASE WHEN TRIM(lfa1.NAME1) = '' THEN NULL ELSE lfa1.NAME1 END AS vendor_name,
 # MAGIC     CASE WHEN TRIM(lfa1.NAME2) = '' THEN NULL ELSE lfa1.NAME2 END AS vendor_name_2,
+# MAGIC     CASE WHEN TRIM(lfa1.SORTL) = '' THEN NULL ELSE lfa1.SORTL END AS vendor_sort_field,
 # MAGIC     CASE WHEN TRIM(lfa1.ORT01) = '' THEN NULL ELSE lfa1.ORT01 END AS vendor_city,
 # MAGIC     CASE WHEN TRIM(lfa1.LAND1) = '' THEN NULL ELSE lfa1.LAND1 END AS vendor_country,
+# MAGIC     CASE WHEN TRIM(lfa1.REGIO) = '' THEN NULL ELSE lfa1.REGIO END AS vendor_region,
 # MAGIC     CASE WHEN TRIM(lfa1.PSTLZ) = '' THEN NULL ELSE lfa1.PSTLZ END AS vendor_postal_code,
 # MAGIC     CASE WHEN TRIM(lfa1.STRAS) = '' THEN NULL ELSE lfa1.STRAS END AS vendor_street,
 # MAGIC     CASE WHEN TRIM(lfa1.STCD1) = '' THEN NULL ELSE lfa1.STCD1 END AS vendor_tax_number_1,
+# MAGIC     CASE WHEN TRIM(lfa1.STCD2) = '' THEN NULL ELSE lfa1.STCD2 END AS vendor_tax_number_2,
 # MAGIC     CASE WHEN TRIM(lfa1.STCEG) = '' THEN NULL ELSE lfa1.STCEG END AS vendor_vat_number,
 # MAGIC     CASE WHEN TRIM(lfa1.KTOKK) = '' THEN NULL ELSE lfa1.KTOKK END AS vendor_account_group,
+# MAGIC     CASE WHEN TRIM(lfa1.BRSCH) = '' THEN NULL ELSE lfa1.BRSCH END AS vendor_industry,
+# MAGIC     CASE WHEN TRIM(lfa1.LOEVM) = '' THEN NULL ELSE lfa1.LOEVM END AS vendor_deletion_flag,
+# MAGIC     CASE WHEN TRIM(lfa1.SPERR) = '' THEN NULL ELSE lfa1.SPERR END AS vendor_posting_block
+# MAGIC     -- END GENERATED: vendor columns
+# MAGIC FROM (
+# MAGIC     SELECT MANDT, LIFNR FROM lfa1
 # MAGIC 
-# MAGIC     -- Quality check flag
-# MAGIC     CASE WHEN lfa1.LIFNR IS NULL THEN 1 ELSE 0 END AS is_vendor_not_in_master
+# MAGIC     UNION
 # MAGIC 
-# MAGIC FROM
-# MAGIC     bseg
+# MAGIC     SELECT mandt, vendor_number
+# MAGIC     FROM ap_staging_changes
+# MAGIC     WHERE vendor_number IS NOT NULL
+# MAGIC         AND is_vendor_not_in_master = 1
 # MAGIC 
-# MAGIC INNER JOIN bkpf
-# MAGIC     ON bseg.MANDT = bkpf.MANDT
-# MAGIC     AND bseg.BUKRS = bkpf.BUKRS
-# MAGIC     AND bseg.BELNR = bkpf.BELNR
-# MAGIC     AND bseg.GJAHR = bkpf.GJAHR
+# MAGIC     UNION
 # MAGIC 
+# MAGIC     SELECT NULL, NULL
+# MAGIC ) v
 # MAGIC LEFT JOIN lfa1
-# MAGIC     ON bseg.MANDT = lfa1.MANDT
-# MAGIC     AND bseg.LIFNR = lfa1.LIFNR
+# MAGIC     ON v.MANDT = lfa1.MANDT
+# MAGIC     AND v.LIFNR = lfa1.LIFNR;
 # MAGIC 
-# MAGIC WHERE
-# MAGIC     bseg.KOART IN ('K', 'S');  -- K = Vendor, S = G/L Account
+# MAGIC CREATE TABLE IF NOT EXISTS dim_vendor
+# MAGIC USING DELTA
+# MAGIC AS SELECT CAST(NULL AS BIGINT) AS vendor_key, * FROM ap_vendor_attributes WHERE 1 = 0;
+# MAGIC 
+# MAGIC -- Rewrites new vendors and the master records changed since
+# MAGIC -- the last load (all vendors on a full load). New vendors
+# MAGIC -- are numbered after the highest key in use
+# MAGIC MERGE INTO dim_vendor AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         COALESCE(
+# MAGIC             dim.vendor_key,
+# MAGIC             CASE WHEN a.vendor_number IS NULL THEN -1 END,
+# MAGIC             (SELECT COALESCE(MAX(vendor_key), 0) FROM dim_vendor)
+# MAGIC                 + ROW_NUMBER() OVER (
+# MAGIC                     PARTITION BY dim.vendor_key IS NULL
+# MAGIC                     ORDER BY a.MANDT NULLS LAST, a.vendor_number NULLS LAST
+# MAGIC                 )
+# MAGIC         ) AS vendor_key,
+# MAGIC         a.*
+# MAGIC     FROM ap_vendor_attributes a
+# MAGIC     CROSS JOIN ap_load_scope s
+# MAGIC     LEFT JOIN dim_vendor dim
+# MAGIC         ON dim.MANDT <=> a.MANDT
+# MAGIC         AND dim.vendor_number <=> a.vendor_number
+# MAGIC     LEFT JOIN ap_changed_vendors c
+# MAGIC         ON c.MANDT = a.MANDT
+# MAGIC         AND c.LIFNR = a.vendor_number
+# MAGIC     WHERE s.is_full_load
+# MAGIC         OR dim.vendor_key IS NULL
+# MAGIC         OR c.LIFNR IS NOT NULL
+# MAGIC ) AS source
+# MAGIC ON target.vendor_key = source.vendor_key
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+# MAGIC 
+# MAGIC CREATE TABLE IF NOT EXISTS dim_document_type (
+# MAGIC     document_type_key INT,
+# MAGIC     document_type STRING,
+# MAGIC     document_type_description STRING
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC MERGE INTO dim_document_type AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         COALESCE(
+# MAGIC             dim.document_type_key,
+# MAGIC             (SELECT COALESCE(MAX(document_type_key), 0) FROM dim_document_type)
+# MAGIC                 + ROW_NUMBER() OVER (
+# MAGIC                     PARTITION BY dim.document_type_key IS NULL
+# MAGIC                     ORDER BY t.document_type
+# MAGIC                 )
+# MAGIC         ) AS document_type_key,
+# MAGIC         t.document_type,
+# MAGIC         CASE
+# MAGIC             WHEN t.document_type = 'RE' THEN 'Invoice'
+# MAGIC             WHEN t.document_type = 'KZ' THEN 'Payment'
+# MAGIC             WHEN t.document_type = 'KG' THEN 'Credit Memo'
+# MAGIC             ELSE 'Other'
+# MAGIC         END AS document_type_description
+# MAGIC     FROM (
+# MAGIC         SELECT DISTINCT document_type_code AS document_type
+# MAGIC         FROM ap_staging_changes
+# MAGIC     ) t
+# MAGIC     LEFT JOIN dim_document_type dim
+# MAGIC         ON dim.document_type <=> t.document_type
+# MAGIC ) AS source
+# MAGIC ON target.document_type_key = source.document_type_key
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+# MAGIC 
+# MAGIC CREATE TABLE IF NOT EXISTS dim_date (
+# MAGIC     date_key INT,
+# MAGIC     calendar_date DATE,
+# MAGIC     calendar_year INT,
+# MAGIC     calendar_quarter INT,
+# MAGIC     calendar_month INT,
+# MAGIC     month_name STRING,
+# MAGIC     year_month STRING,
+# MAGIC     day_of_month INT,
+# MAGIC     day_name STRING
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC -- Whole calendar years around the posting and document
+# MAGIC -- dates of the changed rows and the load day (the aging
+# MAGIC -- snapshot date); days already present are kept
+# MAGIC MERGE INTO dim_date AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         YEAR(calendar_date) * 10000 + MONTH(calendar_date) * 100 + DAY(calendar_date) AS date_key,
+# MAGIC         calendar_date,
+# MAGIC         YEAR(calendar_date) AS calendar_year,
+# MAGIC         QUARTER(calendar_date) AS calendar_quarter,
+# MAGIC         MONTH(calendar_date) AS calendar_month,
+# MAGIC         DATE_FORMAT(calendar_date, 'MMMM') AS month_name,
+# MAGIC         DATE_FORMAT(calendar_date, 'yyyy-MM') AS year_month,
+# MAGIC         DAY(calendar_date) AS day_of_month,
+# MAGIC         DATE_FORMAT(calendar_date, 'EEEE') AS day_name
+# MAGIC     FROM (
+# MAGIC         SELECT EXPLODE(SEQUENCE(first_day, last_day, INTERVAL 1 DAY)) AS calendar_date
+# MAGIC         FROM (
+# MAGIC             SELECT
+# MAGIC                 MAKE_DATE(YEAR(LEAST(MIN(posting_date), MIN(document_date), CURRENT_DATE())), 1, 1) AS first_day,
+# MAGIC                 MAKE_DATE(YEAR(GREATEST(MAX(posting_date), MAX(document_date), CURRENT_DATE())), 12, 31) AS last_day
+# MAGIC             FROM ap_staging_changes
+# MAGIC         ) date_range
+# MAGIC     ) days
+# MAGIC ) AS source
+# MAGIC ON target.date_key = source.date_key
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+# MAGIC 
+# MAGIC -- Company codes, so that the fact and the aggregate tables
+# MAGIC -- (snapshots, clearing, data quality results) share one
+# MAGIC -- company code filter in the semantic model
+# MAGIC CREATE TABLE IF NOT EXISTS dim_company_code (
+# MAGIC     company_code STRING
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC MERGE INTO dim_company_code AS target
+# MAGIC USING (
+# MAGIC     SELECT DISTINCT company_code
+# MAGIC     FROM ap_staging_changes
+# MAGIC ) AS source
+# MAGIC ON target.company_code = source.company_code
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
 
 # METADATA ********************
 
@@ -185,38 +886,58 @@
 
 # CELL ********************
 
+run_log.next_stage("fact")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
 # MAGIC %%sql
 # MAGIC -- =====================================================
 # MAGIC -- STAGE 2: Business Logic Transformation Layer
 # MAGIC -- =====================================================
 # MAGIC -- Purpose: Apply business rules and calculations
-# MAGIC -- Input: Clean, typed data from staging table
+# MAGIC -- Input: Changed rows of the staging table (ap_staging_changes)
 # MAGIC -- Output: Final fact table ready for Power BI
 # MAGIC -- =====================================================
 # MAGIC 
-# MAGIC CREATE OR REPLACE TABLE accounts_payable_fact AS
-# MAGIC SELECT
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_fact_changes AS
+# MAGIC SELECT /*+ BROADCAST(v, dt) */
 # MAGIC     -- Document Keys
-# MAGIC     mandt AS MANDT,
+# MAGIC     stg.mandt AS MANDT,
 # MAGIC     company_code,
 # MAGIC     document_number,
 # MAGIC     fiscal_year,
 # MAGIC     line_item_number,
 # MAGIC 
+# MAGIC     -- Dimension Keys
+# MAGIC     COALESCE(v.vendor_key, -1) AS vendor_key,
+# MAGIC     dt.document_type_key,
+# MAGIC     YEAR(posting_date) * 10000 + MONTH(posting_date) * 100 + DAY(posting_date) AS posting_date_key,
+# MAGIC 
 # MAGIC     -- Document Header Information
 # MAGIC     document_type_code AS document_type,
 # MAGIC     document_date,
 # MAGIC     posting_date,
+# MAGIC     entry_date,
 # MAGIC     currency,
 # MAGIC     user_name,
 # MAGIC     document_header_text,
 # MAGIC     reference_document,
 # MAGIC     transaction_code,
+# MAGIC     document_status,
+# MAGIC     reversal_document,
+# MAGIC     reversal_fiscal_year,
 # MAGIC 
 # MAGIC     -- Line Item Information
 # MAGIC     debit_credit_indicator,
 # MAGIC     account_type,
-# MAGIC     vendor_number,
+# MAGIC     stg.vendor_number,
 # MAGIC     gl_account,
 # MAGIC     amount_local_currency,
 # MAGIC     amount_document_currency,
@@ -228,20 +949,10 @@
 # MAGIC     baseline_payment_date,
 # MAGIC     cash_discount_days_1,
 # MAGIC     cash_discount_days_2,
+# MAGIC     net_payment_terms_days,
 # MAGIC     payment_terms,
 # MAGIC     cash_discount_amount,
 # MAGIC 
-# MAGIC     -- Vendor Master Data
-# MAGIC     vendor_name,
-# MAGIC     vendor_name_2,
-# MAGIC     vendor_city,
-# MAGIC     vendor_country,
-# MAGIC     vendor_postal_code,
-# MAGIC     vendor_street,
-# MAGIC     vendor_tax_number_1,
-# MAGIC     vendor_vat_number,
-# MAGIC     vendor_account_group,
-# MAGIC 
 # MAGIC     -- Calculated Fields
 # MAGIC     CASE
 # MAGIC         WHEN debit_credit_indicator = 'S' THEN amount_local_currency
@@ -254,14 +965,6 @@
 # MAGIC         ELSE 0
 # MAGIC     END AS vendor_liability_amount,
 # MAGIC 
-# MAGIC     -- Document Classification
-# MAGIC     CASE
-# MAGIC         WHEN document_type_code = 'RE' THEN 'Invoice'
-# MAGIC         WHEN document_type_code = 'KZ' THEN 'Payment'
-# MAGIC         WHEN document_type_code = 'KG' THEN 'Credit Memo'
-# MAGIC         ELSE 'Other'
-# MAGIC     END AS document_type_description,
-# MAGIC 
 # MAGIC     -- Due Date Calculation
 # MAGIC     CASE
 # MAGIC         WHEN baseline_payment_date IS NOT NULL AND cash_discount_days_1 IS NOT NULL
@@ -277,63 +980,848 @@
 # MAGIC     END AS cash_discount_due_date,
 # MAGIC 
 # MAGIC     -- Data Quality Flags
-# MAGIC     CASE WHEN vendor_number IS NULL THEN 1 ELSE 0 END AS is_missing_vendor,
+# MAGIC     CASE WHEN stg.vendor_number IS NULL THEN 1 ELSE 0 END AS is_missing_vendor,
 # MAGIC     CASE WHEN amount_local_currency = 0 THEN 1 ELSE 0 END AS is_zero_amount,
 # MAGIC     is_vendor_not_in_master,
 # MAGIC 
 # MAGIC     -- Metadata
 # MAGIC     CURRENT_TIMESTAMP() AS etl_load_timestamp
 # MAGIC 
-# MAGIC FROM accounts_payable_staging;
+# MAGIC FROM ap_staging_changes stg
+# MAGIC LEFT JOIN dim_vendor v
+# MAGIC     ON v.MANDT = stg.mandt
+# MAGIC     AND v.vendor_number = stg.vendor_number
+# MAGIC LEFT JOIN dim_document_type dt
+# MAGIC     ON dt.document_type = stg.document_type_code;
+# MAGIC 
+# MAGIC -- Upgrading from the fact table with vendor columns: run
+# MAGIC -- once with load_mode = "full" after
+# MAGIC --   DROP TABLE accounts_payable_fact; DROP TABLE ap_vendor_stats;
+# MAGIC -- Upgrading from the fact table without net_payment_terms_days:
+# MAGIC -- run once with load_mode = "full" after
+# MAGIC --   ALTER TABLE accounts_payable_fact ADD COLUMNS (net_payment_terms_days INT);
 # MAGIC 
+# MAGIC -- First run: create the empty table with the view's schema.
+# MAGIC -- Partitioned by fiscal year and company code so report and
+# MAGIC -- MERGE filters on them skip whole directories
+# MAGIC CREATE TABLE IF NOT EXISTS accounts_payable_fact
+# MAGIC USING DELTA
+# MAGIC PARTITIONED BY (fiscal_year, company_code)
+# MAGIC AS SELECT * FROM ap_fact_changes WHERE 1 = 0;
 # MAGIC 
+# MAGIC -- Full load: start from an empty table
+# MAGIC DELETE FROM accounts_payable_fact WHERE '${ap.load_mode}' = 'full';
+# MAGIC 
+# MAGIC MERGE INTO accounts_payable_fact AS target
+# MAGIC USING ap_fact_changes AS source
+# MAGIC ON target.MANDT = source.MANDT
+# MAGIC     AND target.company_code = source.company_code
+# MAGIC     AND target.document_number = source.document_number
+# MAGIC     AND target.fiscal_year = source.fiscal_year
+# MAGIC     AND target.line_item_number = source.line_item_number
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+from delta.tables import DeltaTable
+
+# Compact the small files written by the MERGE in the fiscal years touched by
+# this run. Bin-packing only rewrites the small files, so its cost follows
+# the delta, not the history.
+touched_years = [
+    row.fiscal_year
+    for row in spark.sql("""
+        SELECT DISTINCT fiscal_year FROM ap_fact_changes
+        WHERE fiscal_year IS NOT NULL
+    """).collect()
+]
+if touched_years:
+    spark.sql(f"""
+        OPTIMIZE accounts_payable_fact
+        WHERE fiscal_year IN ({", ".join(str(year) for year in touched_years)})
+    """)
+
+# Cluster rows by vendor and posting date, so Direct Lake and SQL endpoint
+# queries can skip files by their min/max statistics. ZORDER rewrites every
+# file of a partition, so it runs once every zorder_interval_days, on the
+# fiscal years loaded since the previous ZORDER (all of them the first time).
+DeltaTable.forName(spark, "accounts_payable_fact").history().createOrReplaceTempView("ap_fact_history")
+zorder_years = [
+    row.fiscal_year
+    for row in spark.sql(f"""
+        WITH zorders AS (
+            SELECT timestamp FROM ap_fact_history
+            WHERE operation = 'OPTIMIZE' AND operationParameters['zOrderBy'] <> '[]'
+        )
+        SELECT DISTINCT fiscal_year
+        FROM accounts_payable_fact
+        WHERE fiscal_year IS NOT NULL
+          AND etl_load_timestamp > (SELECT COALESCE(MAX(timestamp), TIMESTAMP'1900-01-01') FROM zorders)
+          AND NOT EXISTS (
+              SELECT 1 FROM zorders
+              WHERE timestamp > current_timestamp() - INTERVAL {zorder_interval_days} DAYS
+          )
+    """).collect()
+]
+if zorder_years:
+    spark.sql(f"""
+        OPTIMIZE accounts_payable_fact
+        WHERE fiscal_year IN ({", ".join(str(year) for year in zorder_years)})
+        ZORDER BY (vendor_number, posting_date)
+    """)
+
+run_log.next_stage("clearing")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
+# MAGIC -- =====================================================
+# MAGIC -- CLEARING: Invoice-Payment Matching
 # MAGIC -- =====================================================
-# MAGIC -- Data Quality Summary View
+# MAGIC -- Purpose: Link vendor debits (payments, credit memos) to
+# MAGIC -- the invoices they settle, per vendor and company code,
+# MAGIC -- FIFO by due date with partial clearing
+# MAGIC -- Method: invoices and debits are laid out on one running
+# MAGIC -- amount axis per vendor. Each stretch between two line
+# MAGIC -- ends belongs to one invoice and one debit, found with
+# MAGIC -- window functions over one sort per vendor (no invoice x
+# MAGIC -- payment join)
+# MAGIC -- Output: ap_clearing_pairs (amount cleared per invoice
+# MAGIC --         line and debit line, days to pay)
+# MAGIC --         ap_open_items (invoice lines not fully cleared)
+# MAGIC -- Rebuilt from the fact table on every load: a new debit
+# MAGIC -- or reversal can move the allocation of older lines
 # MAGIC -- =====================================================
-# MAGIC CREATE OR REPLACE VIEW ap_data_quality_summary AS
+# MAGIC 
+# MAGIC -- Vendor lines of documents that are not reversed (the
+# MAGIC -- original and its reversal cancel out). Credits (H) are
+# MAGIC -- the items to pay, in due date order (baseline date or
+# MAGIC -- posting date without payment terms); debits (S) settle
+# MAGIC -- them in posting date order. running_amount is where a
+# MAGIC -- line ends on its side of the axis.
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_clearing_lines AS
 # MAGIC SELECT
-# MAGIC     COUNT(*) AS total_line_items,
-# MAGIC     SUM(is_missing_vendor) AS missing_vendor_count,
-# MAGIC     SUM(is_zero_amount) AS zero_amount_count,
-# MAGIC     SUM(is_vendor_not_in_master) AS vendor_not_in_master_count,
-# MAGIC     COUNT(DISTINCT vendor_number) AS unique_vendors,
-# MAGIC     COUNT(DISTINCT document_number) AS unique_documents,
-# MAGIC     SUM(CASE WHEN document_type = 'RE' THEN 1 ELSE 0 END) AS invoice_count,
-# MAGIC     SUM(CASE WHEN document_type = 'KZ' THEN 1 ELSE 0 END) AS payment_count,
-# MAGIC     MIN(posting_date) AS earliest_posting_date,
-# MAGIC     MAX(posting_date) AS latest_posting_date,
-# MAGIC     SUM(signed_amount) AS net_vendor_liability
-# MAGIC FROM accounts_payable_fact;
+# MAGIC     MANDT,
+# MAGIC     company_code,
+# MAGIC     vendor_number,
+# MAGIC     vendor_key,
+# MAGIC     fiscal_year,
+# MAGIC     document_number,
+# MAGIC     line_item_number,
+# MAGIC     document_type,
+# MAGIC     document_date,
+# MAGIC     posting_date,
+# MAGIC     net_due_date,
+# MAGIC     debit_credit_indicator,
+# MAGIC     amount_local_currency,
+# MAGIC     -- One partitioning for all windows of the stage: credits
+# MAGIC     -- sort before debits, each side sums only its own lines
+# MAGIC     CASE WHEN debit_credit_indicator = 'H'
+# MAGIC         THEN SUM(CASE WHEN debit_credit_indicator = 'H' THEN amount_local_currency ELSE 0 END) OVER (
+# MAGIC             PARTITION BY MANDT, company_code, vendor_number
+# MAGIC             ORDER BY debit_credit_indicator,
+# MAGIC                 CASE WHEN debit_credit_indicator = 'H' THEN item_due_date ELSE posting_date END NULLS LAST,
+# MAGIC                 fiscal_year, document_number, line_item_number
+# MAGIC             ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+# MAGIC         ELSE SUM(CASE WHEN debit_credit_indicator = 'S' THEN amount_local_currency ELSE 0 END) OVER (
+# MAGIC             PARTITION BY MANDT, company_code, vendor_number
+# MAGIC             ORDER BY debit_credit_indicator,
+# MAGIC                 CASE WHEN debit_credit_indicator = 'H' THEN item_due_date ELSE posting_date END NULLS LAST,
+# MAGIC                 fiscal_year, document_number, line_item_number
+# MAGIC             ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+# MAGIC     END AS running_amount,
+# MAGIC     SUM(CASE WHEN debit_credit_indicator = 'S' THEN amount_local_currency ELSE 0 END) OVER (
+# MAGIC         PARTITION BY MANDT, company_code, vendor_number
+# MAGIC     ) AS vendor_debit_amount
+# MAGIC FROM (
+# MAGIC     SELECT
+# MAGIC         *,
+# MAGIC         -- Same due date as in sql/create_ap_fact_table.sql: net
+# MAGIC         -- terms (ZBD3T) first, then the fact's due date
+# MAGIC         COALESCE(DATEADD(day, net_payment_terms_days, baseline_payment_date),
+# MAGIC                  net_due_date, baseline_payment_date, posting_date) AS item_due_date
+# MAGIC     FROM accounts_payable_fact
+# MAGIC     WHERE account_type = 'K'
+# MAGIC         AND vendor_number IS NOT NULL
+# MAGIC         AND reversal_document IS NULL
+# MAGIC         AND debit_credit_indicator IN ('H', 'S')
+# MAGIC         AND amount_local_currency > 0
+# MAGIC ) vendor_lines;
 # MAGIC 
+# MAGIC -- Sorted by running amount, the next invoice end at or
+# MAGIC -- after a line end names the invoice of the stretch that
+# MAGIC -- ends there, the next debit end names the debit. Without
+# MAGIC -- a debit the stretch is still open, without an invoice
+# MAGIC -- the debit is unapplied (paid in advance). A debit posted
+# MAGIC -- before its invoice is carried forward: the stretch is
+# MAGIC -- cleared when the invoice is posted (or dated), never
+# MAGIC -- before, so days to pay are not negative.
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_clearing_segments AS
+# MAGIC SELECT
+# MAGIC     MANDT,
+# MAGIC     company_code,
+# MAGIC     vendor_number,
+# MAGIC     vendor_key,
+# MAGIC     running_amount - COALESCE(LAG(running_amount) OVER by_amount, 0) AS segment_amount,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN fiscal_year END, TRUE) OVER ahead AS fiscal_year,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN document_number END, TRUE) OVER ahead AS document_number,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN line_item_number END, TRUE) OVER ahead AS line_item_number,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN document_date END, TRUE) OVER ahead AS document_date,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN net_due_date END, TRUE) OVER ahead AS net_due_date,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN fiscal_year END, TRUE) OVER ahead AS payment_fiscal_year,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN document_number END, TRUE) OVER ahead AS payment_document_number,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN line_item_number END, TRUE) OVER ahead AS payment_line_item_number,
+# MAGIC     FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN document_type END, TRUE) OVER ahead AS payment_document_type,
+# MAGIC     GREATEST(
+# MAGIC         FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN posting_date END, TRUE) OVER ahead,
+# MAGIC         FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN posting_date END, TRUE) OVER ahead,
+# MAGIC         FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN document_date END, TRUE) OVER ahead
+# MAGIC     ) AS clearing_date
+# MAGIC FROM ap_clearing_lines
+# MAGIC WINDOW
+# MAGIC     by_amount AS (
+# MAGIC         PARTITION BY MANDT, company_code, vendor_number
+# MAGIC         ORDER BY running_amount, debit_credit_indicator
+# MAGIC     ),
+# MAGIC     ahead AS (
+# MAGIC         PARTITION BY MANDT, company_code, vendor_number
+# MAGIC         ORDER BY running_amount, debit_credit_indicator
+# MAGIC         ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+# MAGIC     );
+# MAGIC 
+# MAGIC -- One row per invoice line and debit line that clears it.
+# MAGIC -- cleared_amount_days and on_time_amount let the report
+# MAGIC -- weight days to pay and punctuality by amount with SUMs
+# MAGIC CREATE OR REPLACE TABLE ap_clearing_pairs AS
+# MAGIC SELECT
+# MAGIC     MANDT,
+# MAGIC     company_code,
+# MAGIC     vendor_number,
+# MAGIC     vendor_key,
+# MAGIC     fiscal_year,
+# MAGIC     document_number,
+# MAGIC     line_item_number,
+# MAGIC     document_date,
+# MAGIC     net_due_date,
+# MAGIC     payment_fiscal_year,
+# MAGIC     payment_document_number,
+# MAGIC     payment_line_item_number,
+# MAGIC     payment_document_type,
+# MAGIC     clearing_date,
+# MAGIC     segment_amount AS cleared_amount,
+# MAGIC     DATEDIFF(clearing_date, document_date) AS days_to_pay,
+# MAGIC     DATEDIFF(clearing_date, net_due_date) AS days_past_due,
+# MAGIC     segment_amount * DATEDIFF(clearing_date, document_date) AS cleared_amount_days,
+# MAGIC     CASE
+# MAGIC         WHEN net_due_date IS NULL OR clearing_date <= net_due_date THEN segment_amount
+# MAGIC         ELSE 0
+# MAGIC     END AS on_time_amount
+# MAGIC FROM ap_clearing_segments
+# MAGIC WHERE segment_amount > 0
+# MAGIC     AND document_number IS NOT NULL
+# MAGIC     AND payment_document_number IS NOT NULL;
+# MAGIC 
+# MAGIC -- Invariant: no invoice is cleared before it is dated
+# MAGIC SELECT RAISE_ERROR(CONCAT(COUNT(*), ' ap_clearing_pairs rows with negative days_to_pay'))
+# MAGIC FROM ap_clearing_pairs
+# MAGIC WHERE days_to_pay < 0
+# MAGIC HAVING COUNT(*) > 0;
+# MAGIC 
+# MAGIC -- Invoice lines with an open balance: the part of the
+# MAGIC -- line beyond the vendor's total debits
+# MAGIC CREATE OR REPLACE TABLE ap_open_items AS
+# MAGIC SELECT
+# MAGIC     MANDT,
+# MAGIC     company_code,
+# MAGIC     vendor_number,
+# MAGIC     vendor_key,
+# MAGIC     fiscal_year,
+# MAGIC     document_number,
+# MAGIC     line_item_number,
+# MAGIC     document_type,
+# MAGIC     document_date,
+# MAGIC     posting_date,
+# MAGIC     net_due_date,
+# MAGIC     amount_local_currency AS item_amount,
+# MAGIC     amount_local_currency - open_amount AS cleared_amount,
+# MAGIC     open_amount
+# MAGIC FROM (
+# MAGIC     SELECT
+# MAGIC         *,
+# MAGIC         LEAST(amount_local_currency, GREATEST(running_amount - vendor_debit_amount, 0)) AS open_amount
+# MAGIC     FROM ap_clearing_lines
+# MAGIC     WHERE debit_credit_indicator = 'H'
+# MAGIC ) items
+# MAGIC WHERE open_amount > 0;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+run_log.next_stage("snapshots")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
 # MAGIC -- =====================================================
-# MAGIC -- Vendor Summary View
+# MAGIC -- STAGE 3: AP Snapshot Aggregates
 # MAGIC -- =====================================================
-# MAGIC CREATE OR REPLACE VIEW ap_vendor_summary AS
+# MAGIC -- Purpose: Pre-aggregate aging and payment KPIs so report
+# MAGIC -- measures read small tables instead of scanning the fact
+# MAGIC -- table with TODAY()-relative filters on every render
+# MAGIC -- Output: ap_aging_snapshot (one snapshot per load day)
+# MAGIC --         ap_payment_stats_monthly (changed months merged)
+# MAGIC -- =====================================================
+# MAGIC 
+# MAGIC CREATE TABLE IF NOT EXISTS ap_aging_snapshot (
+# MAGIC     snapshot_date DATE,
+# MAGIC     fiscal_year INT,
+# MAGIC     company_code STRING,
+# MAGIC     vendor_number STRING,
+# MAGIC     aging_bucket STRING,
+# MAGIC     aging_bucket_order INT,
+# MAGIC     open_amount DECIMAL(25,2),
+# MAGIC     invoice_count BIGINT,
+# MAGIC     vendor_key BIGINT
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC -- Upgrading from the snapshot without vendor_key (keeps the
+# MAGIC -- snapshot history): run once
+# MAGIC --   ALTER TABLE ap_aging_snapshot ADD COLUMNS (vendor_key BIGINT);
+# MAGIC --   MERGE INTO ap_aging_snapshot t USING dim_vendor d
+# MAGIC --   ON t.vendor_number <=> d.vendor_number
+# MAGIC --   WHEN MATCHED THEN UPDATE SET vendor_key = d.vendor_key;
+# MAGIC 
+# MAGIC -- Aging of the open invoice amounts (ap_open_items) as of
+# MAGIC -- the load day; a second run on the same day replaces that
+# MAGIC -- snapshot
+# MAGIC DELETE FROM ap_aging_snapshot WHERE snapshot_date = CURRENT_DATE();
+# MAGIC 
+# MAGIC INSERT INTO ap_aging_snapshot
 # MAGIC SELECT
+# MAGIC     CURRENT_DATE() AS snapshot_date,
+# MAGIC     fiscal_year,
+# MAGIC     company_code,
 # MAGIC     vendor_number,
-# MAGIC     vendor_name,
-# MAGIC     vendor_city,
-# MAGIC     vendor_country,
-# MAGIC     COUNT(DISTINCT document_number) AS document_count,
-# MAGIC     SUM(CASE WHEN document_type = 'RE' THEN vendor_liability_amount ELSE 0 END) AS total_invoices,
-# MAGIC     SUM(CASE WHEN document_type = 'KZ' THEN vendor_liability_amount ELSE 0 END) AS total_payments,
-# MAGIC     SUM(vendor_liability_amount) AS net_open_amount
-# MAGIC FROM accounts_payable_fact
-# MAGIC WHERE vendor_number IS NOT NULL
+# MAGIC     CASE aging_bucket_order
+# MAGIC         WHEN 0 THEN 'No Due Date'
+# MAGIC         WHEN 1 THEN 'Not Due'
+# MAGIC         WHEN 2 THEN '0-30 Days'
+# MAGIC         WHEN 3 THEN '31-60 Days'
+# MAGIC         WHEN 4 THEN '61-90 Days'
+# MAGIC         ELSE '90+ Days'
+# MAGIC     END AS aging_bucket,
+# MAGIC     aging_bucket_order,
+# MAGIC     SUM(open_amount) AS open_amount,
+# MAGIC     COUNT(DISTINCT document_number) AS invoice_count,
+# MAGIC     vendor_key
+# MAGIC FROM (
+# MAGIC     SELECT
+# MAGIC         fiscal_year,
+# MAGIC         company_code,
+# MAGIC         vendor_number,
+# MAGIC         vendor_key,
+# MAGIC         document_number,
+# MAGIC         open_amount,
+# MAGIC         CASE
+# MAGIC             WHEN net_due_date IS NULL THEN 0
+# MAGIC             WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 0 THEN 1
+# MAGIC             WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 30 THEN 2
+# MAGIC             WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 60 THEN 3
+# MAGIC             WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 90 THEN 4
+# MAGIC             ELSE 5
+# MAGIC         END AS aging_bucket_order
+# MAGIC     FROM ap_open_items
+# MAGIC ) invoices
 # MAGIC GROUP BY
+# MAGIC     fiscal_year,
+# MAGIC     company_code,
 # MAGIC     vendor_number,
-# MAGIC     vendor_name,
-# MAGIC     vendor_city,
-# MAGIC     vendor_country;
+# MAGIC     vendor_key,
+# MAGIC     aging_bucket_order;
+# MAGIC 
+# MAGIC CREATE TABLE IF NOT EXISTS ap_payment_stats_monthly (
+# MAGIC     posting_month DATE,
+# MAGIC     fiscal_year INT,
+# MAGIC     company_code STRING,
+# MAGIC     vendor_number STRING,
+# MAGIC     vendor_key BIGINT,
+# MAGIC     payment_line_count BIGINT,
+# MAGIC     total_payment_days BIGINT,
+# MAGIC     min_payment_days INT,
+# MAGIC     max_payment_days INT,
+# MAGIC     invoice_amount DECIMAL(25,2),
+# MAGIC     net_payables_amount DECIMAL(25,2)
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC -- Upgrading from the table without vendor_key: run once with
+# MAGIC -- ap.load_mode = full after
+# MAGIC --   DROP TABLE ap_payment_stats_monthly;
+# MAGIC DELETE FROM ap_payment_stats_monthly WHERE '${ap.load_mode}' = 'full';
+# MAGIC 
+# MAGIC -- Only months that received changed rows are recomputed
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_changed_months AS
+# MAGIC SELECT DISTINCT
+# MAGIC     fiscal_year,
+# MAGIC     company_code,
+# MAGIC     TRUNC(posting_date, 'MM') AS posting_month
+# MAGIC FROM ap_fact_changes
+# MAGIC WHERE posting_date IS NOT NULL;
+# MAGIC 
+# MAGIC MERGE INTO ap_payment_stats_monthly AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         TRUNC(fact.posting_date, 'MM') AS posting_month,
+# MAGIC         fact.fiscal_year,
+# MAGIC         fact.company_code,
+# MAGIC         fact.vendor_number,
+# MAGIC         fact.vendor_key,
+# MAGIC         SUM(CASE WHEN fact.document_type = 'KZ' THEN 1 ELSE 0 END) AS payment_line_count,
+# MAGIC         SUM(CASE WHEN fact.document_type = 'KZ'
+# MAGIC                  THEN DATEDIFF(fact.posting_date, fact.document_date) END) AS total_payment_days,
+# MAGIC         MIN(CASE WHEN fact.document_type = 'KZ'
+# MAGIC                  THEN DATEDIFF(fact.posting_date, fact.document_date) END) AS min_payment_days,
+# MAGIC         MAX(CASE WHEN fact.document_type = 'KZ'
+# MAGIC                  THEN DATEDIFF(fact.posting_date, fact.document_date) END) AS max_payment_days,
+# MAGIC         SUM(CASE WHEN fact.document_type = 'RE' AND fact.debit_credit_indicator = 'H'
+# MAGIC                  THEN fact.amount_local_currency ELSE 0 END) AS invoice_amount,
+# MAGIC         SUM(CASE WHEN fact.account_type = 'K' THEN fact.vendor_liability_amount ELSE 0 END) AS net_payables_amount
+# MAGIC     FROM accounts_payable_fact fact
+# MAGIC     LEFT SEMI JOIN ap_changed_months m
+# MAGIC         ON fact.fiscal_year = m.fiscal_year
+# MAGIC         AND fact.company_code = m.company_code
+# MAGIC         AND TRUNC(fact.posting_date, 'MM') = m.posting_month
+# MAGIC     GROUP BY
+# MAGIC         TRUNC(fact.posting_date, 'MM'),
+# MAGIC         fact.fiscal_year,
+# MAGIC         fact.company_code,
+# MAGIC         fact.vendor_number,
+# MAGIC         fact.vendor_key
+# MAGIC ) AS source
+# MAGIC ON target.posting_month = source.posting_month
+# MAGIC     AND target.fiscal_year = source.fiscal_year
+# MAGIC     AND target.company_code = source.company_code
+# MAGIC     AND target.vendor_key = source.vendor_key
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+run_log.next_stage("summaries")
+
+# Summaries used to be views over the fact table; replace them once by tables
+for view_name in ("ap_data_quality_summary", "ap_vendor_summary"):
+    if any(t.name == view_name and t.tableType == "VIEW" for t in spark.catalog.listTables()):
+        spark.sql(f"DROP VIEW {view_name}")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
+# MAGIC -- =====================================================
+# MAGIC -- Summary Tables
+# MAGIC -- =====================================================
+# MAGIC -- Purpose: Materialize the data quality and vendor
+# MAGIC -- summaries from small per-partition stats tables that
+# MAGIC -- are merged with the rows changed by this run, and
+# MAGIC -- evaluate the data quality rules of sql/dq_rules.json
+# MAGIC -- Output: ap_data_quality_summary (1 row)
+# MAGIC --         ap_vendor_summary (1 row per vendor)
+# MAGIC --         dq_rules (1 row per rule)
+# MAGIC --         dq_results (1 row per rule x posting date)
+# MAGIC -- =====================================================
+# MAGIC -- Upgrading from ap_dq_daily_stats with data quality
+# MAGIC -- counts: run once with load_mode = "full" after
+# MAGIC --   DROP TABLE ap_dq_daily_stats;
+# MAGIC 
+# MAGIC -- Exact counts per fiscal year x company code x posting date.
+# MAGIC -- A document has a single posting date, so distinct
+# MAGIC -- document counts add up across rows.
+# MAGIC CREATE TABLE IF NOT EXISTS ap_dq_daily_stats (
+# MAGIC     fiscal_year INT,
+# MAGIC     company_code STRING,
+# MAGIC     posting_date DATE,
+# MAGIC     line_item_count BIGINT,
+# MAGIC     document_count BIGINT,
+# MAGIC     invoice_line_count BIGINT,
+# MAGIC     payment_line_count BIGINT,
+# MAGIC     net_vendor_liability DECIMAL(25,2)
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC -- Vendor totals per fiscal year x company code; distinct
+# MAGIC -- vendors are counted exactly on this small table
+# MAGIC CREATE TABLE IF NOT EXISTS ap_vendor_stats (
+# MAGIC     fiscal_year INT,
+# MAGIC     company_code STRING,
+# MAGIC     vendor_number STRING,
+# MAGIC     document_count BIGINT,
+# MAGIC     total_invoices DECIMAL(25,2),
+# MAGIC     total_payments DECIMAL(25,2),
+# MAGIC     net_open_amount DECIMAL(25,2)
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC -- Data quality rules, generated from sql/dq_rules.json
+# MAGIC -- (sample-data/scripts/dq_rules.py)
+# MAGIC CREATE OR REPLACE TABLE dq_rules AS
+# MAGIC SELECT
+# MAGIC     rule_id,
+# MAGIC     rule_type,
+# MAGIC     column_name,
+# MAGIC     severity,
+# MAGIC     CAST(min_pass_rate AS DECIMAL(5,4)) AS min_pass_rate,
+# MAGIC     description
+# MAGIC FROM (
+# MAGIC     VALUES
+# MAGIC     -- BEGIN GENERATED: dq rules (sample-data/scripts/dq_rules.py)
+# MAGIC     ('posting_date_present', 'completeness', 'posting_date', 'high', 1.0, 'Posting date (BUDAT) is set'),
+# MAGIC     ('document_date_present', 'completeness', 'document_date', 'medium', 1.0, 'Document date (BLDAT) is set'),
+# MAGIC     ('document_type_present', 'completeness', 'document_type', 'medium', 1.0, 'Document type (BLART) is set'),
+# MAGIC     ('vendor_number_present', 'completeness', 'vendor_number', 'high', 0.95, 'Line item carries a vendor number (LIFNR)'),
+# MAGIC     ('baseline_date_present', 'completeness', 'baseline_payment_date', 'medium', 0.99, 'Vendor line has a baseline payment date (ZFBDT)'),
+# MAGIC     ('payment_terms_present', 'completeness', 'payment_terms', 'low', 0.95, 'Vendor line has payment terms (ZTERM)'),
+# MAGIC     ('debit_credit_valid', 'validity', 'debit_credit_indicator', 'high', 1.0, 'Debit/credit indicator (SHKZG) is S or H'),
+# MAGIC     ('account_type_valid', 'validity', 'account_type', 'high', 1.0, 'Account type (KOART) is a known SAP account type'),
+# MAGIC     ('document_type_known', 'validity', 'document_type', 'low', 0.9, 'Document type is an invoice, payment or credit memo'),
+# MAGIC     ('amount_not_zero', 'validity', 'amount_local_currency', 'low', 0.99, 'Amount in local currency (DMBTR) is not zero'),
+# MAGIC     ('posting_not_before_document_date', 'range', 'posting_date', 'medium', 0.99, 'Posting date is not before the document date'),
+# MAGIC     ('cash_discount_days_range', 'range', 'cash_discount_days_1', 'low', 1.0, 'Cash discount days (ZBD1T) are between 0 and 365'),
+# MAGIC     ('vendor_in_master', 'referential', 'vendor_number', 'high', 1.0, 'Vendor number exists in the vendor master (LFA1)')
+# MAGIC     -- END GENERATED: dq rules
+# MAGIC ) AS r(rule_id, rule_type, column_name, severity, min_pass_rate, description);
+# MAGIC 
+# MAGIC -- Rows checked and failed per rule x fiscal year x
+# MAGIC -- company code x posting date
+# MAGIC CREATE TABLE IF NOT EXISTS dq_results (
+# MAGIC     rule_id STRING,
+# MAGIC     fiscal_year INT,
+# MAGIC     company_code STRING,
+# MAGIC     posting_date DATE,
+# MAGIC     rows_checked BIGINT,
+# MAGIC     rows_failed BIGINT,
+# MAGIC     evaluated_at TIMESTAMP
+# MAGIC ) USING DELTA;
+# MAGIC 
+# MAGIC DELETE FROM ap_dq_daily_stats WHERE '${ap.load_mode}' = 'full';
+# MAGIC DELETE FROM ap_vendor_stats WHERE '${ap.load_mode}' = 'full';
+# MAGIC DELETE FROM dq_results WHERE '${ap.load_mode}' = 'full';
+# MAGIC 
+# MAGIC -- Results of rules removed from dq_rules.json
+# MAGIC MERGE INTO dq_results AS target
+# MAGIC USING dq_rules AS source
+# MAGIC ON target.rule_id = source.rule_id
+# MAGIC WHEN NOT MATCHED BY SOURCE THEN DELETE;
+# MAGIC 
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_changed_days AS
+# MAGIC SELECT DISTINCT fiscal_year, company_code, posting_date
+# MAGIC FROM ap_fact_changes;
+# MAGIC 
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_changed_vendor_partitions AS
+# MAGIC SELECT DISTINCT fiscal_year, company_code, vendor_number
+# MAGIC FROM ap_fact_changes
+# MAGIC WHERE vendor_number IS NOT NULL;
+# MAGIC 
+# MAGIC -- A rule without results (added to dq_rules.json since the
+# MAGIC -- last run) is evaluated on all days, not only changed ones
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_dq_days AS
+# MAGIC SELECT fiscal_year, company_code, posting_date
+# MAGIC FROM ap_changed_days
+# MAGIC 
+# MAGIC UNION
+# MAGIC 
+# MAGIC SELECT fiscal_year, company_code, posting_date
+# MAGIC FROM ap_dq_daily_stats
+# MAGIC WHERE (SELECT COUNT(DISTINCT rule_id) FROM dq_results)
+# MAGIC     < (SELECT COUNT(*) FROM dq_rules);
+# MAGIC 
+# MAGIC -- One aggregation over the fact rows of those days computes
+# MAGIC -- the daily stats and the counts of every rule
+# MAGIC CREATE OR REPLACE TEMP VIEW ap_dq_day_counts AS
+# MAGIC SELECT
+# MAGIC     fact.fiscal_year,
+# MAGIC     fact.company_code,
+# MAGIC     fact.posting_date,
+# MAGIC     COUNT(*) AS line_item_count,
+# MAGIC     COUNT(DISTINCT fact.document_number) AS document_count,
+# MAGIC     SUM(CASE WHEN fact.document_type = 'RE' THEN 1 ELSE 0 END) AS invoice_line_count,
+# MAGIC     SUM(CASE WHEN fact.document_type = 'KZ' THEN 1 ELSE 0 END) AS payment_line_count,
+# MAGIC     SUM(fact.signed_amount) AS net_vendor_liability,
+# MAGIC     -- BEGIN GENERATED: dq rule counts (sample-data/scripts/dq_rules.py)
+# MAGIC     COUNT(*) AS posting_date_present_checked,
+# MAGIC     SUM(CASE WHEN posting_date IS NULL THEN 1 ELSE 0 END) AS posting_date_present_failed,
+# MAGIC     COUNT(*) AS document_date_present_checked,
+# MAGIC     SUM(CASE WHEN document_date IS NULL THEN 1 ELSE 0 END) AS document_date_present_failed,
+# MAGIC     COUNT(*) AS document_type_present_checked,
+# MAGIC     SUM(CASE WHEN document_type IS NULL THEN 1 ELSE 0 END) AS document_type_present_failed,
+# MAGIC     COUNT(*) AS vendor_number_present_checked,
+# MAGIC     SUM(CASE WHEN vendor_number IS NULL THEN 1 ELSE 0 END) AS vendor_number_present_failed,
+# MAGIC     SUM(CASE WHEN account_type = 'K' THEN 1 ELSE 0 END) AS baseline_date_present_checked,
+# MAGIC     SUM(CASE WHEN account_type = 'K' AND baseline_payment_date IS NULL THEN 1 ELSE 0 END) AS baseline_date_present_failed,
+# MAGIC     SUM(CASE WHEN account_type = 'K' THEN 1 ELSE 0 END) AS payment_terms_present_checked,
+# MAGIC     SUM(CASE WHEN account_type = 'K' AND payment_terms IS NULL THEN 1 ELSE 0 END) AS payment_terms_present_failed,
+# MAGIC     SUM(CASE WHEN debit_credit_indicator IS NOT NULL THEN 1 ELSE 0 END) AS debit_credit_valid_checked,
+# MAGIC     SUM(CASE WHEN debit_credit_indicator IS NOT NULL AND debit_credit_indicator NOT IN ('S', 'H') THEN 1 ELSE 0 END) AS debit_credit_valid_failed,
+# MAGIC     SUM(CASE WHEN account_type IS NOT NULL THEN 1 ELSE 0 END) AS account_type_valid_checked,
+# MAGIC     SUM(CASE WHEN account_type IS NOT NULL AND account_type NOT IN ('A', 'D', 'K', 'M', 'S') THEN 1 ELSE 0 END) AS account_type_valid_failed,
+# MAGIC     SUM(CASE WHEN document_type IS NOT NULL THEN 1 ELSE 0 END) AS document_type_known_checked,
+# MAGIC     SUM(CASE WHEN document_type IS NOT NULL AND document_type NOT IN ('RE', 'KZ', 'KG') THEN 1 ELSE 0 END) AS document_type_known_failed,
+# MAGIC     SUM(CASE WHEN amount_local_currency IS NOT NULL THEN 1 ELSE 0 END) AS amount_not_zero_checked,
+# MAGIC     SUM(CASE WHEN amount_local_currency IS NOT NULL AND amount_local_currency = 0 THEN 1 ELSE 0 END) AS amount_not_zero_failed,
+# MAGIC     SUM(CASE WHEN posting_date IS NOT NULL THEN 1 ELSE 0 END) AS posting_not_before_document_date_checked,
+# MAGIC     SUM(CASE WHEN posting_date IS NOT NULL AND posting_date < document_date THEN 1 ELSE 0 END) AS posting_not_before_document_date_failed,
+# MAGIC     SUM(CASE WHEN cash_discount_days_1 IS NOT NULL THEN 1 ELSE 0 END) AS cash_discount_days_range_checked,
+# MAGIC     SUM(CASE WHEN cash_discount_days_1 IS NOT NULL AND (cash_discount_days_1 < 0 OR cash_discount_days_1 > 365) THEN 1 ELSE 0 END) AS cash_discount_days_range_failed,
+# MAGIC     SUM(CASE WHEN vendor_number IS NOT NULL THEN 1 ELSE 0 END) AS vendor_in_master_checked,
+# MAGIC     SUM(CASE WHEN vendor_number IS NOT NULL AND is_vendor_not_in_master = 1 THEN 1 ELSE 0 END) AS vendor_in_master_failed
+# MAGIC     -- END GENERATED: dq rule counts
+# MAGIC FROM accounts_payable_fact fact
+# MAGIC LEFT SEMI JOIN ap_dq_days d
+# MAGIC     ON fact.fiscal_year = d.fiscal_year
+# MAGIC     AND fact.company_code = d.company_code
+# MAGIC     AND fact.posting_date <=> d.posting_date
+# MAGIC GROUP BY
+# MAGIC     fact.fiscal_year,
+# MAGIC     fact.company_code,
+# MAGIC     fact.posting_date;
+# MAGIC 
+# MAGIC CACHE TABLE ap_dq_day_counts;
+# MAGIC 
+# MAGIC MERGE INTO ap_dq_daily_stats AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         fiscal_year,
+# MAGIC         company_code,
+# MAGIC         posting_date,
+# MAGIC         line_item_count,
+# MAGIC         document_count,
+# MAGIC         invoice_line_count,
+# MAGIC         payment_line_count,
+# MAGIC         net_vendor_liability
+# MAGIC     FROM ap_dq_day_counts
+# MAGIC ) AS source
+# MAGIC ON target.fiscal_year = source.fiscal_year
+# MAGIC     AND target.company_code = source.company_code
+# MAGIC     AND target.posting_date <=> source.posting_date
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+# MAGIC 
+# MAGIC -- One row per rule and day: the (checked, failed) column
+# MAGIC -- pairs of the aggregation above, unpivoted
+# MAGIC MERGE INTO dq_results AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         rule_id,
+# MAGIC         fiscal_year,
+# MAGIC         company_code,
+# MAGIC         posting_date,
+# MAGIC         rows_checked,
+# MAGIC         rows_failed,
+# MAGIC         CURRENT_TIMESTAMP() AS evaluated_at
+# MAGIC     FROM ap_dq_day_counts
+# MAGIC     UNPIVOT ((rows_checked, rows_failed) FOR rule_id IN (
+# MAGIC         -- BEGIN GENERATED: dq rule columns (sample-data/scripts/dq_rules.py)
+# MAGIC         (posting_date_present_checked, posting_date_present_failed) AS posting_date_present,
+# MAGIC         (document_date_present_checked, document_date_present_failed) AS document_date_present,
+# MAGIC         (document_type_present_checked, document_type_present_failed) AS document_type_present,
+# MAGIC         (vendor_number_present_checked, vendor_number_present_failed) AS vendor_number_present,
+# MAGIC         (baseline_date_present_checked, baseline_date_present_failed) AS baseline_date_present,
+# MAGIC         (payment_terms_present_checked, payment_terms_present_failed) AS payment_terms_present,
+# MAGIC         (debit_credit_valid_checked, debit_credit_valid_failed) AS debit_credit_valid,
+# MAGIC         (account_type_valid_checked, account_type_valid_failed) AS account_type_valid,
+# MAGIC         (document_type_known_checked, document_type_known_failed) AS document_type_known,
+# MAGIC         (amount_not_zero_checked, amount_not_zero_failed) AS amount_not_zero,
+# MAGIC         (posting_not_before_document_date_checked, posting_not_before_document_date_failed) AS posting_not_before_document_date,
+# MAGIC         (cash_discount_days_range_checked, cash_discount_days_range_failed) AS cash_discount_days_range,
+# MAGIC         (vendor_in_master_checked, vendor_in_master_failed) AS vendor_in_master
+# MAGIC         -- END GENERATED: dq rule columns
+# MAGIC     ))
+# MAGIC ) AS source
+# MAGIC ON target.rule_id = source.rule_id
+# MAGIC     AND target.fiscal_year = source.fiscal_year
+# MAGIC     AND target.company_code = source.company_code
+# MAGIC     AND target.posting_date <=> source.posting_date
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+# MAGIC 
+# MAGIC UNCACHE TABLE IF EXISTS ap_dq_day_counts;
+# MAGIC 
+# MAGIC 
+# MAGIC MERGE INTO ap_vendor_stats AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         fact.fiscal_year,
+# MAGIC         fact.company_code,
+# MAGIC         fact.vendor_number,
+# MAGIC         COUNT(DISTINCT fact.document_number) AS document_count,
+# MAGIC         SUM(CASE WHEN fact.document_type = 'RE' THEN fact.vendor_liability_amount ELSE 0 END) AS total_invoices,
+# MAGIC         SUM(CASE WHEN fact.document_type = 'KZ' THEN fact.vendor_liability_amount ELSE 0 END) AS total_payments,
+# MAGIC         SUM(fact.vendor_liability_amount) AS net_open_amount
+# MAGIC     FROM accounts_payable_fact fact
+# MAGIC     LEFT SEMI JOIN ap_changed_vendor_partitions v
+# MAGIC         ON fact.fiscal_year = v.fiscal_year
+# MAGIC         AND fact.company_code = v.company_code
+# MAGIC         AND fact.vendor_number = v.vendor_number
+# MAGIC     GROUP BY
+# MAGIC         fact.fiscal_year,
+# MAGIC         fact.company_code,
+# MAGIC         fact.vendor_number
+# MAGIC ) AS source
+# MAGIC ON target.fiscal_year = source.fiscal_year
+# MAGIC     AND target.company_code = source.company_code
+# MAGIC     AND target.vendor_number = source.vendor_number
+# MAGIC WHEN MATCHED THEN UPDATE SET *
+# MAGIC WHEN NOT MATCHED THEN INSERT *;
+# MAGIC 
+# MAGIC -- Both summaries read only the stats tables above (and
+# MAGIC -- the vendor names of dim_vendor)
+# MAGIC CREATE OR REPLACE TABLE ap_data_quality_summary AS
+# MAGIC SELECT
+# MAGIC     SUM(line_item_count) AS total_line_items,
+# MAGIC     (SELECT SUM(rows_failed) FROM dq_results WHERE rule_id = 'vendor_number_present') AS missing_vendor_count,
+# MAGIC     (SELECT SUM(rows_failed) FROM dq_results WHERE rule_id = 'amount_not_zero') AS zero_amount_count,
+# MAGIC     (SELECT SUM(rows_failed) FROM dq_results WHERE rule_id = 'vendor_in_master') AS vendor_not_in_master_count,
+# MAGIC     (SELECT COUNT(DISTINCT vendor_number) FROM ap_vendor_stats) AS unique_vendors,
+# MAGIC     SUM(document_count) AS unique_documents,
+# MAGIC     SUM(invoice_line_count) AS invoice_count,
+# MAGIC     SUM(payment_line_count) AS payment_count,
+# MAGIC     MIN(posting_date) AS earliest_posting_date,
+# MAGIC     MAX(posting_date) AS latest_posting_date,
+# MAGIC     SUM(net_vendor_liability) AS net_vendor_liability
+# MAGIC FROM ap_dq_daily_stats;
+# MAGIC 
+# MAGIC CREATE OR REPLACE TABLE ap_vendor_summary AS
+# MAGIC SELECT
+# MAGIC     s.vendor_number,
+# MAGIC     v.vendor_name,
+# MAGIC     v.vendor_city,
+# MAGIC     v.vendor_country,
+# MAGIC     s.document_count,
+# MAGIC     s.total_invoices,
+# MAGIC     s.total_payments,
+# MAGIC     s.net_open_amount
+# MAGIC FROM (
+# MAGIC     SELECT
+# MAGIC         vendor_number,
+# MAGIC         SUM(document_count) AS document_count,
+# MAGIC         SUM(total_invoices) AS total_invoices,
+# MAGIC         SUM(total_payments) AS total_payments,
+# MAGIC         SUM(net_open_amount) AS net_open_amount
+# MAGIC     FROM ap_vendor_stats
+# MAGIC     GROUP BY vendor_number
+# MAGIC ) s
+# MAGIC LEFT JOIN (
+# MAGIC     SELECT
+# MAGIC         vendor_number,
+# MAGIC         MAX(vendor_name) AS vendor_name,
+# MAGIC         MAX(vendor_city) AS vendor_city,
+# MAGIC         MAX(vendor_country) AS vendor_country
+# MAGIC     FROM dim_vendor
+# MAGIC     GROUP BY vendor_number
+# MAGIC ) v
+# MAGIC     ON v.vendor_number = s.vendor_number;
+
+# METADATA ********************
+
+# META {
+# META   "language": "sparksql",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+run_log.next_stage("watermark")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# MAGIC %%sql
+# MAGIC -- =====================================================
+# MAGIC -- Advance Watermark
+# MAGIC -- =====================================================
+# MAGIC -- Runs only after both MERGEs succeeded, so a failed run
+# MAGIC -- is picked up again by the next one
+# MAGIC -- =====================================================
+# MAGIC 
+# MAGIC MERGE INTO ap_load_watermark AS target
+# MAGIC USING (
+# MAGIC     SELECT
+# MAGIC         'accounts_payable_staging' AS table_name,
+# MAGIC         DATE_FORMAT(MAX(CPUDT), 'yyyyMMdd') AS last_entry_date
+# MAGIC     FROM bkpf
+# MAGIC ) AS source
+# MAGIC ON target.table_name = source.table_name
+# MAGIC WHEN MATCHED THEN UPDATE SET
+# MAGIC     last_entry_date = COALESCE(source.last_entry_date, target.last_entry_date),
+# MAGIC     updated_at = CURRENT_TIMESTAMP()
+# MAGIC WHEN NOT MATCHED THEN INSERT (table_name, last_entry_date, updated_at)
+# MAGIC     VALUES (source.table_name, source.last_entry_date, CURRENT_TIMESTAMP());
+# MAGIC 
+# MAGIC INSERT OVERWRITE TABLE ap_vendor_snapshot
+# MAGIC SELECT MANDT, LIFNR, vendor_hash FROM ap_vendor_hash;
+# MAGIC 
+# MAGIC UNCACHE TABLE IF EXISTS ap_staging_changes;
+# MAGIC 
 # MAGIC 
 # MAGIC -- =====================================================
 # MAGIC -- Usage Instructions
 # MAGIC -- =====================================================
 # MAGIC -- 1. Run this entire script in your Lakehouse SQL endpoint
-# MAGIC -- 2. Stage 1 creates: accounts_payable_staging (typed data)
-# MAGIC -- 3. Stage 2 creates: accounts_payable_fact (business logic)
+# MAGIC -- 2. Stage 1 casts into: ap_staging_changes (cached view;
+# MAGIC --    persist_staging = True also writes accounts_payable_staging)
+# MAGIC --    Dimensions merge into: dim_vendor, dim_document_type, dim_date
+# MAGIC -- 3. Stage 2 merges into: accounts_payable_fact (business logic)
+# MAGIC --    Clearing rebuilds: ap_clearing_pairs, ap_open_items
+# MAGIC --    Stage 3 refreshes: ap_aging_snapshot, ap_payment_stats_monthly
+# MAGIC --    Summary tables: ap_data_quality_summary, ap_vendor_summary
 # MAGIC -- 4. Verify: SELECT * FROM ap_data_quality_summary;
-# MAGIC -- 5. Publish 'accounts_payable_fact' to your semantic model
+# MAGIC -- 5. The model_refresh stage reframes the tables of the
+# MAGIC --    semantic_model this run changed
+# MAGIC -- 6. Rebuild everything: run with load_mode = "full"
 # MAGIC -- =====================================================
 
 
@@ -346,6 +1834,78 @@
 
 # CELL ********************
 
+run_log.next_stage("model_refresh")
+
+# Direct Lake has no import partitions or refresh policy: a refresh reframes a
+# table onto its latest Delta version, and the column data of the Parquet files
+# the run did not rewrite stays in memory. Only tables whose version changed
+# since the last completed run are reframed, so the work follows the
+# fiscal_year/company_code partitions this run touched, not the history.
+# Turn off "Keep your Direct Lake data up to date" on the model, or every
+# commit of a stage reframes it as well.
+import sempy.fabric as fabric
+
+MODEL_TABLES = ["accounts_payable_fact", "ap_aging_snapshot", "ap_clearing_pairs",
+                "ap_payment_stats_monthly", "dim_company_code", "dim_date", "dim_document_type",
+                "dim_vendor", "dq_results", "dq_rules"]
+REFRESH_POLL_S = 10
+
+# A run that fails here writes no etl_run_cache row, so the next run
+# reframes its tables as well
+last_completed = spark.table("etl_run_cache").first()
+framed_versions = json.loads(last_completed.output_versions) if last_completed else {}
+changed_tables = [t for t in MODEL_TABLES if _table_version(t) != framed_versions.get(t)]
+
+if semantic_model and changed_tables:
+    request_id = fabric.refresh_dataset(
+        semantic_model, refresh_type="full", objects=[{"table": t} for t in changed_tables]
+    )
+    status = "notStarted"
+    while status.lower() in ("notstarted", "inprogress", "unknown"):
+        time.sleep(REFRESH_POLL_S)
+        status = fabric.get_refresh_execution_details(semantic_model, request_id).status
+    if status.lower() != "completed":
+        raise RuntimeError(f"Refresh {request_id} of {semantic_model} ended with status {status}")
+    print(f"Reframed {', '.join(changed_tables)}")
+elif semantic_model:
+    print(f"No tables of {semantic_model} changed")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+run_log.next_stage(None)
+
+# Only the last completed run can be reused (the outputs hold its results).
+# Written with a NULL fingerprint too: model_refresh compares the next run's
+# tables with these versions
+spark.createDataFrame(
+    [(run_fingerprint, _output_versions(), run_id, datetime.now())],
+    spark.table("etl_run_cache").schema,
+).write.mode("overwrite").saveAsTable("etl_run_cache")
+
+display(spark.sql(f"""
+    SELECT stage, duration_s, rows_in, rows_out, files_written, bytes_written,
+           merge_scan_time_ms, merge_rewrite_time_ms, shuffle_read_bytes, shuffle_write_bytes
+    FROM etl_run_log
+    WHERE run_id = '{run_id}'
+    ORDER BY start_time
+"""))
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
 # MAGIC %%sql
 # MAGIC SELECT * FROM ap_data_quality_summary
 
@@ -0,0 +1,343 @@
+# Fabric notebook source
+
+# METADATA ********************
+
+# META {
+# META   "kernel_info": {
+# META     "name": "synapse_pyspark"
+# META   },
+# META   "dependencies": {
+# META     "lakehouse": {
+# META       "default_lakehouse": "f245663a-76de-4021-a6dd-6a806d27f57b",
+# META       "default_lakehouse_name": "SapDataLakehouse",
+# META       "default_lakehouse_workspace_id": "4401777b-4041-493e-81bc-efb3c0cc5c44",
+# META       "known_lakehouses": [
+# META         {
+# META           "id": "f245663a-76de-4021-a6dd-6a806d27f57b"
+# META         }
+# META       ]
+# META     }
+# META   }
+# META }
+
+# PARAMETERS CELL ********************
+
+# Lakehouse folder with the extracts: one file per table or multi-part files
+# (sap_bseg_line_items_00000.csv, sap_bseg_line_items_00001.csv, ...), and
+# delta extracts in delta/<date>/ whose rows replace those of the same key
+extract_folder = "Files/sap_extracts"
+# Byte range per read task: every file is split into ranges of this size
+split_size_mb = 128
+# Tables to ingest; the pipeline runs one activity per table
+tables = "lfa1,bkpf,bseg"
+# Ingest even when the extract files did not change since the last ingest
+force = False
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Landing SQL per table, generated from the schema registry
+# (sample-data/scripts/sap_fields.py): typed SELECT list and the expression
+# that lists the fields of a row that do not parse ('' for a valid row)
+
+# BEGIN GENERATED: landing SQL (sample-data/scripts/sap_fields.py)
+LANDING_COLUMNS = {
+    "bkpf": [
+        "COALESCE(MANDT, '') AS MANDT",
+        "COALESCE(BUKRS, '') AS BUKRS",
+        "COALESCE(BELNR, '') AS BELNR",
+        "COALESCE(GJAHR, '') AS GJAHR",
+        "COALESCE(BLART, '') AS BLART",
+        "TRY_CAST(CASE WHEN BLDAT IS NULL OR TRIM(BLDAT) = '' THEN NULL WHEN LENGTH(TRIM(BLDAT)) = 8 THEN CONCAT(SUBSTRING(BLDAT, 1, 4), '-', SUBSTRING(BLDAT, 5, 2), '-', SUBSTRING(BLDAT, 7, 2)) ELSE BLDAT END AS DATE) AS BLDAT",
+        "TRY_CAST(CASE WHEN BUDAT IS NULL OR TRIM(BUDAT) = '' THEN NULL WHEN LENGTH(TRIM(BUDAT)) = 8 THEN CONCAT(SUBSTRING(BUDAT, 1, 4), '-', SUBSTRING(BUDAT, 5, 2), '-', SUBSTRING(BUDAT, 7, 2)) ELSE BUDAT END AS DATE) AS BUDAT",
+        "TRY_CAST(CASE WHEN CPUDT IS NULL OR TRIM(CPUDT) = '' THEN NULL WHEN LENGTH(TRIM(CPUDT)) = 8 THEN CONCAT(SUBSTRING(CPUDT, 1, 4), '-', SUBSTRING(CPUDT, 5, 2), '-', SUBSTRING(CPUDT, 7, 2)) ELSE CPUDT END AS DATE) AS CPUDT",
+        "COALESCE(WAERS, '') AS WAERS",
+        "TRY_CAST(CASE WHEN KURSF IS NULL OR TRIM(KURSF) = '' THEN NULL WHEN TRIM(KURSF) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(KURSF)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(KURSF, ',', ''), ' ', '') END AS DECIMAL(9,5)) AS KURSF",
+        "COALESCE(USNAM, '') AS USNAM",
+        "COALESCE(TCODE, '') AS TCODE",
+        "COALESCE(BKTXT, '') AS BKTXT",
+        "COALESCE(XBLNR, '') AS XBLNR",
+        "COALESCE(BSTAT, '') AS BSTAT",
+        "COALESCE(STBLG, '') AS STBLG",
+        "COALESCE(STJAH, '') AS STJAH",
+    ],
+    "bseg": [
+        "COALESCE(MANDT, '') AS MANDT",
+        "COALESCE(BUKRS, '') AS BUKRS",
+        "COALESCE(BELNR, '') AS BELNR",
+        "COALESCE(GJAHR, '') AS GJAHR",
+        "COALESCE(BUZEI, '') AS BUZEI",
+        "COALESCE(KOART, '') AS KOART",
+        "COALESCE(SHKZG, '') AS SHKZG",
+        "TRY_CAST(CASE WHEN DMBTR IS NULL OR TRIM(DMBTR) = '' THEN NULL WHEN TRIM(DMBTR) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(DMBTR)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(DMBTR, ',', ''), ' ', '') END AS DECIMAL(15,2)) AS DMBTR",
+        "TRY_CAST(CASE WHEN WRBTR IS NULL OR TRIM(WRBTR) = '' THEN NULL WHEN TRIM(WRBTR) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(WRBTR)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(WRBTR, ',', ''), ' ', '') END AS DECIMAL(15,2)) AS WRBTR",
+        "COALESCE(PSWSL, '') AS PSWSL",
+        "TRY_CAST(CASE WHEN MWSTS IS NULL OR TRIM(MWSTS) = '' THEN NULL WHEN TRIM(MWSTS) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(MWSTS)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(MWSTS, ',', ''), ' ', '') END AS DECIMAL(15,2)) AS MWSTS",
+        "COALESCE(HKONT, '') AS HKONT",
+        "COALESCE(KOSTL, '') AS KOSTL",
+        "COALESCE(LIFNR, '') AS LIFNR",
+        "TRY_CAST(CASE WHEN ZFBDT IS NULL OR TRIM(ZFBDT) = '' THEN NULL WHEN LENGTH(TRIM(ZFBDT)) = 8 THEN CONCAT(SUBSTRING(ZFBDT, 1, 4), '-', SUBSTRING(ZFBDT, 5, 2), '-', SUBSTRING(ZFBDT, 7, 2)) ELSE ZFBDT END AS DATE) AS ZFBDT",
+        "TRY_CAST(ZBD1T AS INT) AS ZBD1T",
+        "TRY_CAST(CASE WHEN ZBD1P IS NULL OR TRIM(ZBD1P) = '' THEN NULL WHEN TRIM(ZBD1P) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(ZBD1P)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(ZBD1P, ',', ''), ' ', '') END AS DECIMAL(5,3)) AS ZBD1P",
+        "TRY_CAST(ZBD2T AS INT) AS ZBD2T",
+        "TRY_CAST(ZBD3T AS INT) AS ZBD3T",
+        "COALESCE(ZTERM, '') AS ZTERM",
+        "TRY_CAST(CASE WHEN SKFBT IS NULL OR TRIM(SKFBT) = '' THEN NULL WHEN TRIM(SKFBT) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(SKFBT)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(SKFBT, ',', ''), ' ', '') END AS DECIMAL(15,2)) AS SKFBT",
+        "COALESCE(SGTXT, '') AS SGTXT",
+        "COALESCE(ZUONR, '') AS ZUONR",
+    ],
+    "lfa1": [
+        "COALESCE(MANDT, '') AS MANDT",
+        "COALESCE(LIFNR, '') AS LIFNR",
+        "COALESCE(NAME1, '') AS NAME1",
+        "COALESCE(NAME2, '') AS NAME2",
+        "COALESCE(SORTL, '') AS SORTL",
+        "COALESCE(STRAS, '') AS STRAS",
+        "COALESCE(ORT01, '') AS ORT01",
+        "COALESCE(PSTLZ, '') AS PSTLZ",
+        "COALESCE(LAND1, '') AS LAND1",
+        "COALESCE(REGIO, '') AS REGIO",
+        "COALESCE(STCD1, '') AS STCD1",
+        "COALESCE(STCD2, '') AS STCD2",
+        "COALESCE(STCEG, '') AS STCEG",
+        "COALESCE(KTOKK, '') AS KTOKK",
+        "COALESCE(BRSCH, '') AS BRSCH",
+        "COALESCE(LOEVM, '') AS LOEVM",
+        "COALESCE(SPERR, '') AS SPERR",
+        "COALESCE(TELF1, '') AS TELF1",
+        "COALESCE(SMTP_ADDR, '') AS SMTP_ADDR",
+    ],
+}
+REJECTED_FIELDS = {
+    "bkpf": "CONCAT_WS(',', CASE WHEN TRIM(BLDAT) <> '' AND TRY_CAST(CASE WHEN BLDAT IS NULL OR TRIM(BLDAT) = '' THEN NULL WHEN LENGTH(TRIM(BLDAT)) = 8 THEN CONCAT(SUBSTRING(BLDAT, 1, 4), '-', SUBSTRING(BLDAT, 5, 2), '-', SUBSTRING(BLDAT, 7, 2)) ELSE BLDAT END AS DATE) IS NULL THEN 'BLDAT' END, CASE WHEN TRIM(BUDAT) <> '' AND TRY_CAST(CASE WHEN BUDAT IS NULL OR TRIM(BUDAT) = '' THEN NULL WHEN LENGTH(TRIM(BUDAT)) = 8 THEN CONCAT(SUBSTRING(BUDAT, 1, 4), '-', SUBSTRING(BUDAT, 5, 2), '-', SUBSTRING(BUDAT, 7, 2)) ELSE BUDAT END AS DATE) IS NULL THEN 'BUDAT' END, CASE WHEN TRIM(CPUDT) <> '' AND TRY_CAST(CASE WHEN CPUDT IS NULL OR TRIM(CPUDT) = '' THEN NULL WHEN LENGTH(TRIM(CPUDT)) = 8 THEN CONCAT(SUBSTRING(CPUDT, 1, 4), '-', SUBSTRING(CPUDT, 5, 2), '-', SUBSTRING(CPUDT, 7, 2)) ELSE CPUDT END AS DATE) IS NULL THEN 'CPUDT' END, CASE WHEN TRIM(KURSF) <> '' AND TRY_CAST(CASE WHEN KURSF IS NULL OR TRIM(KURSF) = '' THEN NULL WHEN TRIM(KURSF) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(KURSF)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(KURSF, ',', ''), ' ', '') END AS DECIMAL(9,5)) IS NULL THEN 'KURSF' END)",
+    "bseg": "CONCAT_WS(',', CASE WHEN TRIM(DMBTR) <> '' AND TRY_CAST(CASE WHEN DMBTR IS NULL OR TRIM(DMBTR) = '' THEN NULL WHEN TRIM(DMBTR) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(DMBTR)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(DMBTR, ',', ''), ' ', '') END AS DECIMAL(15,2)) IS NULL THEN 'DMBTR' END, CASE WHEN TRIM(WRBTR) <> '' AND TRY_CAST(CASE WHEN WRBTR IS NULL OR TRIM(WRBTR) = '' THEN NULL WHEN TRIM(WRBTR) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(WRBTR)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(WRBTR, ',', ''), ' ', '') END AS DECIMAL(15,2)) IS NULL THEN 'WRBTR' END, CASE WHEN TRIM(MWSTS) <> '' AND TRY_CAST(CASE WHEN MWSTS IS NULL OR TRIM(MWSTS) = '' THEN NULL WHEN TRIM(MWSTS) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(MWSTS)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(MWSTS, ',', ''), ' ', '') END AS DECIMAL(15,2)) IS NULL THEN 'MWSTS' END, CASE WHEN TRIM(ZFBDT) <> '' AND TRY_CAST(CASE WHEN ZFBDT IS NULL OR TRIM(ZFBDT) = '' THEN NULL WHEN LENGTH(TRIM(ZFBDT)) = 8 THEN CONCAT(SUBSTRING(ZFBDT, 1, 4), '-', SUBSTRING(ZFBDT, 5, 2), '-', SUBSTRING(ZFBDT, 7, 2)) ELSE ZFBDT END AS DATE) IS NULL THEN 'ZFBDT' END, CASE WHEN TRIM(ZBD1T) <> '' AND TRY_CAST(ZBD1T AS INT) IS NULL THEN 'ZBD1T' END, CASE WHEN TRIM(ZBD1P) <> '' AND TRY_CAST(CASE WHEN ZBD1P IS NULL OR TRIM(ZBD1P) = '' THEN NULL WHEN TRIM(ZBD1P) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(ZBD1P)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(ZBD1P, ',', ''), ' ', '') END AS DECIMAL(5,3)) IS NULL THEN 'ZBD1P' END, CASE WHEN TRIM(ZBD2T) <> '' AND TRY_CAST(ZBD2T AS INT) IS NULL THEN 'ZBD2T' END, CASE WHEN TRIM(ZBD3T) <> '' AND TRY_CAST(ZBD3T AS INT) IS NULL THEN 'ZBD3T' END, CASE WHEN TRIM(SKFBT) <> '' AND TRY_CAST(CASE WHEN SKFBT IS NULL OR TRIM(SKFBT) = '' THEN NULL WHEN TRIM(SKFBT) LIKE '%-' THEN CONCAT('-', REPLACE(REPLACE(TRIM(TRAILING '-' FROM TRIM(SKFBT)), ',', ''), ' ', '')) ELSE REPLACE(REPLACE(SKFBT, ',', ''), ' ', '') END AS DECIMAL(15,2)) IS NULL THEN 'SKFBT' END)",
+    "lfa1": "''",
+}
+# END GENERATED: landing SQL
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+import fnmatch
+import hashlib
+import os
+import time
+
+from notebookutils import mssparkutils
+from pyspark import StorageLevel
+from pyspark.sql import Window
+from pyspark.sql import functions as F
+
+# Splittable CSV: each file is read in split_size_mb byte ranges, one task per
+# range, so ingest time scales with the cores, not the size of a file.
+# Quoted fields follow RFC 4180 ("Müller, Hans", "" inside quotes). Fields
+# must not contain line breaks (multiLine would make a file unsplittable).
+spark.conf.set("spark.sql.files.maxPartitionBytes", f"{split_size_mb}m")
+
+CSV_OPTIONS = {
+    "header": "true",
+    "inferSchema": "false",  # all columns as text, no extra pass over the files
+    "quote": '"',
+    "escape": '"',
+    "multiLine": "false",
+    "encoding": "UTF-8",
+}
+
+# Extract file and key per table: a key in a later extract replaces it
+BKPF_KEYS = ["MANDT", "BUKRS", "BELNR", "GJAHR"]
+EXTRACTS = {
+    "lfa1": ("sap_lfa1_vendor_master.csv", ["MANDT", "LIFNR"]),
+    "bkpf": ("sap_bkpf_document_header.csv", BKPF_KEYS),
+    "bseg": ("sap_bseg_line_items.csv", BKPF_KEYS + ["BUZEI"]),
+}
+DELTA_DIR = "delta"
+
+
+def create_table(name, ddl):
+    """CREATE TABLE IF NOT EXISTS that tolerates a parallel ingest creating it first"""
+    try:
+        spark.sql(ddl)
+    except Exception:
+        # On the first run the three ingests race to commit the first version
+        if not spark.catalog.tableExists(name):
+            raise
+
+
+create_table("sap_ingest_rejects", """
+    CREATE TABLE IF NOT EXISTS sap_ingest_rejects (
+        source_table STRING,
+        record STRING,
+        rejected_fields STRING,
+        loaded_at TIMESTAMP
+    ) USING DELTA
+    PARTITIONED BY (source_table)
+""")
+
+# Fingerprint of the extract files per table at their last ingest. A table
+# whose files have the same names, sizes and modification times is skipped.
+# Partitioned by table and replaced per partition like sap_ingest_rejects, so
+# the parallel ingests never write the same files. Upgrade from the
+# unpartitioned table: DROP TABLE etl_source_state (each table is ingested
+# once more on the next run).
+create_table("etl_source_state", """
+    CREATE TABLE IF NOT EXISTS etl_source_state (
+        source_table STRING,
+        fingerprint STRING,
+        files INT,
+        file_bytes BIGINT,
+        ingested_at TIMESTAMP
+    ) USING DELTA
+    PARTITIONED BY (source_table)
+""")
+
+
+def extract_files(folder, file_name):
+    """Files of one extract in folder: the single file or its part files
+    (file_name_*.csv), whichever was written last, never both"""
+    stem, ext = os.path.splitext(file_name)
+    listing = [f for f in mssparkutils.fs.ls(folder) if f.isFile]
+    single = [f for f in listing if f.name == file_name]
+    parts = sorted((f for f in listing if fnmatch.fnmatch(f.name, f"{stem}_*{ext}")),
+                   key=lambda f: f.name)
+    if single and parts:
+        # A leftover of an earlier delivery: reading both would load every row twice
+        newer_parts = max(f.modifyTime for f in parts) > single[0].modifyTime
+        print(f"{folder}: {file_name} and {len(parts)} part file(s), reading the "
+              f"{'part files' if newer_parts else 'single file'} (written last)")
+        return parts if newer_parts else single
+    return single or parts
+
+
+def extract_generations(file_name):
+    """Files of the full extract and of each delta extract, oldest first"""
+    folders = [extract_folder]
+    if any(f.isDir and f.name.rstrip("/") == DELTA_DIR for f in mssparkutils.fs.ls(extract_folder)):
+        delta_folder = f"{extract_folder}/{DELTA_DIR}"
+        folders += sorted(f"{delta_folder}/{f.name.rstrip('/')}"
+                          for f in mssparkutils.fs.ls(delta_folder) if f.isDir)
+    generations = [extract_files(folder, file_name) for folder in folders]
+    return [files for files in generations if files]
+
+
+def fingerprint(generations):
+    """(hash, file count, bytes) of the files of all extract generations"""
+    files = [(f.path, f.size, f.modifyTime) for files in generations for f in files]
+    digest = hashlib.sha256("\n".join(f"{path}|{size}|{mtime}" for path, size, mtime in files).encode())
+    return digest.hexdigest(), len(files), sum(size for _, size, _ in files)
+
+
+def ingest(table, generations, keys):
+    start = time.time()
+    frames = [
+        spark.read.options(**CSV_OPTIONS).csv([f.path for f in files])
+        .withColumn("__generation", F.lit(index))
+        for index, files in enumerate(generations)
+    ]
+    read_tasks = sum(frame.rdd.getNumPartitions() for frame in frames)
+    extract = frames[0]
+    for frame in frames[1:]:
+        extract = extract.unionByName(frame, allowMissingColumns=True)
+    # The newest version of a key wins, the same upsert the Dataflow does
+    if len(frames) > 1:
+        newest_first = Window.partitionBy(*keys).orderBy(F.col("__generation").desc())
+        extract = (extract
+                   .withColumn("__version", F.row_number().over(newest_first))
+                   .where("__version = 1")
+                   .drop("__version"))
+    extract = extract.drop("__generation")
+    checked = (
+        extract
+        .withColumn("rejected_fields", F.expr(REJECTED_FIELDS[table]))
+        .withColumn("record", F.when(F.col("rejected_fields") != "", F.to_json(F.struct(*extract.columns))))
+        .persist(StorageLevel.MEMORY_AND_DISK)
+    )
+
+    # One bulk overwrite per table (replaces the table like the Dataflow)
+    (checked
+        .where("rejected_fields = ''")
+        .selectExpr(*LANDING_COLUMNS[table])
+        .write.format("delta")
+        .mode("overwrite")
+        .option("overwriteSchema", "true")
+        .saveAsTable(table))
+
+    # Replaces only this table's partition: the tables are ingested in parallel
+    (checked
+        .where("rejected_fields <> ''")
+        .select(F.lit(table.upper()).alias("source_table"), "record", "rejected_fields",
+                F.current_timestamp().alias("loaded_at"))
+        .write.format("delta")
+        .mode("overwrite")
+        .option("replaceWhere", f"source_table = '{table.upper()}'")
+        .saveAsTable("sap_ingest_rejects"))
+
+    counts = {row.valid: row["count"] for row in
+              checked.groupBy(F.expr("rejected_fields = ''").alias("valid")).count().collect()}
+    checked.unpersist()
+    print(f"{table}: {counts.get(True, 0):,} rows loaded, {counts.get(False, 0):,} rejected "
+          f"({len(frames)} extract(s), {read_tasks} read tasks, {time.time() - start:.1f}s)")
+
+
+for table in [t.strip() for t in tables.split(",") if t.strip()]:
+    file_name, keys = EXTRACTS[table]
+    generations = extract_generations(file_name)
+    if not generations:
+        raise FileNotFoundError(f"No {file_name} extract in {extract_folder}")
+    digest, files, file_bytes = fingerprint(generations)
+    state = spark.sql(f"SELECT fingerprint FROM etl_source_state WHERE source_table = '{table}'").first()
+    if state and state.fingerprint == digest and not force:
+        print(f"{table}: {files} file(s) unchanged since the last ingest, skipped")
+        continue
+    ingest(table, generations, keys)
+    # Recorded after the load: a failed (and retried) load ingests again
+    (spark.sql(f"""
+        SELECT '{table}' AS source_table, '{digest}' AS fingerprint, {files} AS files,
+               CAST({file_bytes} AS BIGINT) AS file_bytes, current_timestamp() AS ingested_at
+    """)
+        .write.format("delta")
+        .mode("overwrite")
+        .option("replaceWhere", f"source_table = '{table}'")
+        .saveAsTable("etl_source_state"))
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
+
+# CELL ********************
+
+# Exit value for the pipeline: "pending" when a table was ingested after the
+# last completed 0_DataCleaning run (etl_run_cache, written after its last
+# stage, model_refresh), so the fact build also reruns after a failed build
+# or model refresh even if nothing was ingested
+pending = spark.sql(f"""
+    SELECT COUNT(*) AS n
+    FROM etl_source_state
+    WHERE source_table IN ({", ".join(f"'{t.strip()}'" for t in tables.split(",") if t.strip())})
+      AND ingested_at > (
+          SELECT COALESCE(MAX(completed_at), TIMESTAMP'1900-01-01')
+          FROM etl_run_cache
+      )
+""").first().n if spark.catalog.tableExists("etl_run_cache") else 1
+
+mssparkutils.notebook.exit("pending" if pending else "current")
+
+# METADATA ********************
+
+# META {
+# META   "language": "python",
+# META   "language_group": "synapse_pyspark"
+# META }
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Content-hash cache for generated extracts and local pipeline runs
+
+An entry is keyed on a fingerprint of everything that determines its output:
+the configuration (generator options and seed, or load modes and SQL text),
+the content of the input files and the code that produces it. A run with the
+same fingerprint restores the entry instead of producing it again.
+
+- Entries are directories under CACHE_DIR (AP_CACHE_DIR overrides it)
+- Restored files are hard links where possible: writers must replace such a
+  file (remove, then write), never truncate or append to it
+- Entries not used for MAX_AGE_DAYS are evicted, then the least recently
+  used ones until the cache fits into MAX_BYTES
+
+Usage:
+    python3 artifact_cache.py              # list entries
+    python3 artifact_cache.py --evict      # apply the age and size limits
+    python3 artifact_cache.py --clear
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+CACHE_DIR = os.environ.get("AP_CACHE_DIR", os.path.join(REPO_ROOT, "sample-data", ".cache"))
+MAX_BYTES = 5 * 2**30
+MAX_AGE_DAYS = 14
+
+MANIFEST_FILE = "manifest.json"
+FILES_DIR = "files"
+HASH_CHUNK_SIZE = 2**20
+
+
+def hash_files(paths, digest=None):
+    """SHA-256 over the names and contents of the files (directories recursively)"""
+    digest = digest or hashlib.sha256()
+    for path in sorted(paths):
+        if os.path.isdir(path):
+            children = [os.path.join(path, name) for name in os.listdir(path)]
+            hash_files(children, digest)
+            continue
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return digest
+
+
+def fingerprint(config, files=()):
+    """Cache key of a JSON-serializable configuration and input files"""
+    digest = hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode())
+    return hash_files(files, digest).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:  # other file system, or no hard links
+        shutil.copy2(src, dst)
+
+
+def _copy_paths(src_dir, dst_dir, names, link=True):
+    copy = _link_or_copy if link else shutil.copy2
+    for name in names:
+        src, dst = os.path.join(src_dir, name), os.path.join(dst_dir, name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, copy_function=copy, dirs_exist_ok=True)
+        else:
+            copy(src, dst)
+
+
+def _tree_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+class ArtifactCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def manifest(self, key):
+        """Manifest of a complete entry, or None"""
+        try:
+            with open(os.path.join(self._entry(key), MANIFEST_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def restore(self, key, dest_dir, link=True):
+        """Link the entry's files into dest_dir; returns its manifest or None on a miss
+
+        link=False copies them, for files that are modified in place (databases).
+        """
+        manifest = self.manifest(key)
+        if manifest is None:
+            return None
+        _copy_paths(os.path.join(self._entry(key), FILES_DIR), dest_dir, manifest["files"], link)
+        os.utime(self._entry(key))  # last use, for eviction
+        return manifest
+
+    def store(self, key, src_dir, names, **metadata):
+        """Add the files/directories names of src_dir as entry key
+
+        Outputs larger than the whole cache are not stored. Returns True if stored.
+        """
+        paths = [os.path.join(src_dir, name) for name in names]
+        size = sum(_tree_bytes(p) if os.path.isdir(p) else os.path.getsize(p) for p in paths)
+        if size > self.max_bytes:
+            return False
+
+        # Written under a temporary name and renamed: a run that is interrupted
+        # (or runs concurrently) never sees a partial entry
+        staging = self._entry(f".{key}.{os.getpid()}.tmp")
+        shutil.rmtree(staging, ignore_errors=True)
+        _copy_paths(src_dir, os.path.join(staging, FILES_DIR), names)
+        manifest = {"files": list(names), "bytes": size, "created": time.time(), **metadata}
+        with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        try:
+            os.rename(staging, self._entry(key))
+        except OSError:  # stored meanwhile by another run
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+        return True
+
+    def entries(self):
+        """(key, last use, bytes) of the complete entries, most recently used first"""
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for key in os.listdir(self.root):
+            manifest = None if key.startswith(".") else self.manifest(key)
+            if manifest is not None:
+                found.append((key, os.path.getmtime(self._entry(key)), manifest["bytes"]))
+        return sorted(found, key=lambda entry: entry[1], reverse=True)
+
+    def evict(self):
+        """Remove entries unused for max_age_days, then the least recently used
+        ones beyond max_bytes. Returns the removed keys."""
+        cutoff = time.time() - self.max_age_days * 86400
+        removed, total = [], 0
+        for key, last_used, size in self.entries():
+            if last_used < cutoff or total + size > self.max_bytes:
+                shutil.rmtree(self._entry(key), ignore_errors=True)
+                removed.append(key)
+            else:
+                total += size
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or trim the artifact cache")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help=f"Cache directory (default: {CACHE_DIR})")
+    parser.add_argument("--evict", action="store_true", help="Apply the age and size limits")
+    parser.add_argument("--clear", action="store_true", help="Remove all entries")
+    args = parser.parse_args(argv)
+
+    cache = ArtifactCache(args.cache_dir)
+    if args.clear:
+        cache.clear()
+    elif args.evict:
+        print(f"Evicted {len(cache.evict())} entries")
+
+    entries = cache.entries()
+    for key, last_used, size in entries:
+        kind = cache.manifest(key).get("kind", "")
+        print(f"  {key[:16]}  {kind:<10} {size / 2**20:>10.1f} MiB  "
+              f"last used {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))}")
+    print(f"  {len(entries)} entries, {sum(e[2] for e in entries) / 2**20:.1f} MiB in {args.cache_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
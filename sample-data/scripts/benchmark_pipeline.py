@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Benchmark the AP pipeline at fixed scale factors and compare with a baseline
+
+Runs the notebook SQL on DuckDB (see run_local_pipeline.py) as a full load,
+then a set of queries equivalent to representative report measures. Stores
+the median wall time and the peak memory of every stage and query as JSON
+and flags each one that got slower (or bigger) than the saved baseline by
+more than the threshold.
+
+Usage:
+    python3 benchmark_pipeline.py --save-baseline       # on the main branch
+    python3 benchmark_pipeline.py                       # after a SQL change
+    python3 benchmark_pipeline.py --sf 0.1 --repeat 5 --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import duckdb
+
+import run_local_pipeline as runner
+
+BENCHMARK_SCALE_FACTORS = [0.1, 1]
+BENCHMARK_REPEAT = 3
+BASELINE_PATH = os.path.join(runner.REPO_ROOT, "sample-data", "benchmarks", "baseline.json")
+REGRESSION_THRESHOLD = 0.25     # 25% slower than the baseline
+MIN_REGRESSION_SECONDS = 0.05   # ignore changes below timer noise
+MIN_REGRESSION_BYTES = 16 * 2**20
+
+# Report measures (dax/ap_measures.dax) as the queries they boil down to
+MEASURE_QUERIES = {
+    # Aging 0-30 / 31-60 / 61-90 / 90+ Days on the latest snapshot
+    "aging_buckets": """
+        SELECT aging_bucket_order, aging_bucket,
+               SUM(open_amount) AS open_amount, SUM(invoice_count) AS invoice_count
+        FROM ap_aging_snapshot
+        WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM ap_aging_snapshot)
+        GROUP BY aging_bucket_order, aging_bucket
+        ORDER BY aging_bucket_order
+    """,
+    # Vendor table of the report
+    "vendor_summary": """
+        SELECT vendor_number, vendor_name, vendor_city, document_count,
+               total_invoices, total_payments, net_open_amount
+        FROM ap_vendor_summary
+        ORDER BY net_open_amount DESC
+    """,
+    # On-Time Payment Rate per fiscal year
+    "on_time_payment_rate": """
+        SELECT fiscal_year,
+               COUNT(DISTINCT CASE WHEN posting_date <= net_due_date THEN document_number END)
+                   / COUNT(DISTINCT document_number) AS on_time_payment_rate
+        FROM accounts_payable_fact
+        WHERE document_type = 'KZ'
+        GROUP BY fiscal_year
+    """,
+    # Average Payment Days per month
+    "average_payment_days": """
+        SELECT posting_month,
+               SUM(total_payment_days) / SUM(payment_line_count) AS average_payment_days
+        FROM ap_payment_stats_monthly
+        GROUP BY posting_month
+        ORDER BY posting_month
+    """,
+}
+
+
+# ============================================================================
+# MEASUREMENT
+# ============================================================================
+
+def run_queries(con):
+    """Run each measure query once; returns {name: metrics}"""
+    metrics = {}
+    for name, query in MEASURE_QUERIES.items():
+        start = time.perf_counter()
+        with runner.PeakMemory() as memory:
+            rows = runner.execute(con, query, {}, set())
+        metrics[name] = {
+            "wall_time_s": round(time.perf_counter() - start, 4),
+            "rows": rows,
+            "peak_memory_bytes": memory.peak_bytes,
+        }
+    return metrics
+
+
+def summarize(samples):
+    """Median wall time and maximum peak memory over the repetitions"""
+    summary = {}
+    for name in samples[0]:
+        runs = [sample[name] for sample in samples]
+        summary[name] = {
+            "wall_time_s": round(statistics.median(run["wall_time_s"] for run in runs), 4),
+            "peak_memory_bytes": max(run["peak_memory_bytes"] for run in runs),
+            "rows": runs[-1]["rows"],
+        }
+    return summary
+
+
+def benchmark_scale_factor(args, stages, scale_factor):
+    """Full loads and measure queries, repeated on the same database"""
+    label, data_dir, db_path, _ = runner.prepare_run_dir(
+        args.work_dir, scale_factor, args.format, args.reuse_data
+    )
+
+    stage_samples, query_samples = [], []
+    con = duckdb.connect(db_path)
+    try:
+        landing_counts = runner.load_landing_tables(con, data_dir, args.format)
+        for _ in range(args.repeat):
+            metrics = runner.run_stages(con, stages, {"ap.load_mode": "full"})
+            stage_samples.append({m["stage"]: m for m in metrics})
+            query_samples.append(run_queries(con))
+    finally:
+        con.close()
+
+    return label, {
+        "landing_rows": landing_counts,
+        "stages": summarize(stage_samples),
+        "queries": summarize(query_samples),
+    }
+
+
+# ============================================================================
+# BASELINE COMPARISON
+# ============================================================================
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD, min_seconds=MIN_REGRESSION_SECONDS):
+    """Rows of (scale factor, kind, name, metric, baseline, current, change, regression)
+
+    A stage or query regresses when its time or peak memory grows by more
+    than threshold (a fraction) and by more than the noise floor.
+    """
+    rows = []
+    for label, result in current["scale_factors"].items():
+        base_result = baseline.get("scale_factors", {}).get(label)
+        if base_result is None:
+            continue
+        for kind in ["stages", "queries"]:
+            for name, metrics in result[kind].items():
+                base = base_result[kind].get(name)
+                if base is None:
+                    continue
+                for metric, floor in [("wall_time_s", min_seconds),
+                                      ("peak_memory_bytes", MIN_REGRESSION_BYTES)]:
+                    old, new = base[metric], metrics[metric]
+                    change = (new - old) / old if old else 0.0
+                    regression = change > threshold and new - old > floor
+                    rows.append((label, kind, name, metric, old, new, change, regression))
+    return rows
+
+
+def print_comparison(rows, threshold):
+    print(f"\nComparison with baseline (threshold +{threshold:.0%})")
+    print(f"  {'SF':<8} {'Stage / query':<40} {'Metric':<8} {'Baseline':>12} {'Current':>12} {'Change':>8}")
+    for label, _, name, metric, old, new, change, regression in rows:
+        if metric == "wall_time_s":
+            unit, old_text, new_text = "time", f"{old:.3f}s", f"{new:.3f}s"
+        else:
+            unit, old_text, new_text = "memory", f"{old / 2**20:.0f}MiB", f"{new / 2**20:.0f}MiB"
+        flag = "  REGRESSION" if regression else ""
+        print(f"  {label:<8} {name[:40]:<40} {unit:<8} {old_text:>12} {new_text:>12} {change:>+8.1%}{flag}")
+
+
+# ============================================================================
+# MAIN
+# ============================================================================
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the AP pipeline on DuckDB and compare with a saved baseline"
+    )
+    parser.add_argument("--source", choices=["notebook", "sql"], default="notebook",
+                        help="Benchmark the notebook's %%%%sql cells or sql/create_ap_fact_table.sql "
+                             "(default: notebook)")
+    parser.add_argument("--scale-factor", "--sf", type=float, nargs="+", default=BENCHMARK_SCALE_FACTORS,
+                        help=f"Scale factors (default: {' '.join(map(str, BENCHMARK_SCALE_FACTORS))})")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="Sample data format (default: csv)")
+    parser.add_argument("--repeat", type=int, default=BENCHMARK_REPEAT,
+                        help=f"Full loads per scale factor, timings are medians (default: {BENCHMARK_REPEAT})")
+    parser.add_argument("--work-dir", default=runner.WORK_DIR,
+                        help=f"Data and database per scale factor (default: {runner.WORK_DIR})")
+    parser.add_argument("--reuse-data", action="store_true",
+                        help="Use the data already in the work directory instead of generating it")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help=f"Baseline results (default: {BASELINE_PATH})")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store this run as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help=f"Allowed slowdown as a fraction (default: {REGRESSION_THRESHOLD})")
+    parser.add_argument("--min-seconds", type=float, default=MIN_REGRESSION_SECONDS,
+                        help=f"Ignore slowdowns below this many seconds (default: {MIN_REGRESSION_SECONDS})")
+    parser.add_argument("--output", default=None,
+                        help="Also write the results as JSON to this file")
+
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    cells = runner.notebook_sql_cells() if args.source == "notebook" else runner.script_sql_cells()
+    stages = runner.split_stages(cells)
+
+    print("="*70)
+    print("AP Pipeline Benchmark")
+    print("="*70)
+    print(f"  Source: {args.source} ({len(stages)} stages, {len(MEASURE_QUERIES)} queries)")
+    print(f"  Scale factors: {', '.join(f'SF{sf:g}' for sf in args.scale_factor)}")
+    print(f"  Repetitions: {args.repeat}")
+
+    results = {
+        "source": args.source,
+        "format": args.format,
+        "repeat": args.repeat,
+        "environment": {
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "scale_factors": {},
+    }
+    for sf in args.scale_factor:
+        label, result = benchmark_scale_factor(args, stages, sf)
+        results["scale_factors"][label] = result
+        print(f"\n{label} ({result['landing_rows']['bseg']:,} BSEG lines)")
+        print(f"  {'Stage / query':<40} {'Time (s)':>10} {'Peak MiB':>10}")
+        for kind in ["stages", "queries"]:
+            for name, m in result[kind].items():
+                print(f"  {name[:40]:<40} {m['wall_time_s']:>10.3f} {m['peak_memory_bytes'] / 2**20:>10.1f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline} - run with --save-baseline first")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("environment") != results["environment"]:
+        print("\nNote: the baseline was recorded in a different environment")
+
+    rows = compare(baseline, results, args.threshold, args.min_seconds)
+    print_comparison(rows, args.threshold)
+    regressions = [row for row in rows if row[-1]]
+    print("\n" + "="*70)
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) above +{args.threshold:.0%}")
+    else:
+        print("✅ No regressions")
+    print("="*70)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
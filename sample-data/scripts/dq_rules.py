@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Declarative data quality rules and their generated single-pass evaluation
+
+The rules live in sql/dq_rules.json, one object per rule:
+
+- rule_id: snake_case name, unique (also the column prefix in the SQL)
+- type: completeness (column is set), validity (column in values, or not in
+  invalid_values), range (column between min and max, either optional) or
+  referential (the staging join found the column in reference; the join sets
+  unmatched_flag, so the rule does not join again)
+- column: fact column the rule checks
+- where: optional Spark SQL predicate, the rows the rule applies to; its
+  column names are renamed for the notebook fact like column
+- severity (high/medium/low), min_pass_rate (0-1) and description: reported
+  with the results in dq_rules
+
+min/max numbers are literals, strings are SQL expressions (another column,
+or a literal such as DATE '2020-01-01'). Rules other than completeness skip
+rows where the column is NULL; completeness reports those.
+
+Every rule becomes two aggregates (rows checked, rows failed) of the one
+aggregation over the changed days of accounts_payable_fact in the summary
+stage, which UNPIVOTs them into dq_results (rule x fiscal year x company code
+x posting date). Adding a rule adds two SUMs to that query, not a scan.
+
+Usage:
+    python3 dq_rules.py --check    # exit 1 if a generated file is out of date
+    python3 dq_rules.py --write    # regenerate after changing sql/dq_rules.json
+"""
+
+import json
+import os
+import re
+import sys
+
+import sap_fields
+
+RULES_PATH = os.path.join(sap_fields.REPO_ROOT, "sql", "dq_rules.json")
+
+RULE_TYPES = {
+    "completeness": [],
+    "validity": [],
+    "range": [],
+    "referential": ["reference", "unmatched_flag"],
+}
+SEVERITIES = ("high", "medium", "low")
+IDENTIFIER = re.compile(r"^[a-z][a-z0-9_]*$")
+# A string literal, or a word outside of one (column names in an expression)
+EXPRESSION_TOKEN = re.compile(r"'[^']*'|\b[a-z][a-z0-9_]*\b")
+
+
+# ============================================================================
+# RULES
+# ============================================================================
+
+def _check_rule(rule, seen):
+    rule_id = rule.get("rule_id", "")
+    if not IDENTIFIER.match(rule_id):
+        raise ValueError(f"Invalid rule_id {rule_id!r}: use lower-case snake_case")
+    if rule_id in seen:
+        raise ValueError(f"Duplicate rule_id {rule_id!r}")
+    if rule.get("type") not in RULE_TYPES:
+        raise ValueError(f"{rule_id}: type must be one of {', '.join(RULE_TYPES)}")
+    missing = [key for key in ["column", "severity", "min_pass_rate", "description"]
+               + RULE_TYPES[rule["type"]] if key not in rule]
+    if missing:
+        raise ValueError(f"{rule_id}: missing {', '.join(missing)}")
+    if rule["type"] == "validity" and ("values" in rule) == ("invalid_values" in rule):
+        raise ValueError(f"{rule_id}: a validity rule needs either values or invalid_values")
+    if rule["type"] == "range" and "min" not in rule and "max" not in rule:
+        raise ValueError(f"{rule_id}: a range rule needs min and/or max")
+    if rule["severity"] not in SEVERITIES:
+        raise ValueError(f"{rule_id}: severity must be one of {', '.join(SEVERITIES)}")
+    if not 0 <= rule["min_pass_rate"] <= 1:
+        raise ValueError(f"{rule_id}: min_pass_rate must be between 0 and 1")
+    # Spark SQL does not read '' as an escaped quote
+    texts = [rule["description"]] + [v for v in rule.get("values", rule.get("invalid_values", []))
+                                     if isinstance(v, str)]
+    if any("'" in text for text in texts):
+        raise ValueError(f"{rule_id}: descriptions and values cannot contain a single quote")
+
+
+def load_rules(path=RULES_PATH):
+    """The rules of the JSON file, validated (ValueError on an invalid rule)"""
+    with open(path, encoding="utf-8") as f:
+        rules = json.load(f)["rules"]
+    seen = set()
+    for rule in rules:
+        _check_rule(rule, seen)
+        seen.add(rule["rule_id"])
+    return rules
+
+
+def _column(name, variant):
+    """Name of a fact column in the variant, None if it has no such column"""
+    if variant == "notebook":
+        if name in sap_fields.NOTEBOOK_EXCLUDED:
+            return None
+        return sap_fields.NOTEBOOK_RENAMED.get(name, name)
+    return name
+
+
+def _expression(sql, variant):
+    """SQL expression with the fact columns named as in the variant, None if
+    it uses a column the variant does not have"""
+    def rename(match):
+        word = match.group(0)
+        if word.startswith("'"):
+            return word
+        column = _column(word, variant)
+        if column is None:
+            missing.append(word)
+        return column or word
+
+    missing = []
+    renamed = EXPRESSION_TOKEN.sub(rename, sql)
+    return None if missing else renamed
+
+
+def _bound(value, variant):
+    return _expression(value, variant) if isinstance(value, str) else repr(value)
+
+
+def _literal(value):
+    return f"'{value}'" if isinstance(value, str) else repr(value)
+
+
+def _grouped(predicate):
+    return f"({predicate})" if re.search(r"\bOR\b", predicate, re.IGNORECASE) else predicate
+
+
+def variant_rules(variant="sql"):
+    """(rule, column, failure predicate, scope predicate or None) of the rules
+    the variant's fact table has the columns for"""
+    out = []
+    for rule in load_rules():
+        column = _column(rule["column"], variant)
+        bounds = [_bound(rule[key], variant) for key in ("min", "max") if key in rule]
+        where = _expression(rule["where"], variant) if rule.get("where") else ""
+        if column is None or None in bounds or where is None:
+            continue
+
+        kind = rule["type"]
+        if kind == "completeness":
+            failed = f"{column} IS NULL"
+        elif kind == "validity" and "values" in rule:
+            failed = f"{column} NOT IN ({', '.join(_literal(v) for v in rule['values'])})"
+        elif kind == "validity" and len(rule["invalid_values"]) == 1:
+            failed = f"{column} = {_literal(rule['invalid_values'][0])}"
+        elif kind == "validity":
+            failed = f"{column} IN ({', '.join(_literal(v) for v in rule['invalid_values'])})"
+        elif kind == "range":
+            checks = []
+            if "min" in rule:
+                checks.append(f"{column} < {_bound(rule['min'], variant)}")
+            if "max" in rule:
+                checks.append(f"{column} > {_bound(rule['max'], variant)}")
+            failed = " OR ".join(checks)
+        else:
+            failed = f"{rule['unmatched_flag']} = 1"
+
+        scope = [] if kind == "completeness" else [f"{column} IS NOT NULL"]
+        if where:
+            scope.insert(0, _grouped(where))
+        out.append((rule, column, failed, " AND ".join(scope) or None))
+    return out
+
+
+# ============================================================================
+# CODE GENERATION
+# ============================================================================
+
+def _with_commas(lines):
+    return [line + "," for line in lines[:-1]] + lines[-1:]
+
+
+def rule_values_lines(variant="sql"):
+    """VALUES rows of dq_rules"""
+    return _with_commas([
+        f"('{rule['rule_id']}', '{rule['type']}', '{column}', '{rule['severity']}', "
+        f"{rule['min_pass_rate']}, '{rule['description']}')"
+        for rule, column, _, _ in variant_rules(variant)
+    ])
+
+
+def rule_count_lines(variant="sql"):
+    """Rows checked and failed of every rule, as aggregates"""
+    lines = []
+    for rule, _, failed, scope in variant_rules(variant):
+        rule_id = rule["rule_id"]
+        if scope:
+            lines.append(f"SUM(CASE WHEN {scope} THEN 1 ELSE 0 END) AS {rule_id}_checked")
+            failed = f"{scope} AND {_grouped(failed)}"
+        else:
+            lines.append(f"COUNT(*) AS {rule_id}_checked")
+        lines.append(f"SUM(CASE WHEN {failed} THEN 1 ELSE 0 END) AS {rule_id}_failed")
+    return _with_commas(lines)
+
+
+def rule_unpivot_lines(variant="sql"):
+    """UNPIVOT list: the (checked, failed) column pair of every rule"""
+    return _with_commas([
+        f"({rule['rule_id']}_checked, {rule['rule_id']}_failed) AS {rule['rule_id']}"
+        for rule, _, _, _ in variant_rules(variant)
+    ])
+
+
+# (file, marker name, generated lines, line prefix)
+TARGETS = [
+    (path, name, (lambda lines=lines, variant=variant: lines(variant)), prefix)
+    for path, variant, prefix in [
+        (sap_fields.SQL_SCRIPT_PATH, "sql", ""),
+        (sap_fields.NOTEBOOK_PATH, "notebook", "# MAGIC "),
+    ]
+    for name, lines in [
+        ("dq rules", rule_values_lines),
+        ("dq rule counts", rule_count_lines),
+        ("dq rule columns", rule_unpivot_lines),
+    ]
+]
+
+
+def main(argv=None):
+    return sap_fields.main(argv, TARGETS, "dq_rules.py",
+                           "Generate the data quality rule SQL from sql/dq_rules.json")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,16 +7,31 @@ Reference: sample-data/SAP_TABLE_REFERENCE.md
 - Two years (2023-2024) for YoY analysis
 - Realistic SAP field structures
 - Varied payment terms, amounts, and patterns
+
+Usage:
+    python3 generate_sample_data.py                      # demo dataset (CSV in ../)
+    python3 generate_sample_data.py --scale-factor 10 --format parquet \\
+        --output-dir /data/ap_sf10 --workers 8
 """
 
+import argparse
+import glob
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
 
+import artifact_cache
+import sap_fields
+
 # Set seed for reproducibility
-np.random.seed(42)
-random.seed(42)
+SEED = 42
+np.random.seed(SEED)
+random.seed(SEED)
 
 # ============================================================================
 # CONFIGURATION
@@ -26,6 +41,39 @@ NUM_VENDORS = 100
 NUM_DOCUMENTS_PER_YEAR = 500
 START_DATE = datetime(2023, 1, 1)
 END_DATE = datetime(2024, 12, 31)
+YEARS = tuple(range(START_DATE.year, END_DATE.year + 1))
+
+# "vectorized" draws whole columns with NumPy (fast, for large volumes),
+# "legacy" walks documents row by row with the random module
+GENERATION_MODE = "vectorized"
+
+# Documents per batch in streaming mode (vectorized only). None builds all
+# tables in memory; a number writes BKPF/BSEG batch by batch so peak memory
+# is bounded by the batch size instead of the total row count.
+STREAMING_BATCH_SIZE = None
+
+# Parallel sharded mode (vectorized only). None runs on one core; a number
+# splits the document range into SHARD_SIZE shards, generated by a pool of
+# NUM_WORKERS processes into part files. Each shard is seeded from its index,
+# so the output is identical for any number of workers.
+NUM_WORKERS = None
+SHARD_SIZE = 100000
+
+OUTPUT_DIR = "../"
+LFA1_FILE = "sap_lfa1_vendor_master.csv"
+BKPF_FILE = "sap_bkpf_document_header.csv"
+BSEG_FILE = "sap_bseg_line_items.csv"
+
+# Output format: "csv" (all-text SAP extract) or "parquet" (typed columns of
+# the schema registry in sap_fields.py, BKPF/BSEG partitioned by GJAHR/BUKRS;
+# requires pyarrow)
+OUTPUT_FORMAT = "csv"
+PARQUET_COMPRESSION = "snappy"
+PARQUET_ROW_GROUP_SIZE = 1_000_000
+
+# Full extracts are cached by a fingerprint of the options, the seed and this
+# code (artifact_cache.py); a run with the same fingerprint restores them
+CACHE_CODE_FILES = [__file__, sap_fields.__file__]
 
 # ============================================================================
 # VENDOR MASTER DATA (LFA1)
@@ -184,12 +232,12 @@ TCODE_MAP = {
     "KG": ["FB65"],          # Credit memo
 }
 
-def generate_documents(num_docs_per_year=500):
+def generate_documents(num_docs_per_year=500, years=YEARS, company_codes=COMPANY_CODES):
     """Generate BKPF document headers with realistic SAP fields"""
     documents = []
     doc_counter = 5100000001  # SAP style document numbering
 
-    for year in [2023, 2024]:
+    for year in years:
         for i in range(num_docs_per_year):
             # Seasonal pattern: more in Q4
             month_weights = [8, 8, 9, 9, 7, 6, 6, 7, 9, 10, 11, 12]
@@ -222,7 +270,7 @@ def generate_documents(num_docs_per_year=500):
             documents.append({
                 # Key fields
                 "MANDT": "100",
-                "BUKRS": random.choice(COMPANY_CODES),
+                "BUKRS": random.choice(company_codes),
                 "BELNR": doc_number,
                 "GJAHR": str(year),
 
@@ -523,39 +571,742 @@ def generate_line_items(documents_df, vendors_df):
     return pd.DataFrame(line_items)
 
 # ============================================================================
-# MAIN GENERATION
+# VECTORIZED GENERATION (BKPF + BSEG)
 # ============================================================================
+# Same fields and balancing rules as the row-by-row generators above, but
+# every random value is drawn as a whole NumPy array from a seeded Generator.
+# Amounts are drawn in integer cents so debit and credit totals match exactly.
+
+MONTH_WEIGHTS = [8, 8, 9, 9, 7, 6, 6, 7, 9, 10, 11, 12]
+
+# Amount ranges (EUR) per GL account on invoice expense lines
+GL_AMOUNT_RANGES = {
+    "400000": (500, 50000), "410000": (500, 50000),        # Materials
+    "420000": (200, 20000), "430000": (200, 20000),        # Services
+    "440000": (200, 20000),
+    "480000": (1000, 100000), "490000": (1000, 100000),    # Rent/Insurance
+}
+DEFAULT_AMOUNT_RANGE = (100, 10000)
 
-if __name__ == "__main__":
-    print("="*70)
-    print("SAP Accounts Payable Sample Data Generator")
-    print("Following authentic SAP table structures (BKPF, BSEG, LFA1)")
-    print("="*70)
-    print(f"\nConfiguration:")
-    print(f"  - Vendors: {NUM_VENDORS}")
-    print(f"  - Documents per year: {NUM_DOCUMENTS_PER_YEAR}")
-    print(f"  - Years: 2023-2024")
-    print()
+# Accounts with 19% German VAT (Services, IT, Marketing)
+TAXED_GL_ACCOUNTS = ["420000", "440000", "450000"]
 
-    # Generate data
-    print("Step 1/3: Generating vendor master data (LFA1)...")
-    vendors_df = generate_vendors(NUM_VENDORS)
+BSEG_COLUMNS = [
+    "MANDT", "BUKRS", "BELNR", "GJAHR", "BUZEI",
+    "KOART", "SHKZG", "DMBTR", "WRBTR", "PSWSL", "MWSTS",
+    "HKONT", "KOSTL",
+    "LIFNR", "ZFBDT", "ZBD1T", "ZBD1P", "ZBD2T", "ZBD3T", "ZTERM", "SKFBT",
+    "SGTXT", "ZUONR",
+]
+
+
+def _zfill(values, width):
+    """Left-pad a string array with zeros (np.char.zfill fails on empty arrays)"""
+    if values.size == 0:
+        return values.astype(f"U{width}")
+    return np.char.zfill(values, width)
+
+
+def _format_dates(dates):
+    """Format a datetime64[D] array as SAP DATS strings (YYYYMMDD)"""
+    return np.char.replace(np.datetime_as_string(dates, unit="D"), "-", "")
+
+
+def _format_cents(cents):
+    """Format an integer cent array as SAP amount strings (e.g. 1234.50)"""
+    cents = np.asarray(cents, dtype=np.int64)
+    euros = (cents // 100).astype(str)
+    return np.char.add(np.char.add(euros, "."), _zfill((cents % 100).astype(str), 2))
+
+
+def _draw_cents(rng, low, high):
+    """Draw uniform amounts in cents between per-row EUR bounds (inclusive)"""
+    return rng.integers(np.round(low * 100).astype(np.int64), np.round(high * 100).astype(np.int64), endpoint=True)
+
+
+def generate_document_batch(year, num_docs, first_doc_number, rng, company_codes=COMPANY_CODES,
+                            entry_dates=None):
+    """Generate one batch of BKPF headers for a fiscal year with NumPy
+
+    Document numbers run consecutively from first_doc_number. With
+    entry_dates (datetime64[D] array), one document is entered on each of
+    those days instead and the fiscal year follows the posting date.
+    """
+    n = num_docs if entry_dates is None else len(entry_dates)
+    doc_types = np.array([dt[0] for dt in DOCUMENT_TYPES])
+    type_weights = np.array([dt[1] for dt in DOCUMENT_TYPES])
+    month_weights = np.array(MONTH_WEIGHTS) / sum(MONTH_WEIGHTS)
+    type_desc = {"RE": "Invoice", "KZ": "Payment", "KG": "Credit Memo"}
+
+    if entry_dates is None:
+        # Seasonal pattern: more in Q4
+        month = rng.choice(12, size=n, p=month_weights)
+        day = rng.integers(0, 28, size=n)
+        doc_date = (np.datetime64(f"{year}-01", "M") + month).astype("datetime64[D]") + day
+        entry_date = doc_date + rng.integers(0, 2, size=n, endpoint=True)
+        posting_date = entry_date + rng.integers(0, 1, size=n, endpoint=True)
+        fiscal_year = str(year)
+    else:
+        entry_date = np.asarray(entry_dates, dtype="datetime64[D]")
+        doc_date = entry_date - rng.integers(0, 2, size=n, endpoint=True)
+        posting_date = entry_date + rng.integers(0, 1, size=n, endpoint=True)
+        fiscal_year = posting_date.astype("datetime64[Y]").astype(str)
+
+    doc_type = doc_types[rng.choice(len(doc_types), size=n, p=type_weights / type_weights.sum())]
+    doc_number = _zfill(np.arange(first_doc_number, first_doc_number + n).astype(str), 10)
+
+    # Transaction code: pick uniformly among the codes of each type
+    tcode = np.empty(n, dtype=object)
+    header_text = np.empty(n, dtype=object)
+    tcode_pick = rng.random(n)
+    for code, options in TCODE_MAP.items():
+        mask = doc_type == code
+        tcode[mask] = np.array(options)[(tcode_pick[mask] * len(options)).astype(int)]
+        header_text[mask] = np.char.add(f"{type_desc[code]} ", doc_number[mask])
+    header_text = np.array([text[:25] for text in header_text], dtype=object)
+
+    xblnr = np.char.add("EXT", rng.integers(100000, 999999, size=n, endpoint=True).astype(str))
+    users = _zfill(rng.integers(1, 20, size=n, endpoint=True).astype(str), 2)
+
+    return pd.DataFrame({
+        "MANDT": "100",
+        "BUKRS": np.array(company_codes)[rng.integers(0, len(company_codes), size=n)],
+        "BELNR": doc_number,
+        "GJAHR": fiscal_year,
+        "BLART": doc_type,
+        "BLDAT": _format_dates(doc_date),
+        "BUDAT": _format_dates(posting_date),
+        "CPUDT": _format_dates(entry_date),
+        "WAERS": "EUR",
+        "KURSF": "1.00000",
+        "USNAM": np.char.add("USER", users),
+        "TCODE": tcode,
+        "BKTXT": header_text,
+        "XBLNR": np.where(doc_type == "RE", xblnr, ""),
+        "BSTAT": "",
+        "STBLG": "",
+        "STJAH": "",
+    })
+
+
+def generate_documents_vectorized(num_docs_per_year=500, rng=None, years=YEARS,
+                                  first_doc_number=5100000001, company_codes=COMPANY_CODES):
+    """Generate BKPF document headers with NumPy, one array per field"""
+    rng = rng if rng is not None else np.random.default_rng(SEED)
+
+    blocks = []
+    doc_counter = first_doc_number
+    for year in years:
+        blocks.append(generate_document_batch(year, num_docs_per_year, doc_counter, rng, company_codes))
+        doc_counter += num_docs_per_year
+
+    return pd.concat(blocks, ignore_index=True)
+
+
+def generate_line_items_vectorized(documents_df, vendors_df, rng=None, payments=None):
+    """Generate BSEG line items with NumPy, one array per field
+
+    RE: 1-5 GL debit lines + 1 vendor credit line carrying the GL total
+    KZ: bank credit line + vendor debit line
+    KG: vendor debit line + GL credit line
+
+    payments (optional DataFrame with BELNR, LIFNR, DMBTR) makes the listed
+    KZ documents pay that vendor and amount instead of random ones.
+    """
+    rng = rng if rng is not None else np.random.default_rng(SEED)
+
+    doc_type = documents_df["BLART"].to_numpy()
+    doc_bldat = documents_df["BLDAT"].to_numpy()
+    keys = {col: documents_df[col].to_numpy() for col in ["MANDT", "BUKRS", "BELNR", "GJAHR"]}
+
+    vendor_ids = vendors_df["LIFNR"].to_numpy()
+    vendor_names = vendors_df["NAME1"].to_numpy()
+
+    gl_codes = np.array(list(GL_ACCOUNTS.keys()))
+    gl_weights = np.array(list(GL_ACCOUNTS.values()))
+    gl_low = np.array([GL_AMOUNT_RANGES.get(gl, DEFAULT_AMOUNT_RANGE)[0] for gl in gl_codes])
+    gl_high = np.array([GL_AMOUNT_RANGES.get(gl, DEFAULT_AMOUNT_RANGE)[1] for gl in gl_codes])
+    gl_taxed = np.isin(gl_codes, TAXED_GL_ACCOUNTS)
+    cost_centers = np.array(COST_CENTERS)
+
+    re_docs = np.flatnonzero(doc_type == "RE")
+    kz_docs = np.flatnonzero(doc_type == "KZ")
+    kg_docs = np.flatnonzero(doc_type == "KG")
+
+    # Each block is a dict of equal-length arrays; "doc" and "line" fix the order
+    blocks = []
+
+    def add_block(doc, line, **fields):
+        fields["doc"] = doc
+        fields["line"] = line
+        blocks.append(fields)
+
+    # ---- Invoices (RE) -----------------------------------------------------
+    num_gl_lines = rng.integers(1, 5, size=len(re_docs), endpoint=True)
+    gl_doc = np.repeat(re_docs, num_gl_lines)
+    gl_starts = np.cumsum(num_gl_lines) - num_gl_lines
+    gl_line = np.arange(len(gl_doc)) - np.repeat(gl_starts, num_gl_lines) + 1
+
+    gl_pick = rng.choice(len(gl_codes), size=len(gl_doc), p=gl_weights / gl_weights.sum())
+    gl_cents = _draw_cents(rng, gl_low[gl_pick], gl_high[gl_pick])
+    tax_cents = np.where(gl_taxed[gl_pick], np.round(gl_cents * 0.19), 0).astype(np.int64)
+
+    add_block(
+        gl_doc, gl_line,
+        KOART="S", SHKZG="S",
+        DMBTR=_format_cents(gl_cents), MWSTS=_format_cents(tax_cents),
+        HKONT=gl_codes[gl_pick],
+        KOSTL=cost_centers[rng.integers(0, len(cost_centers), size=len(gl_doc))],
+        SGTXT=np.char.add("Expense ", gl_codes[gl_pick]),
+    )
+
+    # Vendor line (Credit, balances the document)
+    gl_total = np.zeros(len(documents_df), dtype=np.int64)
+    np.add.at(gl_total, gl_doc, gl_cents)
+    re_total = gl_total[re_docs]
+
+    re_vendor = rng.integers(0, len(vendor_ids), size=len(re_docs))
+    terms = PAYMENT_TERMS_OPTIONS
+    term_pick = rng.integers(0, len(terms), size=len(re_docs))
+    zterm = np.array([t[0] for t in terms])[term_pick]
+    net_days = np.array([t[1] for t in terms])[term_pick]
+    disc_pct = np.array([t[2] for t in terms])[term_pick]
+    disc_days = np.array([t[3] for t in terms])[term_pick]
+    has_discount = disc_pct > 0
+
+    add_block(
+        re_docs, num_gl_lines + 1,
+        KOART="K", SHKZG="H",
+        DMBTR=_format_cents(re_total), MWSTS="0.00",
+        HKONT="160000", KOSTL="",
+        LIFNR=vendor_ids[re_vendor],
+        ZFBDT=doc_bldat[re_docs],
+        ZBD1T=np.where(disc_days > 0, disc_days.astype(str), ""),
+        ZBD1P=np.where(has_discount, np.char.mod("%.3f", disc_pct), ""),
+        ZBD3T=net_days.astype(str),
+        ZTERM=zterm,
+        SKFBT=np.where(has_discount, _format_cents(re_total), ""),
+        SGTXT=np.array([f"AP {name[:30]}"[:50] for name in vendor_names], dtype=object)[re_vendor],
+        ZUONR=vendor_ids[re_vendor],
+    )
+
+    # ---- Payments (KZ) -----------------------------------------------------
+    kz_cents = _draw_cents(rng, np.full(len(kz_docs), 1000), np.full(len(kz_docs), 100000))
+    kz_vendor = rng.integers(0, len(vendor_ids), size=len(kz_docs))
+
+    if payments is not None and len(payments):
+        match = pd.Index(payments["BELNR"]).get_indexer(documents_df["BELNR"].to_numpy()[kz_docs])
+        hit = match >= 0
+        kz_vendor[hit] = pd.Index(vendor_ids).get_indexer(payments["LIFNR"].to_numpy()[match[hit]])
+        kz_cents[hit] = np.round(payments["DMBTR"].astype(float).to_numpy()[match[hit]] * 100)
+
+    # Bank line (Credit)
+    add_block(
+        kz_docs, np.full(len(kz_docs), 1),
+        KOART="S", SHKZG="H",
+        DMBTR=_format_cents(kz_cents), MWSTS="0.00",
+        HKONT="113100", KOSTL="",
+        SGTXT="Payment",
+    )
+
+    # Vendor line (Debit, clears AP)
+    add_block(
+        kz_docs, np.full(len(kz_docs), 2),
+        KOART="K", SHKZG="S",
+        DMBTR=_format_cents(kz_cents), MWSTS="0.00",
+        HKONT="160000", KOSTL="",
+        LIFNR=vendor_ids[kz_vendor],
+        SGTXT=np.array([f"Payment to {name[:30]}"[:50] for name in vendor_names], dtype=object)[kz_vendor],
+        ZUONR=vendor_ids[kz_vendor],
+    )
+
+    # ---- Credit Memos (KG) -------------------------------------------------
+    kg_cents = _draw_cents(rng, np.full(len(kg_docs), 100), np.full(len(kg_docs), 10000))
+    kg_vendor = rng.integers(0, len(vendor_ids), size=len(kg_docs))
+
+    # Vendor line (Debit, reduces AP)
+    add_block(
+        kg_docs, np.full(len(kg_docs), 1),
+        KOART="K", SHKZG="S",
+        DMBTR=_format_cents(kg_cents), MWSTS="0.00",
+        HKONT="160000", KOSTL="",
+        LIFNR=vendor_ids[kg_vendor],
+        SGTXT=np.array([f"Credit from {name[:30]}"[:50] for name in vendor_names], dtype=object)[kg_vendor],
+        ZUONR=vendor_ids[kg_vendor],
+    )
+
+    # GL line (Credit, reduces expense)
+    add_block(
+        kg_docs, np.full(len(kg_docs), 2),
+        KOART="S", SHKZG="H",
+        DMBTR=_format_cents(kg_cents), MWSTS="0.00",
+        HKONT=gl_codes[rng.integers(0, len(gl_codes), size=len(kg_docs))],
+        KOSTL=cost_centers[rng.integers(0, len(cost_centers), size=len(kg_docs))],
+        SGTXT="Credit adjustment",
+    )
+
+    # ---- Assemble in document / line order ---------------------------------
+    doc = np.concatenate([block["doc"] for block in blocks])
+    line = np.concatenate([block["line"] for block in blocks])
+    order = np.lexsort((line, doc))
+    doc = doc[order]
+
+    columns = {}
+    for col in BSEG_COLUMNS:
+        if col in keys:
+            columns[col] = keys[col][doc]
+        elif col == "BUZEI":
+            columns[col] = _zfill(line[order].astype(str), 3)
+        elif col == "WRBTR":
+            columns[col] = columns["DMBTR"]
+        elif col == "PSWSL":
+            columns[col] = "EUR"
+        else:
+            parts = [np.broadcast_to(np.asarray(block.get(col, ""), dtype=object), block["doc"].shape)
+                     for block in blocks]
+            columns[col] = np.concatenate(parts)[order]
+
+    return pd.DataFrame(columns)
+
+# ============================================================================
+# OUTPUT WRITERS (CSV / PARQUET)
+# ============================================================================
+
+# SAP table of each output file (its Parquet columns are typed with
+# sap_fields.SAP_SCHEMAS, the landing schema of the Dataflow)
+FILE_TABLES = {
+    LFA1_FILE: "LFA1",
+    BKPF_FILE: "BKPF",
+    BSEG_FILE: "BSEG",
+}
+
+# Hive-style partition columns per file (tables without them are not partitioned)
+PARQUET_PARTITIONS = {
+    BKPF_FILE: ["GJAHR", "BUKRS"],
+    BSEG_FILE: ["GJAHR", "BUKRS"],
+}
+
+DEFAULT_WRITE_OPTIONS = {
+    "output_format": OUTPUT_FORMAT,
+    "compression": PARQUET_COMPRESSION,
+    "row_group_size": PARQUET_ROW_GROUP_SIZE,
+}
+
+
+def to_arrow_table(df, file_name):
+    """Convert an all-text SAP DataFrame to an Arrow table with the landing types"""
+    import pyarrow as pa
+
+    table = pa.table({name: pa.array(df[name].to_numpy(dtype=object), pa.string()) for name in df.columns})
+    typed, rejects = sap_fields.parse_table(FILE_TABLES[file_name], table)
+    if rejects:
+        raise ValueError(f"{len(rejects)} {file_name} rows do not match the schema, "
+                         f"first: {rejects[0]['record']} ({rejects[0]['rejected_fields']})")
+    return typed
+
+
+def output_path(output_dir, file_name, output_format="csv"):
+    """Path of a table's output: the CSV file or the Parquet dataset directory"""
+    if output_format == "parquet":
+        return os.path.join(output_dir, os.path.splitext(file_name)[0])
+    return os.path.join(output_dir, file_name)
+
+
+def prepare_output(output_dir, file_names, output_format="csv"):
+    """Remove the outputs of a previous run: Parquet datasets, CSV files and
+    their part files (they may be hard links into the artifact cache, which
+    writing over them would change)"""
+    os.makedirs(output_dir, exist_ok=True)
+    for file_name in file_names:
+        if output_format == "parquet":
+            shutil.rmtree(output_path(output_dir, file_name, output_format), ignore_errors=True)
+            continue
+        for path in [output_path(output_dir, file_name)] + glob.glob(
+                os.path.join(output_dir, part_file(file_name))):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def output_names(output_dir, file_names, output_format="csv"):
+    """Outputs of the tables relative to output_dir: files, part files or dataset directories"""
+    names = []
+    for file_name in file_names:
+        path = output_path(output_dir, file_name, output_format)
+        if os.path.exists(path):
+            names.append(os.path.relpath(path, output_dir))
+        if output_format == "csv":
+            parts = glob.glob(os.path.join(output_dir, part_file(file_name)))
+            names += sorted(os.path.relpath(p, output_dir) for p in parts)
+    return names
+
+
+def write_table(df, output_dir, file_name, part=None, append=False, output_format="csv",
+                compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE):
+    """Write one generated table (or one batch/shard of it)
+
+    CSV: writes file_name, or its part file when part is given; append adds
+    rows without a header. Parquet: adds part-<part>-*.parquet files to the
+    table's dataset directory, partitioned by GJAHR/BUKRS for BKPF/BSEG.
+    """
+    if output_format == "csv":
+        path = os.path.join(output_dir, file_name if part is None else part_file(file_name, part))
+        df.to_csv(path, mode="a" if append else "w", header=not append, index=False)
+        return
+
+    if output_format != "parquet":
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    import pyarrow.dataset as ds
+
+    ds.write_dataset(
+        to_arrow_table(df, file_name),
+        output_path(output_dir, file_name, output_format),
+        format="parquet",
+        partitioning=PARQUET_PARTITIONS.get(file_name),
+        partitioning_flavor="hive",
+        basename_template=f"part-{part or 0:05d}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=ds.ParquetFileFormat().make_write_options(compression=compression),
+        min_rows_per_group=min(row_group_size, len(df)),
+        max_rows_per_group=row_group_size,
+    )
+
+# ============================================================================
+# STREAMING OUTPUT
+# ============================================================================
+
+def generate_streaming(vendors_df, output_dir, num_docs_per_year=500, batch_size=100000,
+                       rng=None, years=YEARS, first_doc_number=5100000001,
+                       company_codes=COMPANY_CODES, write_options=None):
+    """Generate BKPF/BSEG in document batches and write each batch as it is made
+
+    CSV batches are appended to one file per table; Parquet batches are
+    added as part files to the table's dataset (write_options). A document
+    and all of its line items are always generated in the same batch, and
+    document numbers continue across batches, so BKPF and BSEG keys (BELNR,
+    GJAHR, BUKRS) stay consistent. Returns the rows written.
+    """
+    rng = rng if rng is not None else np.random.default_rng(SEED)
+    write_options = write_options or DEFAULT_WRITE_OPTIONS
+
+    totals = {"BKPF": 0, "BSEG": 0}
+    doc_counter = first_doc_number
+    batch = 0
+
+    for year in years:
+        for batch_start in range(0, num_docs_per_year, batch_size):
+            num_docs = min(batch_size, num_docs_per_year - batch_start)
+            documents_df = generate_document_batch(year, num_docs, doc_counter, rng, company_codes)
+            line_items_df = generate_line_items_vectorized(documents_df, vendors_df, rng)
+            doc_counter += num_docs
+
+            # CSV batches are appended to one file, Parquet batches become part files
+            if write_options["output_format"] == "csv":
+                part, append = None, batch > 0
+            else:
+                part, append = batch, False
+            write_table(documents_df, output_dir, BKPF_FILE, part, append, **write_options)
+            write_table(line_items_df, output_dir, BSEG_FILE, part, append, **write_options)
+            batch += 1
+
+            totals["BKPF"] += len(documents_df)
+            totals["BSEG"] += len(line_items_df)
+            print(f"  {year}: {totals['BKPF']:,} documents, {totals['BSEG']:,} line items written")
+
+    return totals
+
+
+# ============================================================================
+# PARALLEL SHARDED GENERATION
+# ============================================================================
+
+def part_file(file_name, shard_index=None):
+    """Part file name for a shard, e.g. sap_bseg_line_items_00003.csv
+
+    Without a shard index, returns the glob pattern matching all parts.
+    """
+    stem, ext = os.path.splitext(file_name)
+    suffix = "*" if shard_index is None else f"{shard_index:05d}"
+    return f"{stem}_{suffix}{ext}"
+
+
+def plan_shards(num_docs_per_year=500, shard_size=100000, years=YEARS,
+                first_doc_number=5100000001):
+    """Split the document range into fixed-size shards
+
+    Returns (shard_index, year, num_docs, first_doc_number) tuples. The plan
+    depends only on the volume and shard size, never on the worker count.
+    """
+    shards = []
+    doc_counter = first_doc_number
+    for year in years:
+        for batch_start in range(0, num_docs_per_year, shard_size):
+            num_docs = min(shard_size, num_docs_per_year - batch_start)
+            shards.append((len(shards), year, num_docs, doc_counter))
+            doc_counter += num_docs
+    return shards
 
-    print("Step 2/3: Generating document headers (BKPF)...")
-    documents_df = generate_documents(NUM_DOCUMENTS_PER_YEAR)
 
-    print("Step 3/3: Generating line items (BSEG)...")
-    line_items_df = generate_line_items(documents_df, vendors_df)
+def generate_shard(shard, vendors_df, output_dir, seed=SEED, company_codes=COMPANY_CODES,
+                   write_options=None):
+    """Generate one shard of BKPF/BSEG and write its part files"""
+    shard_index, year, num_docs, first_doc_number = shard
+    rng = np.random.default_rng([seed, shard_index])
 
-    # Save to CSV
-    output_dir = "../"
+    documents_df = generate_document_batch(year, num_docs, first_doc_number, rng, company_codes)
+    line_items_df = generate_line_items_vectorized(documents_df, vendors_df, rng)
 
-    print(f"\nSaving files to {output_dir}...")
-    vendors_df.to_csv(f"{output_dir}/sap_lfa1_vendor_master.csv", index=False)
-    documents_df.to_csv(f"{output_dir}/sap_bkpf_document_header.csv", index=False)
-    line_items_df.to_csv(f"{output_dir}/sap_bseg_line_items.csv", index=False)
+    write_options = write_options or DEFAULT_WRITE_OPTIONS
+    write_table(documents_df, output_dir, BKPF_FILE, shard_index, **write_options)
+    write_table(line_items_df, output_dir, BSEG_FILE, shard_index, **write_options)
 
-    # Statistics
+    return shard_index, len(documents_df), len(line_items_df)
+
+
+def generate_sharded(vendors_df, output_dir, num_docs_per_year=500, shard_size=100000,
+                     num_workers=None, seed=SEED, years=YEARS,
+                     first_doc_number=5100000001, company_codes=COMPANY_CODES,
+                     write_options=None):
+    """Generate BKPF/BSEG shards in a process pool. Returns the rows written."""
+    shards = plan_shards(num_docs_per_year, shard_size, years, first_doc_number)
+
+    totals = {"BKPF": 0, "BSEG": 0, "shards": len(shards)}
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        results = pool.map(generate_shard, shards, repeat(vendors_df), repeat(output_dir),
+                           repeat(seed), repeat(company_codes), repeat(write_options))
+        for shard_index, num_docs, num_lines in results:
+            totals["BKPF"] += num_docs
+            totals["BSEG"] += num_lines
+            print(f"  Shard {shard_index + 1}/{len(shards)}: {num_docs:,} documents, {num_lines:,} line items")
+
+    return totals
+
+
+# ============================================================================
+# INCREMENTAL (DELTA) EXTRACTS
+# ============================================================================
+# Simulates daily SAP extracts on top of an existing full extract. Each run
+# continues after the highest BELNR and the last entry date (CPUDT) found in
+# the full extract and all earlier deltas, and writes only the new documents
+# to <output-dir>/delta/<last entry date>/:
+#   - new RE/KZ/KG documents entered on each day of the window
+#   - payments (KZ) that clear open invoices, oldest due date first
+#   - occasional reversals: a new document with flipped debit/credit lines,
+#     plus the changed header of the reversed invoice (STBLG/STJAH filled)
+
+DELTA_DIR = "delta"
+REVERSAL_RATE = 0.01  # share of new documents that reverse an earlier invoice
+
+BKPF_KEYS = ["MANDT", "BUKRS", "BELNR", "GJAHR"]
+
+
+def from_arrow_table(table):
+    """Convert a typed Arrow table back to all-text SAP columns (inverse of to_arrow_table)"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = {}
+    for name in table.column_names:
+        column = table[name]
+        if pa.types.is_date(column.type):
+            column = pc.strftime(column.cast(pa.timestamp("s")), format="%Y%m%d")
+        columns[name] = column.cast(pa.string()).fill_null("").to_numpy(zero_copy_only=False)
+    return pd.DataFrame(columns)
+
+
+def read_table(output_dir, file_name, output_format="csv", columns=None, row_filter=None):
+    """Read a generated table back as all-text SAP columns
+
+    Reads the single file, its part files or the Parquet dataset. row_filter
+    (DataFrame -> DataFrame) is applied chunk by chunk to bound memory.
+    """
+    row_filter = row_filter or (lambda df: df)
+    frames = []
+
+    if output_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        path = output_path(output_dir, file_name, output_format)
+        if not os.path.isdir(path):
+            return None
+        partition_cols = PARQUET_PARTITIONS.get(file_name)
+        partitioning = None
+        if partition_cols:
+            partitioning = ds.partitioning(
+                pa.schema([(col, pa.string()) for col in partition_cols]), flavor="hive"
+            )
+        dataset = ds.dataset(path, format="parquet", partitioning=partitioning)
+        for batch in dataset.to_batches(columns=columns):
+            frames.append(row_filter(from_arrow_table(pa.Table.from_batches([batch]))))
+    else:
+        paths = glob.glob(os.path.join(output_dir, file_name))
+        paths += sorted(glob.glob(os.path.join(output_dir, part_file(file_name))))
+        for path in paths:
+            for chunk in pd.read_csv(path, dtype=str, keep_default_na=False,
+                                     usecols=columns, chunksize=1_000_000):
+                frames.append(row_filter(chunk))
+
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_history(output_dir, file_name, output_format="csv", columns=None, row_filter=None):
+    """Read a table from the full extract and all delta extracts, oldest first"""
+    dirs = [output_dir] + sorted(glob.glob(os.path.join(output_dir, DELTA_DIR, "*")))
+    frames = [read_table(d, file_name, output_format, columns, row_filter) for d in dirs]
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        raise FileNotFoundError(f"No {file_name} extract found in {output_dir}")
+    return pd.concat(frames, ignore_index=True)
+
+
+def open_invoices(documents_df, vendor_lines_df):
+    """Open invoice vendor lines, clearing payments FIFO per company code and vendor
+
+    Payments and credit memos (vendor debits) settle the oldest invoices
+    (by baseline date) first. Reversed documents are ignored. Returns the
+    invoice lines with OPEN_CENTS (remaining amount) and DUE_DATE.
+    """
+    headers = documents_df[BKPF_KEYS + ["BLART", "STBLG"]]
+    lines = vendor_lines_df.merge(headers, on=BKPF_KEYS)
+    lines = lines[lines["STBLG"] == ""]
+    cents = np.round(lines["DMBTR"].astype(float) * 100).astype(np.int64)
+
+    vendor_key = ["BUKRS", "LIFNR"]
+    paid = (cents[lines["SHKZG"] == "S"]).groupby([lines["BUKRS"], lines["LIFNR"]]).sum()
+    paid.name = "PAID_CENTS"
+
+    invoices = lines[(lines["BLART"] == "RE") & (lines["SHKZG"] == "H")].copy()
+    invoices["CENTS"] = cents.loc[invoices.index]
+    invoices = invoices.sort_values(vendor_key + ["ZFBDT", "BELNR"])
+    invoices["CUM_CENTS"] = invoices.groupby(vendor_key)["CENTS"].cumsum()
+    invoices = invoices.join(paid, on=vendor_key)
+    invoices["PAID_CENTS"] = invoices["PAID_CENTS"].fillna(0).astype(np.int64)
+
+    invoices["OPEN_CENTS"] = np.minimum(invoices["CENTS"], invoices["CUM_CENTS"] - invoices["PAID_CENTS"])
+    invoices = invoices[invoices["OPEN_CENTS"] > 0]
+
+    net_days = pd.to_numeric(invoices["ZBD3T"], errors="coerce").fillna(0).astype(int)
+    invoices["DUE_DATE"] = (
+        pd.to_datetime(invoices["ZFBDT"], format="%Y%m%d", errors="coerce").to_numpy().astype("datetime64[D]")
+        + net_days.to_numpy()
+    )
+    return invoices
+
+
+def reverse_documents(originals_df, original_lines_df, first_doc_number, entry_dates):
+    """Build reversal documents for originals_df and the updated original headers
+
+    Each reversal copies the original's lines with debit/credit flipped.
+    Returns (reversal headers, reversal lines, original headers with STBLG/STJAH).
+    """
+    originals_df = originals_df.reset_index(drop=True)
+    n = len(originals_df)
+
+    reversal_dates = _format_dates(np.asarray(entry_dates, dtype="datetime64[D]"))
+    reversal_numbers = _zfill(np.arange(first_doc_number, first_doc_number + n).astype(str), 10)
+    reversal_years = np.array([date[:4] for date in reversal_dates])
+
+    reversals_df = originals_df.copy()
+    reversals_df["BELNR"] = reversal_numbers
+    reversals_df["GJAHR"] = reversal_years
+    for col in ["BLDAT", "BUDAT", "CPUDT"]:
+        reversals_df[col] = reversal_dates
+    reversals_df["TCODE"] = "FB08"
+    reversals_df["BKTXT"] = [f"Reversal {belnr}"[:25] for belnr in originals_df["BELNR"]]
+    reversals_df["STBLG"] = originals_df["BELNR"]
+    reversals_df["STJAH"] = originals_df["GJAHR"]
+
+    updated_df = originals_df.copy()
+    updated_df["STBLG"] = reversal_numbers
+    updated_df["STJAH"] = reversal_years
+
+    # Map every original document key to its reversal number / year
+    mapping = originals_df[BKPF_KEYS].assign(NEW_BELNR=reversal_numbers, NEW_GJAHR=reversal_years)
+    lines = original_lines_df.merge(mapping, on=BKPF_KEYS)
+    lines["BELNR"] = lines.pop("NEW_BELNR")
+    lines["GJAHR"] = lines.pop("NEW_GJAHR")
+    lines["SHKZG"] = np.where(lines["SHKZG"] == "S", "H", "S")
+    lines = lines.sort_values(["BELNR", "BUZEI"])[BSEG_COLUMNS]
+
+    return reversals_df, lines.reset_index(drop=True), updated_df
+
+
+def generate_increment(output_dir, num_days=1, num_docs_per_year=500, seed=SEED,
+                       company_codes=COMPANY_CODES, output_format="csv"):
+    """Generate the next num_days of BKPF/BSEG after the existing extracts
+
+    Returns (documents_df, line_items_df, extract_date), where documents_df
+    also holds the changed headers of reversed invoices.
+    """
+    vendors_df = read_table(output_dir, LFA1_FILE, output_format)
+    documents_hist = read_history(output_dir, BKPF_FILE, output_format)
+    # Later extracts carry changed headers (reversals): keep the newest version
+    documents_hist = documents_hist.drop_duplicates(BKPF_KEYS, keep="last")
+
+    last_entry = pd.to_datetime(documents_hist["CPUDT"], format="%Y%m%d").max()
+    start = np.datetime64(last_entry.date(), "D") + 1
+    next_doc_number = int(documents_hist["BELNR"].max()) + 1
+    rng = np.random.default_rng([seed, int(start.astype(np.int64))])
+
+    # New documents: Poisson count per day around the yearly volume
+    per_day = rng.poisson(num_docs_per_year / 365, size=num_days)
+    entry_dates = np.repeat(start + np.arange(num_days), per_day)
+    documents_df = generate_document_batch(
+        None, len(entry_dates), next_doc_number, rng, company_codes, entry_dates=entry_dates
+    )
+    next_doc_number += len(documents_df)
+
+    vendor_columns = BKPF_KEYS + ["BUZEI", "KOART", "SHKZG", "DMBTR", "LIFNR", "ZFBDT", "ZBD3T"]
+    vendor_lines = read_history(
+        output_dir, BSEG_FILE, output_format, vendor_columns,
+        row_filter=lambda df: df[df["KOART"] == "K"],
+    )
+    candidates = open_invoices(documents_hist, vendor_lines)
+
+    # Reversals: pick fully open invoices, they are no longer payable
+    fully_open = candidates[candidates["OPEN_CENTS"] == candidates["CENTS"]]
+    num_reversals = min(rng.binomial(len(documents_df), REVERSAL_RATE), len(fully_open))
+    reversed_keys = fully_open.iloc[rng.choice(len(fully_open), size=num_reversals, replace=False)][BKPF_KEYS]
+    candidates = candidates.merge(reversed_keys, on=BKPF_KEYS, how="left", indicator=True)
+    candidates = candidates[candidates["_merge"] == "left_only"]
+
+    # Payments: each KZ document clears the open invoice due first
+    window_end = start + num_days - 1
+    due = candidates[candidates["DUE_DATE"] <= window_end].sort_values(["DUE_DATE", "BELNR"])
+    kz_docs = np.flatnonzero(documents_df["BLART"].to_numpy() == "KZ")[:len(due)]
+    due = due.iloc[:len(kz_docs)]
+    payments = pd.DataFrame({
+        "BELNR": documents_df["BELNR"].to_numpy()[kz_docs],
+        "LIFNR": due["LIFNR"].to_numpy(),
+        "DMBTR": _format_cents(due["OPEN_CENTS"].to_numpy()),
+    })
+    documents_df.loc[kz_docs, "BUKRS"] = due["BUKRS"].to_numpy()
+
+    line_items_df = generate_line_items_vectorized(documents_df, vendors_df, rng, payments)
+
+    if num_reversals:
+        originals = documents_hist.merge(reversed_keys, on=BKPF_KEYS)
+        original_lines = read_history(
+            output_dir, BSEG_FILE, output_format,
+            row_filter=lambda df: df.merge(reversed_keys, on=BKPF_KEYS),
+        )
+        reversal_dates = start + rng.integers(0, num_days, size=len(originals))
+        reversals_df, reversal_lines, updated_df = reverse_documents(
+            originals, original_lines, next_doc_number, reversal_dates
+        )
+        columns = documents_df.columns
+        documents_df = pd.concat([documents_df, reversals_df[columns], updated_df[columns]], ignore_index=True)
+        line_items_df = pd.concat([line_items_df, reversal_lines], ignore_index=True)
+
+    extract_date = str(window_end).replace("-", "")
+    return documents_df, line_items_df, extract_date
+
+
+def print_statistics(vendors_df, documents_df, line_items_df):
+    """Print a summary of the generated LFA1, BKPF and BSEG tables"""
     print("\n" + "="*70)
     print("GENERATION COMPLETE")
     print("="*70)
@@ -597,11 +1348,261 @@ if __name__ == "__main__":
     print(f"  Mean:   EUR {vendor_amounts.mean():>12,.2f}")
     print(f"  Median: EUR {vendor_amounts.median():>12,.2f}")
 
+# ============================================================================
+# SCALE FACTORS
+# ============================================================================
+# TPC-style scale factor (SF): one number sizes the whole dataset.
+#
+#   documents per year = 100,000 x SF       (~3.2 BSEG lines per document)
+#   vendors            = max(100, 1,000 x SF)
+#   fiscal years       = 2 + log10(SF)      (ending in END_DATE's year)
+#   company codes      = 3 x (1 + log10(SF))
+#
+#   SF      Vendors   Docs/year    Years  Company codes  ~BSEG lines
+#   0.005       100         500        2              3        3,200  (demo)
+#   1         1,000     100,000        2              3         640K
+#   10       10,000   1,000,000        3              6         9.6M
+#   100     100,000  10,000,000        4              9         128M
+#
+# log10 steps are whole powers of ten (SF 1-9 count as SF1, 10-99 as SF10 ...).
+
+def scale_config(scale_factor):
+    """Dataset dimensions for a scale factor (see table above)"""
+    steps = len(str(int(scale_factor))) - 1 if scale_factor >= 1 else 0
+    num_years = 2 + steps
+    num_company_codes = 3 * (1 + steps)
+
+    return {
+        "num_vendors": max(100, round(1000 * scale_factor)),
+        "num_docs_per_year": max(1, round(100000 * scale_factor)),
+        "years": tuple(range(END_DATE.year - num_years + 1, END_DATE.year + 1)),
+        # 1000, 2000 ... 9000, then 1100, 2100 ...
+        "company_codes": [f"{1000 * (i % 9 + 1) + 100 * (i // 9):04d}" for i in range(num_company_codes)],
+    }
+
+
+def parse_args(argv=None):
+    """Command-line options (defaults reproduce the demo dataset)"""
+    parser = argparse.ArgumentParser(
+        description="Generate SAP Accounts Payable sample data (LFA1, BKPF, BSEG)"
+    )
+    parser.add_argument("--scale-factor", "--sf", type=float, default=None,
+                        help="TPC-style scale factor (SF1, SF10, SF100 ...); "
+                             "default: demo dataset from the module constants")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR,
+                        help=f"Output directory (default: {OUTPUT_DIR})")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=OUTPUT_FORMAT,
+                        help=f"Output format (default: {OUTPUT_FORMAT})")
+    parser.add_argument("--compression", default=PARQUET_COMPRESSION,
+                        help=f"Parquet compression codec (default: {PARQUET_COMPRESSION})")
+    parser.add_argument("--row-group-size", type=int, default=PARQUET_ROW_GROUP_SIZE,
+                        help=f"Parquet rows per row group (default: {PARQUET_ROW_GROUP_SIZE})")
+    parser.add_argument("--mode", choices=["vectorized", "legacy"], default=GENERATION_MODE,
+                        help=f"Generation mode (default: {GENERATION_MODE})")
+    parser.add_argument("--batch-size", type=int, default=STREAMING_BATCH_SIZE,
+                        help="Stream BKPF/BSEG to disk in batches of this many documents")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS,
+                        help="Generate shards in this many processes (writes part files)")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE,
+                        help=f"Documents per shard in parallel mode (default: {SHARD_SIZE})")
+    parser.add_argument("--seed", type=int, default=SEED,
+                        help=f"Random seed (default: {SEED})")
+    parser.add_argument("--incremental-days", type=int, default=None,
+                        help="Append a delta extract with the next N days of BKPF/BSEG "
+                             "after the existing output (writes <output-dir>/delta/<date>/)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always generate, do not restore or store the output in the cache")
+    parser.add_argument("--cache-dir", default=artifact_cache.CACHE_DIR,
+                        help=f"Artifact cache directory (default: {artifact_cache.CACHE_DIR})")
+
+    args = parser.parse_args(argv)
+    if args.incremental_days is not None and args.incremental_days < 1:
+        parser.error("--incremental-days must be at least 1")
+    if args.mode == "legacy" and (args.batch_size or args.workers):
+        parser.error("--batch-size and --workers require --mode vectorized")
+    if args.batch_size and args.workers:
+        parser.error("--batch-size and --workers cannot be combined")
+    return args
+
+
+# ============================================================================
+# MAIN GENERATION
+# ============================================================================
+
+def generate_delta_extract(args, config):
+    """Write the next --incremental-days of BKPF/BSEG as a delta extract"""
+    print("="*70)
+    print("SAP Accounts Payable Sample Data Generator - Delta Extract")
+    print("="*70)
+    print(f"\nReading existing extracts from {args.output_dir}...")
+
+    documents_df, line_items_df, extract_date = generate_increment(
+        args.output_dir, args.incremental_days, config["num_docs_per_year"], args.seed,
+        config["company_codes"], args.format
+    )
+
+    delta_dir = os.path.join(args.output_dir, DELTA_DIR, extract_date)
+    write_options = {
+        "output_format": args.format,
+        "compression": args.compression,
+        "row_group_size": args.row_group_size,
+    }
+    prepare_output(delta_dir, [BKPF_FILE, BSEG_FILE], args.format)
+    write_table(documents_df, delta_dir, BKPF_FILE, **write_options)
+    write_table(line_items_df, delta_dir, BSEG_FILE, **write_options)
+
+    is_reversal = documents_df["TCODE"] == "FB08"
+    is_changed = (documents_df["STBLG"] != "") & ~is_reversal
+    new_docs = documents_df[~is_changed & ~is_reversal]
+    entry_dates = new_docs["CPUDT"]
+
+    print(f"\nDelta extract {entry_dates.min()} - {entry_dates.max()} written to {delta_dir}")
+    print(f"  New documents:       {len(new_docs):,}")
+    for doc_type in sorted(new_docs["BLART"].unique()):
+        print(f"    {doc_type}: {(new_docs['BLART'] == doc_type).sum():,}")
+    print(f"  Reversals:           {is_reversal.sum():,}")
+    print(f"  Changed headers:     {is_changed.sum():,} (reversed invoices)")
+    print(f"  BSEG line items:     {len(line_items_df):,}")
+    print("="*70)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.scale_factor is not None:
+        config = scale_config(args.scale_factor)
+    else:
+        config = {
+            "num_vendors": NUM_VENDORS,
+            "num_docs_per_year": NUM_DOCUMENTS_PER_YEAR,
+            "years": YEARS,
+            "company_codes": COMPANY_CODES,
+        }
+    years = config["years"]
+    output_dir = args.output_dir
+    write_options = {
+        "output_format": args.format,
+        "compression": args.compression,
+        "row_group_size": args.row_group_size,
+    }
+
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+
+    if args.incremental_days:
+        generate_delta_extract(args, config)
+        return
+
+    # Workers only change the file layout (part files), not the rows
+    output_files = [LFA1_FILE, BKPF_FILE, BSEG_FILE]
+    cache = None if args.no_cache else artifact_cache.ArtifactCache(args.cache_dir)
+    cache_key = artifact_cache.fingerprint({
+        "config": config, "seed": args.seed, "mode": args.mode, "write_options": write_options,
+        "batch_size": args.batch_size, "shard_size": args.shard_size if args.workers else None,
+    }, CACHE_CODE_FILES)
+    if cache and cache.manifest(cache_key):
+        prepare_output(output_dir, output_files, args.format)
+        cache.restore(cache_key, output_dir)
+        print(f"Output with the same configuration restored from the cache ({cache_key[:12]}):")
+        for name in output_names(output_dir, output_files, args.format):
+            print(f"  {os.path.join(output_dir, name)}")
+        return
+
+    print("="*70)
+    print("SAP Accounts Payable Sample Data Generator")
+    print("Following authentic SAP table structures (BKPF, BSEG, LFA1)")
+    print("="*70)
+    print(f"\nConfiguration:")
+    if args.scale_factor is not None:
+        print(f"  - Scale factor: SF{args.scale_factor:g}")
+    print(f"  - Vendors: {config['num_vendors']:,}")
+    print(f"  - Documents per year: {config['num_docs_per_year']:,}")
+    print(f"  - Years: {years[0]}-{years[-1]}")
+    print(f"  - Company codes: {', '.join(config['company_codes'])}")
+    print(f"  - Output: {args.format} in {output_dir}")
+    if args.batch_size:
+        print(f"  - Streaming batch size: {args.batch_size:,} documents")
+    if args.workers:
+        print(f"  - Sharded: {args.shard_size:,} documents per shard, {args.workers} workers")
+    print()
+
+    # Generate data
+    print("Step 1/3: Generating vendor master data (LFA1)...")
+    vendors_df = generate_vendors(config["num_vendors"])
+
+    prepare_output(output_dir, output_files, args.format)
+    write_table(vendors_df, output_dir, LFA1_FILE, **write_options)
+
+    if args.workers:
+        print(f"Step 2-3/3: Generating BKPF/BSEG shards in {args.workers} processes...")
+        totals = generate_sharded(
+            vendors_df, output_dir, config["num_docs_per_year"], args.shard_size, args.workers,
+            args.seed, years, company_codes=config["company_codes"], write_options=write_options
+        )
+
+    elif args.batch_size:
+        print(f"Step 2-3/3: Streaming BKPF/BSEG batches to {output_dir}...")
+        totals = generate_streaming(
+            vendors_df, output_dir, config["num_docs_per_year"], args.batch_size,
+            np.random.default_rng(args.seed), years,
+            company_codes=config["company_codes"], write_options=write_options
+        )
+
+    else:
+        if args.mode == "vectorized":
+            rng = np.random.default_rng(args.seed)
+
+            print("Step 2/3: Generating document headers (BKPF, vectorized)...")
+            documents_df = generate_documents_vectorized(
+                config["num_docs_per_year"], rng, years, company_codes=config["company_codes"]
+            )
+
+            print("Step 3/3: Generating line items (BSEG, vectorized)...")
+            line_items_df = generate_line_items_vectorized(documents_df, vendors_df, rng)
+        else:
+            print("Step 2/3: Generating document headers (BKPF)...")
+            documents_df = generate_documents(config["num_docs_per_year"], years, config["company_codes"])
+
+            print("Step 3/3: Generating line items (BSEG)...")
+            line_items_df = generate_line_items(documents_df, vendors_df)
+
+        print(f"\nSaving files to {output_dir}...")
+        write_table(documents_df, output_dir, BKPF_FILE, **write_options)
+        write_table(line_items_df, output_dir, BSEG_FILE, **write_options)
+
+        print_statistics(vendors_df, documents_df, line_items_df)
+
+    if args.workers or args.batch_size:
+        print("\n" + "="*70)
+        print("GENERATION COMPLETE")
+        print("="*70)
+        print(f"\n  LFA1 vendors:        {len(vendors_df):,}")
+        print(f"  BKPF documents:      {totals['BKPF']:,}")
+        print(f"  BSEG line items:     {totals['BSEG']:,}")
+        if args.workers:
+            print(f"  Part files:          {totals['shards']:,} per table")
+
+    if cache and cache.store(cache_key, output_dir, output_names(output_dir, output_files, args.format),
+                             kind="extracts"):
+        print(f"\nStored in the cache ({cache_key[:12]})")
+
     print("\n" + "="*70)
     print("✅ Files created successfully!")
     print("="*70)
-    print(f"  {output_dir}sap_lfa1_vendor_master.csv")
-    print(f"  {output_dir}sap_bkpf_document_header.csv")
-    print(f"  {output_dir}sap_bseg_line_items.csv")
+    if args.format == "parquet":
+        for file_name in [LFA1_FILE, BKPF_FILE, BSEG_FILE]:
+            print(f"  {output_path(output_dir, file_name, args.format)}/")
+    elif args.workers:
+        print(f"  {os.path.join(output_dir, LFA1_FILE)}")
+        print(f"  {os.path.join(output_dir, part_file(BKPF_FILE))}")
+        print(f"  {os.path.join(output_dir, part_file(BSEG_FILE))}")
+    else:
+        print(f"  {os.path.join(output_dir, LFA1_FILE)}")
+        print(f"  {os.path.join(output_dir, BKPF_FILE)}")
+        print(f"  {os.path.join(output_dir, BSEG_FILE)}")
     print("\nNext: Run your Fabric dataflow to ingest this data!")
     print("="*70)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Parallel ingestion of SAP extracts into typed landing tables (DuckDB)
+
+The local counterpart of the SapIngestion notebook. Reads the single-file or
+multi-part extracts (sap_bseg_line_items.csv, sap_bseg_line_items_*.csv) with
+DuckDB's CSV reader, which splits every file into byte ranges and parses them
+on all cores. Quoted fields follow RFC 4180 ("Müller, Hans", "" inside quotes).
+Columns are typed with the schema registry (sap_fields.SAP_SCHEMAS) in SQL,
+rows that do not parse go to sap_ingest_rejects.
+
+Usage:
+    python3 ingest_extracts.py --data-dir ../local_run/sf1/data --database ap.duckdb
+    python3 ingest_extracts.py --data-dir /data/ap_sf10 --database ap.duckdb --threads 8
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+import duckdb
+
+import generate_sample_data as gen
+import sap_fields
+
+# Landing tables as the Dataflow loads them: typed, upserted by key
+LANDING_TABLES = {
+    "lfa1": (gen.LFA1_FILE, ["MANDT", "LIFNR"]),
+    "bkpf": (gen.BKPF_FILE, gen.BKPF_KEYS),
+    "bseg": (gen.BSEG_FILE, gen.BKPF_KEYS + ["BUZEI"]),
+}
+
+
+def extract_files(data_dir, file_name, output_format="csv"):
+    """Files of one extract: the single file or its part files, whichever was
+    written last (never both), or the Parquet dataset"""
+    if output_format == "parquet":
+        path = gen.output_path(data_dir, file_name, output_format)
+        return sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True))
+    single = glob.glob(os.path.join(data_dir, file_name))
+    parts = sorted(glob.glob(os.path.join(data_dir, gen.part_file(file_name))))
+    if single and parts:
+        # A leftover of an earlier run: reading both would load every row twice
+        return parts if max(map(os.path.getmtime, parts)) > os.path.getmtime(single[0]) else single
+    return single or parts
+
+
+def extract_generations(data_dir, file_name, output_format="csv"):
+    """Files of the full extract and of each delta extract, oldest first"""
+    dirs = [data_dir] + sorted(glob.glob(os.path.join(data_dir, gen.DELTA_DIR, "*")))
+    generations = [extract_files(d, file_name, output_format) for d in dirs]
+    return [files for files in generations if files]
+
+
+def _read_files(files, output_format):
+    paths = "[" + ", ".join(f"'{path}'" for path in files) + "]"
+    if output_format == "parquet":
+        # Typed by the generator; partition columns stay text like the keys
+        return f"read_parquet({paths}, hive_partitioning = true, hive_types_autocast = false)"
+    return (f"read_csv({paths}, header = true, all_varchar = true, "
+            f"delim = ',', quote = '\"', escape = '\"')")
+
+
+def ingest_table(con, table, generations, keys, output_format="csv"):
+    """(Re)create one landing table; the newest version of a key wins
+
+    Returns (rows loaded, rows rejected).
+    """
+    fields = [field for field, _ in sap_fields.SAP_SCHEMAS[table.upper()]]
+    extract = " UNION ALL BY NAME ".join(
+        f"SELECT *, {index} AS __generation FROM {_read_files(files, output_format)}"
+        for index, files in enumerate(generations)
+    )
+    dedupe = ""
+    if len(generations) > 1:
+        dedupe = f"QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(keys)} ORDER BY __generation DESC) = 1"
+
+    if output_format == "parquet":
+        con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT {', '.join(fields)} FROM ({extract}) {dedupe}")
+        return con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], 0
+
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE __extract AS
+        SELECT *, {sap_fields.landing_rejected_fields(table)} AS __rejected_fields
+        FROM ({extract})
+        {dedupe}
+    """)
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {table} AS
+        SELECT {', '.join(sap_fields.landing_columns(table))}
+        FROM __extract
+        WHERE __rejected_fields = ''
+    """)
+    rejected = con.execute(f"""
+        INSERT INTO {sap_fields.REJECTS_TABLE}
+        SELECT '{table.upper()}', CAST(TO_JSON(STRUCT_PACK({', '.join(fields)})) AS VARCHAR),
+               __rejected_fields, CURRENT_TIMESTAMP
+        FROM __extract
+        WHERE __rejected_fields <> ''
+    """).fetchone()[0]
+    con.execute("DROP TABLE __extract")
+    return con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], rejected
+
+
+def load_landing_tables(con, data_dir, output_format="csv"):
+    """(Re)create bkpf/bseg/lfa1 and sap_ingest_rejects from the full extract
+    and all delta extracts. Returns {table: rows loaded}."""
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {sap_fields.REJECTS_TABLE} (
+            source_table VARCHAR, record VARCHAR, rejected_fields VARCHAR,
+            loaded_at TIMESTAMP WITH TIME ZONE
+        )
+    """)
+    counts, rejects = {}, 0
+    for table, (file_name, keys) in LANDING_TABLES.items():
+        generations = extract_generations(data_dir, file_name, output_format)
+        if not generations:
+            raise FileNotFoundError(f"No {file_name} extract found in {data_dir}")
+        counts[table], rejected = ingest_table(con, table, generations, keys, output_format)
+        rejects += rejected
+    if rejects:
+        print(f"  {rejects:,} rows rejected (see {sap_fields.REJECTS_TABLE})")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load SAP extracts into typed DuckDB landing tables")
+    parser.add_argument("--data-dir", required=True, help="Directory of the extracts (and delta/)")
+    parser.add_argument("--database", required=True, help="DuckDB database file")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="Extract format (default: csv)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Worker threads (default: all cores)")
+    args = parser.parse_args(argv)
+
+    con = duckdb.connect(args.database)
+    try:
+        if args.threads:
+            con.execute(f"SET threads = {args.threads}")
+        start = time.perf_counter()
+        counts = load_landing_tables(con, args.data_dir, args.format)
+        elapsed = time.perf_counter() - start
+    finally:
+        con.close()
+
+    for table, rows in counts.items():
+        print(f"  {table:<6} {rows:>12,} rows")
+    print(f"  Loaded in {elapsed:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
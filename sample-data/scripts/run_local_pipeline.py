@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""
+Run the AP transformation SQL locally on DuckDB against generated sample data
+
+Pulls the %%sql cells out of the 0_DataCleaning notebook (or reads
+sql/create_ap_fact_table.sql), translates the Spark SQL dialect to DuckDB and
+runs it stage by stage. Records wall time, rows, bytes and peak memory per stage.
+
+- Stages follow the banner comments of the script (CHANGE DETECTION, STAGE 1 ...)
+- Python cells of the notebook (persist_staging, OPTIMIZE) are skipped
+- Delta-only statements (OPTIMIZE, CACHE/UNCACHE) are emulated or skipped
+
+Usage:
+    python3 run_local_pipeline.py                               # demo dataset, full load
+    python3 run_local_pipeline.py --scale-factor 0.1 1 --incremental-days 1 \\
+        --output metrics.json
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from datetime import date
+
+import duckdb
+
+import artifact_cache
+import generate_sample_data as gen
+import ingest_extracts
+import sap_fields
+from ingest_extracts import load_landing_tables
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+NOTEBOOK_PATH = os.path.join(
+    REPO_ROOT, "fabric-workspace", "0_DataCleaning.Notebook", "notebook-content.py"
+)
+SQL_SCRIPT_PATH = os.path.join(REPO_ROOT, "sql", "create_ap_fact_table.sql")
+WORK_DIR = os.path.join(REPO_ROOT, "sample-data", "local_run")
+DATABASE_FILE = "ap_lakehouse.duckdb"
+
+OUTPUT_TABLES = [
+    "ap_document_reconciliation", "dim_vendor", "dim_document_type", "dim_date", "dim_company_code",
+    "accounts_payable_fact", "ap_clearing_pairs", "ap_open_items", "ap_aging_snapshot",
+    "ap_payment_stats_monthly",
+    "dq_rules", "dq_results", "ap_data_quality_summary", "ap_vendor_summary",
+]
+
+# A run is cached by a fingerprint of its SQL, load modes, the extracts and
+# this code (artifact_cache.py); a run with the same fingerprint restores the
+# database and the metrics of the earlier run
+CACHE_CODE_FILES = [__file__, ingest_extracts.__file__, gen.__file__, sap_fields.__file__]
+
+# Stage banner: a title line between two "-- =====" lines
+BANNER_RULE = re.compile(r"^--\s*={5,}\s*$")
+
+
+# ============================================================================
+# SQL EXTRACTION
+# ============================================================================
+
+def notebook_sql_cells(path=NOTEBOOK_PATH):
+    """SQL text of the notebook's %%sql cells, in order"""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+
+    cells = []
+    for cell in re.split(r"^# (?:PARAMETERS )?CELL \*+$", content, flags=re.MULTILINE)[1:]:
+        lines = [line for line in cell.splitlines() if line.startswith("# MAGIC")]
+        lines = [line[len("# MAGIC "):] if line.startswith("# MAGIC ") else "" for line in lines]
+        if lines and lines[0].strip() == "%%sql":
+            cells.append("\n".join(lines[1:]))
+    return cells
+
+
+def script_sql_cells(path=SQL_SCRIPT_PATH):
+    """The standalone script as a single cell (without the %%sql magic)"""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    return [re.sub(r"^%%sql\s*$", "", content, count=1, flags=re.MULTILINE)]
+
+
+def split_statements(sql):
+    """Split SQL on semicolons outside quotes, dropping -- comments"""
+    statements, current = [], []
+    quote = None
+    i = 0
+    while i < len(sql):
+        ch = sql[i]
+        if quote:
+            current.append(ch)
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"', "`"):
+            quote = ch
+            current.append(ch)
+        elif sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end
+            continue
+        elif ch == ";":
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    statements.append("".join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def split_stages(cells):
+    """[(stage name, [statement, ...])] split at the banner comments
+
+    SQL before the first banner of a cell is named after its first line.
+    Stages without statements (e.g. Usage Instructions) are dropped.
+    """
+    stages = []
+    for cell in cells:
+        lines = cell.splitlines()
+        name, chunk = None, []
+        i = 0
+        while i < len(lines):
+            is_banner = (
+                i + 2 < len(lines)
+                and BANNER_RULE.match(lines[i].strip())
+                and lines[i + 1].strip().startswith("--")
+                and BANNER_RULE.match(lines[i + 2].strip())
+            )
+            if is_banner:
+                stages.append((name, split_statements("\n".join(chunk))))
+                name, chunk = lines[i + 1].strip()[2:].strip(), []
+                i += 3
+                continue
+            chunk.append(lines[i])
+            i += 1
+        stages.append((name, split_statements("\n".join(chunk))))
+
+    named, pending = [], []
+    for name, statements in stages:
+        statements = pending + statements
+        if not statements:
+            continue
+        # A header with only SET statements runs with the next stage
+        if all(statement.upper().startswith("SET ") for statement in statements):
+            pending = statements
+            continue
+        pending = []
+        if name is None:
+            name = statements[0].splitlines()[0][:40]
+        named.append((name, statements))
+    return named
+
+
+# ============================================================================
+# SPARK SQL -> DUCKDB
+# ============================================================================
+
+def _spark_format(fmt):
+    """Spark datetime pattern ('yyyyMMdd') as a strftime format"""
+    for spark, strftime in [("yyyy", "%Y"), ("MMMM", "%B"), ("MM", "%m"), ("dd", "%d"),
+                            ("EEEE", "%A"), ("HH", "%H"), ("mm", "%M"), ("ss", "%S")]:
+        fmt = fmt.replace(spark, strftime)
+    return fmt
+
+
+def _split_args(text):
+    """Top-level comma separated arguments of a function call"""
+    args, depth, quote, start = [], 0, None, 0
+    for i, ch in enumerate(text):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            args.append(text[start:i].strip())
+            start = i + 1
+    args.append(text[start:].strip())
+    return args
+
+
+def _rewrite_calls(sql, name, rewrite):
+    """Replace every name(...) call with rewrite(args), innermost calls first"""
+    pattern = re.compile(r"\b" + name + r"\s*\(", re.IGNORECASE)
+    out, pos = [], 0
+    while True:
+        match = pattern.search(sql, pos)
+        if not match:
+            out.append(sql[pos:])
+            return "".join(out)
+        depth, quote, end = 1, None, match.end()
+        while depth:
+            ch = sql[end]
+            if quote:
+                if ch == quote:
+                    quote = None
+            elif ch in ("'", '"'):
+                quote = ch
+            elif ch == "(":
+                depth += 1
+            elif ch == ")":
+                depth -= 1
+            end += 1
+        inner = _rewrite_calls(sql[match.end():end - 1], name, rewrite)
+        out.append(sql[pos:match.start()])
+        out.append(rewrite(_split_args(inner)))
+        pos = end
+
+
+def _to_date(args):
+    if len(args) == 1:
+        return f"TRY_CAST({args[0]} AS DATE)"
+    return f"CAST(TRY_STRPTIME({args[0]}, {_spark_format(args[1])}) AS DATE)"
+
+
+FUNCTION_REWRITES = [
+    ("TO_DATE", _to_date),
+    ("DATE_SUB", lambda a: f"CAST(({a[0]}) - ({a[1]}) AS DATE)"),
+    ("DATE_ADD", lambda a: f"CAST(({a[0]}) + ({a[1]}) AS DATE)"),
+    ("DATEADD", lambda a: f"CAST(({a[2]}) + ({a[1]}) AS DATE)"),
+    ("DATEDIFF", lambda a: f"DATE_DIFF('day', {a[1]}, {a[0]})"),
+    ("DATE_FORMAT", lambda a: f"STRFTIME({a[0]}, {_spark_format(a[1])})"),
+    ("TRUNC", lambda a: f"CAST(DATE_TRUNC('month', {a[0]}) AS DATE)"
+        if a[1].strip("'").upper() in ("MM", "MON", "MONTH")
+        else f"CAST(DATE_TRUNC('year', {a[0]}) AS DATE)"),
+    ("SHA2", lambda a: f"SHA256({a[0]})"),
+    ("TO_JSON", lambda a: f"CAST(TO_JSON({a[0]}) AS VARCHAR)"),
+    ("ARRAY", lambda a: f"LIST_VALUE({', '.join(a)})"),
+    ("SEQUENCE", lambda a: f"CAST(GENERATE_SERIES({', '.join(a)}) AS DATE[])"),
+    ("EXPLODE", lambda a: f"UNNEST({a[0]})"),
+    ("FIRST_VALUE", lambda a: f"FIRST_VALUE({a[0]}{' IGNORE NULLS' if a[1:] == ['TRUE'] else ''})"),
+    ("RAISE_ERROR", lambda a: f"ERROR({a[0]})"),
+    ("CURRENT_TIMESTAMP", lambda a: "CURRENT_TIMESTAMP"),
+    ("CURRENT_DATE", lambda a: "CURRENT_DATE"),
+]
+
+
+def translate(statement, variables, cached):
+    """DuckDB statements for one Spark SQL statement ([] when it is skipped)
+
+    variables: ${name} substitutions, updated by SET statements.
+    cached: names of cached views (CACHE TABLE), updated in place.
+    """
+    statement = re.sub(r"\$\{([\w.]+)\}", lambda m: variables[m.group(1)], statement)
+    head = statement.split(None, 2)
+    keyword = head[0].upper()
+
+    if keyword == "SET":
+        name, value = (part.strip() for part in statement[3:].split("=", 1))
+        # --load-mode on the command line wins over the script's default
+        variables.setdefault(name, value)
+        return []
+    if keyword == "OPTIMIZE":
+        return []
+    if keyword == "CACHE":
+        view = head[2].strip()
+        cached.add(view)
+        return [
+            f"CREATE OR REPLACE TEMP TABLE __cached_{view} AS SELECT * FROM {view}",
+            f"CREATE OR REPLACE TEMP VIEW {view} AS SELECT * FROM __cached_{view}",
+        ]
+    if keyword == "UNCACHE":
+        view = head[-1].split()[-1]
+        cached.discard(view)
+        return [f"DROP TABLE IF EXISTS __cached_{view}"]
+
+    sql = statement
+    sql = re.sub(r"\bUSING\s+DELTA\b", "", sql, flags=re.IGNORECASE)
+    sql = _rewrite_calls(sql, "PARTITIONED\\s+BY", lambda a: "")
+    sql = re.sub(r"\bLEFT\s+SEMI\s+JOIN\b", "SEMI JOIN", sql, flags=re.IGNORECASE)
+    sql = re.sub(r"\bLEFT\s+ANTI\s+JOIN\b", "ANTI JOIN", sql, flags=re.IGNORECASE)
+    sql = sql.replace("<=>", "IS NOT DISTINCT FROM")
+    for name, rewrite in FUNCTION_REWRITES:
+        sql = _rewrite_calls(sql, name, rewrite)
+
+    overwrite = re.match(r"INSERT\s+OVERWRITE\s+(?:TABLE\s+)?(\w+)", sql, re.IGNORECASE)
+    if overwrite:
+        table = overwrite.group(1)
+        return [f"DELETE FROM {table}", f"INSERT INTO {table}" + sql[overwrite.end():]]
+    return [sql]
+
+
+# ============================================================================
+# RUNNER
+# ============================================================================
+
+def database_bytes(con):
+    """Bytes used by the database file (after a checkpoint)"""
+    con.execute("CHECKPOINT")
+    _, _, block_size, _, used_blocks, *_ = con.execute("PRAGMA database_size").fetchone()
+    return block_size * used_blocks
+
+
+def _rss_bytes():
+    """Resident set size of this process (Linux), else None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class PeakMemory:
+    """Peak resident memory while the with-block runs
+
+    Samples /proc/self/statm in a background thread. Where that is not
+    available, falls back to the process-wide peak from getrusage.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if _rss_bytes() is not None:
+            self.peak_bytes = _rss_bytes()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes())
+        else:
+            import resource
+            # ru_maxrss is in KiB on Linux, bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            self.peak_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return False
+
+
+def execute(con, statement, variables, cached):
+    """Run one Spark SQL statement on DuckDB; returns the rows written or returned"""
+    rows = 0
+    for sql in translate(statement, variables, cached):
+        cursor = con.execute(sql)
+        if cursor.description:
+            columns = [column[0] for column in cursor.description]
+            result = cursor.fetchall()
+            if columns == ["Count"]:
+                rows += sum(row[0] for row in result)
+            else:
+                rows += len(result)
+    return rows
+
+
+def run_stages(con, stages, variables):
+    """Run the stages in order; returns per-stage metrics
+
+    rows: rows inserted, updated or deleted (and cached) by the stage,
+    plus rows returned by queries. bytes: growth of the database file.
+    peak_memory_bytes: peak resident memory of the process.
+    """
+    cached = set()
+    metrics = []
+    size_before = database_bytes(con)
+    for name, statements in stages:
+        rows = 0
+        start = time.perf_counter()
+        with PeakMemory() as memory:
+            for statement in statements:
+                try:
+                    rows += execute(con, statement, variables, cached)
+                except duckdb.Error as exc:
+                    raise RuntimeError(f"Stage '{name}' failed: {exc}\n{statement}") from exc
+        wall_time = time.perf_counter() - start
+        size_after = database_bytes(con)
+        metrics.append({
+            "stage": name,
+            "statements": len(statements),
+            "wall_time_s": round(wall_time, 3),
+            "rows": rows,
+            "bytes": size_after - size_before,
+            "peak_memory_bytes": memory.peak_bytes,
+        })
+        size_before = size_after
+    return metrics
+
+
+def table_counts(con, tables):
+    """Row counts of the output tables"""
+    return {table: con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in tables}
+
+
+def print_metrics(title, metrics):
+    print(f"\n{title}")
+    print(f"  {'Stage':<40} {'Time (s)':>10} {'Rows':>12} {'Bytes':>14} {'Peak MiB':>10}")
+    for m in metrics:
+        print(f"  {m['stage'][:40]:<40} {m['wall_time_s']:>10.3f} {m['rows']:>12,} {m['bytes']:>14,}"
+              f" {m['peak_memory_bytes'] / 2**20:>10.1f}")
+    total = sum(m["wall_time_s"] for m in metrics)
+    print(f"  {'Total':<40} {total:>10.3f}")
+
+
+def prepare_run_dir(work_dir, scale_factor, output_format="csv", reuse_data=False, cache=True):
+    """Generate the data of one scale factor and remove its old database
+
+    Returns (label, data directory, database path, generator arguments).
+    """
+    label = "demo" if scale_factor is None else f"sf{scale_factor:g}"
+    run_dir = os.path.join(work_dir, label)
+    data_dir = os.path.join(run_dir, "data")
+    gen_args = ["--output-dir", data_dir, "--format", output_format]
+    if scale_factor is not None:
+        gen_args += ["--scale-factor", str(scale_factor)]
+    if not cache:
+        gen_args += ["--no-cache"]
+
+    if not reuse_data:
+        shutil.rmtree(data_dir, ignore_errors=True)
+        gen.main(gen_args)
+    db_path = os.path.join(run_dir, DATABASE_FILE)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    return label, data_dir, db_path, gen_args
+
+
+def run_scale_factor(args, stages, scale_factor):
+    """Generate data for one scale factor and run the pipeline on it"""
+    label, data_dir, db_path, gen_args = prepare_run_dir(
+        args.work_dir, scale_factor, args.format, args.reuse_data, not args.no_cache
+    )
+    loads = [args.load_mode] + ["incremental"] * bool(args.incremental_days)
+    delta_args = gen_args + ["--incremental-days", str(args.incremental_days)]
+
+    # CURRENT_DATE() is part of the result (aging snapshot), so is the run date.
+    # The key covers the data before the delta extract: the delta is generated
+    # from it and the generator arguments (the seed is in the generator code).
+    cache = None if args.no_cache else artifact_cache.ArtifactCache(args.cache_dir)
+    cache_key = artifact_cache.fingerprint({
+        "stages": stages, "load_modes": loads, "format": args.format,
+        "delta": {"scale_factor": scale_factor, "days": args.incremental_days},
+        "run_date": date.today().isoformat(),
+    }, [data_dir] + CACHE_CODE_FILES)
+    manifest = cache.restore(cache_key, os.path.dirname(db_path), link=False) if cache else None
+    if manifest:
+        # Leave the extracts as an uncached run does: with the delta it loaded
+        if args.incremental_days:
+            gen.main(delta_args)
+        result = manifest["result"]
+        for run in result["runs"]:
+            print_metrics(f"{label} - {run['load_mode']} load, cached result ({cache_key[:12]})",
+                          run["stages"])
+        return result
+
+    result = {"scale_factor": scale_factor, "runs": []}
+    con = duckdb.connect(db_path)
+    try:
+        for run_index, load_mode in enumerate(loads):
+            if run_index:
+                gen.main(delta_args)
+
+            start = time.perf_counter()
+            landing_counts = load_landing_tables(con, data_dir, args.format)
+            load_time = time.perf_counter() - start
+
+            metrics = run_stages(con, stages, {"ap.load_mode": load_mode})
+            title = f"{label} - {load_mode} load ({landing_counts['bseg']:,} BSEG lines)"
+            print_metrics(title, metrics)
+
+            result["runs"].append({
+                "load_mode": load_mode,
+                "landing_rows": landing_counts,
+                "landing_load_time_s": round(load_time, 3),
+                "stages": metrics,
+                "output_rows": table_counts(con, OUTPUT_TABLES),
+            })
+    finally:
+        con.close()
+
+    if cache:
+        cache.store(cache_key, os.path.dirname(db_path), [DATABASE_FILE], kind="pipeline", result=result)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the AP notebook SQL on DuckDB against generated sample data"
+    )
+    parser.add_argument("--source", choices=["notebook", "sql"], default="notebook",
+                        help="Run the notebook's %%%%sql cells or sql/create_ap_fact_table.sql "
+                             "(default: notebook)")
+    parser.add_argument("--scale-factor", "--sf", type=float, nargs="+", default=[None],
+                        help="One or more scale factors (default: demo dataset)")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv",
+                        help="Sample data format (default: csv)")
+    parser.add_argument("--load-mode", choices=["incremental", "full"], default="incremental",
+                        help="ap.load_mode of the first run (default: incremental, "
+                             "which is a full load on an empty database)")
+    parser.add_argument("--incremental-days", type=int, default=None,
+                        help="Then generate a delta extract of N days and run an incremental load")
+    parser.add_argument("--work-dir", default=WORK_DIR,
+                        help=f"Data and database per scale factor (default: {WORK_DIR})")
+    parser.add_argument("--reuse-data", action="store_true",
+                        help="Use the data already in the work directory instead of generating it")
+    parser.add_argument("--output", default=None,
+                        help="Write the metrics as JSON to this file")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always generate and run, do not restore or store results in the cache")
+    parser.add_argument("--cache-dir", default=artifact_cache.CACHE_DIR,
+                        help=f"Artifact cache directory (default: {artifact_cache.CACHE_DIR})")
+
+    args = parser.parse_args(argv)
+    if args.incremental_days is not None and args.incremental_days < 1:
+        parser.error("--incremental-days must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    cells = notebook_sql_cells() if args.source == "notebook" else script_sql_cells()
+    stages = split_stages(cells)
+
+    print("="*70)
+    print("AP Pipeline - Local DuckDB Run")
+    print("="*70)
+    print(f"  Source: {args.source} ({len(stages)} stages)")
+    print(f"  Work directory: {args.work_dir}")
+
+    results = [run_scale_factor(args, stages, sf) for sf in args.scale_factor]
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"source": args.source, "format": args.format, "results": results}, f, indent=2)
+        print(f"\nMetrics written to {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,597 @@
+#!/usr/bin/env python3
+"""
+SAP field parsers and the generated Stage 1 (staging) projection
+
+SAP extracts deliver every field as text: DATS dates as YYYYMMDD, amounts
+with thousands separators and a trailing minus (packed decimals, "1,234.50-"),
+blanks for missing values. Each parser exists in three forms:
+
+- Spark SQL expression (sql_*): used by the staging SQL, evaluated by
+  Spark's code generation (no Python in the executors)
+- PySpark Column (spark_column): the same expression for DataFrame code
+- Arrow-vectorized (arrow_*): for pandas/Arrow code such as the sample data
+  generator, and as pandas UDFs (pandas_udfs) where SQL is not an option
+
+SAP_SCHEMAS is the schema registry: the landing type of every field of
+BKPF, BSEG and LFA1. The Dataflow and the SapIngestion notebook type the
+extracts with it (and write rows that do not parse to sap_ingest_rejects),
+the generator writes its Parquet output with it, and the local runner
+(ingest_extracts.py) lands its tables with it.
+
+STAGING_COLUMNS is the column spec of Stage 1. The SELECT list of
+ap_staging_changes in sql/create_ap_fact_table.sql and in the 0_DataCleaning
+notebook is generated from it, and the vendor attributes of dim_vendor
+from VENDOR_COLUMNS; the schemas in the Dataflow's mashup.pq and
+the landing SQL of the SapIngestion notebook are generated from SAP_SCHEMAS
+(all between GENERATED markers).
+
+Usage:
+    python3 sap_fields.py --check    # exit 1 if a generated file is out of date
+    python3 sap_fields.py --write    # regenerate the SELECT lists and schemas
+"""
+
+import argparse
+import os
+import sys
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SQL_SCRIPT_PATH = os.path.join(REPO_ROOT, "sql", "create_ap_fact_table.sql")
+NOTEBOOK_PATH = os.path.join(
+    REPO_ROOT, "fabric-workspace", "0_DataCleaning.Notebook", "notebook-content.py"
+)
+MASHUP_PATH = os.path.join(REPO_ROOT, "fabric-workspace", "DataIngestion.Dataflow", "mashup.pq")
+INGESTION_NOTEBOOK_PATH = os.path.join(
+    REPO_ROOT, "fabric-workspace", "SapIngestion.Notebook", "notebook-content.py"
+)
+
+BEGIN_MARKER = "BEGIN GENERATED: {} (sample-data/scripts/{})"
+END_MARKER = "END GENERATED: {}"
+
+
+# ============================================================================
+# SPARK SQL EXPRESSIONS
+# ============================================================================
+
+def sql_text(col):
+    """Text kept as delivered (keys and codes keep their leading zeros)"""
+    return col
+
+
+def sql_blank_to_null(col):
+    """Text, blank (only spaces) -> NULL"""
+    return f"CASE WHEN TRIM({col}) = '' THEN NULL ELSE {col} END"
+
+
+def sql_date(col):
+    """DATS (YYYYMMDD) or ISO date text -> DATE, blank/invalid -> NULL"""
+    return "\n".join([
+        "TRY_CAST(",
+        "    CASE",
+        f"        WHEN {col} IS NULL OR TRIM({col}) = '' THEN NULL",
+        f"        WHEN LENGTH(TRIM({col})) = 8 THEN",
+        f"            CONCAT(SUBSTRING({col}, 1, 4), '-',",
+        f"                   SUBSTRING({col}, 5, 2), '-',",
+        f"                   SUBSTRING({col}, 7, 2))",
+        f"        ELSE {col}",
+        "    END AS DATE",
+        ")",
+    ])
+
+
+def _strip_separators(value):
+    return f"REPLACE(REPLACE({value}, ',', ''), ' ', '')"
+
+
+def sql_decimal(col, precision, scale, default=None):
+    """Amount text -> DECIMAL: drops thousands separators and blanks,
+    moves a trailing minus (SAP sign position) to the front;
+    blank -> default (or NULL)"""
+    blank = "NULL" if default is None else f"'{default}'"
+    trailing_minus = f"TRIM(TRAILING '-' FROM TRIM({col}))"
+    return "\n".join([
+        "TRY_CAST(",
+        "    CASE",
+        f"        WHEN {col} IS NULL OR TRIM({col}) = '' THEN {blank}",
+        f"        WHEN TRIM({col}) LIKE '%-' THEN CONCAT('-', {_strip_separators(trailing_minus)})",
+        f"        ELSE {_strip_separators(col)}",
+        f"    END AS DECIMAL({precision},{scale})",
+        ")",
+    ])
+
+
+def sql_int(col):
+    """NUMC/INT4 text -> INT, blank/invalid -> NULL (casts ignore surrounding blanks)"""
+    return f"TRY_CAST({col} AS INT)"
+
+
+def sql_landed(parser, col, precision=None, scale=None, default=None):
+    """A field the ingestion already typed: only the blank default and the
+    exact SQL type are applied (no parsing)"""
+    if parser == "date":
+        return col
+    if parser == "int":
+        return f"CAST({col} AS INT)"
+    value = col if default is None else f"COALESCE({col}, {default})"
+    return f"CAST({value} AS DECIMAL({precision},{scale}))"
+
+
+SQL_PARSERS = {
+    "text": sql_text,
+    "blank_to_null": sql_blank_to_null,
+    "date": sql_date,
+    "decimal": sql_decimal,
+    "int": sql_int,
+}
+
+
+def spark_column(parser, col, **options):
+    """The parser as a PySpark Column, e.g. spark_column("date", "bkpf.BUDAT")"""
+    from pyspark.sql import functions as F
+
+    return F.expr(SQL_PARSERS[parser](col, **options))
+
+
+# ============================================================================
+# ARROW-VECTORIZED PARSERS
+# ============================================================================
+
+def arrow_blank_to_null(array):
+    """Text, blank (only spaces) -> null"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    array = array.cast(pa.string())
+    return pc.if_else(pc.equal(pc.utf8_trim_whitespace(array), ""), None, array)
+
+
+def arrow_date(array):
+    """DATS (YYYYMMDD) or ISO date text -> date32, blank/invalid -> null"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    value = pc.utf8_trim_whitespace(arrow_blank_to_null(array))
+    dats = pc.strptime(value, format="%Y%m%d", unit="s", error_is_null=True)
+    iso = pc.strptime(value, format="%Y-%m-%d", unit="s", error_is_null=True)
+    return pc.if_else(pc.equal(pc.utf8_length(value), 8), dats, iso).cast(pa.date32())
+
+
+def arrow_decimal(array, precision, scale, default=None):
+    """Amount text -> decimal128, same rules as sql_decimal"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    value = pc.replace_substring(pc.replace_substring(array.cast(pa.string()), ",", ""), " ", "")
+    negative = pc.ends_with(value, "-")
+    value = pc.if_else(
+        negative, pc.binary_join_element_wise("-", pc.utf8_slice_codeunits(value, 0, -1), ""), value
+    )
+    value = pc.if_else(pc.equal(value, ""), default, value)
+    if default is not None:
+        value = pc.fill_null(value, default)
+    valid = pc.match_substring_regex(value, r"^[+-]?(\d+\.?\d*|\.\d+)$")
+    value = pc.if_else(valid, value, None).cast(pa.decimal128(38, 10))
+    # Round like the SQL cast instead of failing on extra decimals
+    return pc.round(value, scale, round_mode="half_up").cast(pa.decimal128(precision, scale))
+
+
+def arrow_int(array):
+    """NUMC/INT4 text -> int32, blank/invalid -> null"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    value = pc.utf8_trim_whitespace(arrow_blank_to_null(array))
+    value = pc.if_else(pc.match_substring_regex(value, r"^[+-]?\d+$"), value, None)
+    return value.cast(pa.int32())
+
+
+ARROW_PARSERS = {
+    "text": lambda array: array,
+    "blank_to_null": arrow_blank_to_null,
+    "date": arrow_date,
+    "decimal": arrow_decimal,
+    "int": arrow_int,
+}
+
+
+def pandas_udfs():
+    """Arrow-vectorized pandas UDFs of the parsers, for PySpark code paths
+    that cannot use the SQL expressions: {name: udf}"""
+    import pyarrow as pa
+    from pyspark.sql.functions import pandas_udf
+
+    def wrap(parser, return_type, **options):
+        @pandas_udf(return_type)
+        def parse(values):
+            return ARROW_PARSERS[parser](pa.array(values, pa.string()), **options).to_pandas()
+        return parse
+
+    return {
+        "sap_blank_to_null": wrap("blank_to_null", "string"),
+        "sap_date": wrap("date", "date"),
+        "sap_amount": wrap("decimal", "decimal(15,2)", precision=15, scale=2, default="0"),
+        "sap_int": wrap("int", "int"),
+    }
+
+
+# ============================================================================
+# SCHEMA REGISTRY
+# ============================================================================
+
+# Landing type of every extract field: text, date, int or decimal(p,s).
+# Keys and codes stay text to keep leading zeros (GJAHR too, it is part of
+# the document key); DATS fields land as dates, amounts as decimals and day
+# counts as integers. Blank values land as NULL.
+SAP_SCHEMAS = {
+    "BKPF": [
+        ("MANDT", "text"), ("BUKRS", "text"), ("BELNR", "text"), ("GJAHR", "text"),
+        ("BLART", "text"), ("BLDAT", "date"), ("BUDAT", "date"), ("CPUDT", "date"),
+        ("WAERS", "text"), ("KURSF", "decimal(9,5)"), ("USNAM", "text"), ("TCODE", "text"),
+        ("BKTXT", "text"), ("XBLNR", "text"), ("BSTAT", "text"), ("STBLG", "text"),
+        ("STJAH", "text"),
+    ],
+    "BSEG": [
+        ("MANDT", "text"), ("BUKRS", "text"), ("BELNR", "text"), ("GJAHR", "text"),
+        ("BUZEI", "text"), ("KOART", "text"), ("SHKZG", "text"), ("DMBTR", "decimal(15,2)"),
+        ("WRBTR", "decimal(15,2)"), ("PSWSL", "text"), ("MWSTS", "decimal(15,2)"),
+        ("HKONT", "text"), ("KOSTL", "text"), ("LIFNR", "text"), ("ZFBDT", "date"),
+        ("ZBD1T", "int"), ("ZBD1P", "decimal(5,3)"), ("ZBD2T", "int"), ("ZBD3T", "int"),
+        ("ZTERM", "text"), ("SKFBT", "decimal(15,2)"), ("SGTXT", "text"), ("ZUONR", "text"),
+    ],
+    "LFA1": [
+        ("MANDT", "text"), ("LIFNR", "text"), ("NAME1", "text"), ("NAME2", "text"),
+        ("SORTL", "text"), ("STRAS", "text"), ("ORT01", "text"), ("PSTLZ", "text"),
+        ("LAND1", "text"), ("REGIO", "text"), ("STCD1", "text"), ("STCD2", "text"),
+        ("STCEG", "text"), ("KTOKK", "text"), ("BRSCH", "text"), ("LOEVM", "text"),
+        ("SPERR", "text"), ("TELF1", "text"), ("SMTP_ADDR", "text"),
+    ],
+}
+
+REJECTS_TABLE = "sap_ingest_rejects"
+
+
+def landing_type(table, field):
+    """Landing type of TABLE.FIELD (text for fields not in the registry)"""
+    return dict(SAP_SCHEMAS[table.upper()]).get(field, "text")
+
+
+def _parser_options(field_type):
+    """Parser name and options for a landing type"""
+    if field_type.startswith("decimal"):
+        precision, scale = (int(x) for x in field_type[8:-1].split(","))
+        return "decimal", {"precision": precision, "scale": scale}
+    return field_type, {}
+
+
+def arrow_schema(table):
+    """pyarrow schema of a landing table"""
+    import pyarrow as pa
+
+    types = {"text": pa.string(), "date": pa.date32(), "int": pa.int32()}
+    fields = []
+    for field, field_type in SAP_SCHEMAS[table.upper()]:
+        parser, options = _parser_options(field_type)
+        arrow_type = types.get(parser) or pa.decimal128(options["precision"], options["scale"])
+        fields.append(pa.field(field, arrow_type))
+    return pa.schema(fields)
+
+
+def parse_table(table, text_table):
+    """Type an all-text Arrow table with the landing schema of table
+
+    Rows with a value that does not parse are left out of the typed table.
+    Returns (typed table, rejects): rejects is a list of dicts with
+    source_table, record (the raw row as JSON) and rejected_fields.
+    """
+    import json
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns, failed = {}, {}
+    for name in text_table.column_names:
+        column = text_table[name].combine_chunks().cast(pa.string())
+        parser, options = _parser_options(landing_type(table, name))
+        if parser == "text":
+            columns[name] = column
+            continue
+        parsed = ARROW_PARSERS[parser](column, **options)
+        blank = pc.is_null(arrow_blank_to_null(column))
+        failed[name] = pc.and_(pc.is_null(parsed), pc.invert(blank))
+        columns[name] = parsed
+
+    rejected = pa.array([False] * text_table.num_rows, pa.bool_())
+    for mask in failed.values():
+        rejected = pc.or_(rejected, mask)
+
+    rejects = []
+    if pc.any(rejected).as_py():
+        rows = text_table.filter(rejected).to_pylist()
+        masks = {name: mask.filter(rejected).to_pylist() for name, mask in failed.items()}
+        for index, row in enumerate(rows):
+            rejects.append({
+                "source_table": table.upper(),
+                "record": json.dumps(row, ensure_ascii=False),
+                "rejected_fields": ",".join(name for name, mask in masks.items() if mask[index]),
+            })
+
+    typed = pa.table(columns).filter(pc.invert(rejected))
+    return typed, rejects
+
+
+def _one_line(expression):
+    line = " ".join(part.strip() for part in expression.split("\n"))
+    return line.replace("( ", "(").replace(" )", ")")
+
+
+def landing_columns(table):
+    """SELECT list that types an all-text extract of table with the registry
+
+    Plain SQL that runs on Spark and DuckDB. Text fields keep '' for blanks
+    (as the Dataflow does), typed fields get NULL.
+    """
+    columns = []
+    for field, field_type in SAP_SCHEMAS[table.upper()]:
+        parser, options = _parser_options(field_type)
+        if parser == "text":
+            columns.append(f"COALESCE({field}, '') AS {field}")
+        else:
+            columns.append(f"{_one_line(SQL_PARSERS[parser](field, **options))} AS {field}")
+    return columns
+
+
+def landing_rejected_fields(table):
+    """SQL expression listing the fields of an extract row that do not parse
+    ('' for a valid row)"""
+    checks = []
+    for field, field_type in SAP_SCHEMAS[table.upper()]:
+        parser, options = _parser_options(field_type)
+        if parser == "text":
+            continue
+        typed = _one_line(SQL_PARSERS[parser](field, **options))
+        checks.append(f"CASE WHEN TRIM({field}) <> '' AND {typed} IS NULL THEN '{field}' END")
+    return f"CONCAT_WS(',', {', '.join(checks)})" if checks else "''"
+
+
+def notebook_landing_lines():
+    """Landing SQL of every table as Python constants (SapIngestion notebook)"""
+    out = ["LANDING_COLUMNS = {"]
+    for table in SAP_SCHEMAS:
+        out.append(f'    "{table.lower()}": [')
+        out.extend(f'        "{column}",' for column in landing_columns(table))
+        out.append("    ],")
+    out.append("}")
+    out.append("REJECTED_FIELDS = {")
+    out.extend(f'    "{table.lower()}": "{landing_rejected_fields(table)}",' for table in SAP_SCHEMAS)
+    out.append("}")
+    return out
+
+
+def m_schema_lines():
+    """SAP_SCHEMAS as the Power Query record SapSchemas (mashup.pq)"""
+    out = ["shared SapSchemas = ["]
+    for index, (table, fields) in enumerate(SAP_SCHEMAS.items()):
+        out.append(f"  {table} = {{")
+        for field_index, (field, field_type) in enumerate(fields):
+            comma = "," if field_index < len(fields) - 1 else ""
+            out.append(f'    {{"{field}", "{field_type}"}}{comma}')
+        out.append("  }," if index < len(SAP_SCHEMAS) - 1 else "  }")
+    out.append("];")
+    return out
+
+
+# ============================================================================
+# STAGING COLUMN SPEC
+# ============================================================================
+
+def _amount(col):
+    return ("decimal", col, {"precision": 15, "scale": 2, "default": "0"})
+
+
+# (comment, [(target column, parser, source column, options), ...])
+STAGING_COLUMNS = [
+    ("Document Keys (Text to keep leading zeros)", [
+        ("mandt", "text", "bseg.MANDT", {}),
+        ("company_code", "text", "bseg.BUKRS", {}),
+        ("document_number", "text", "bseg.BELNR", {}),
+        ("fiscal_year", "int", "bseg.GJAHR", {}),
+        ("line_item_number", "text", "bseg.BUZEI", {}),
+    ]),
+    ("Document Header Information", [
+        ("document_type_code", "text", "bkpf.BLART", {}),
+        ("document_date", "date", "bkpf.BLDAT", {}),
+        ("posting_date", "date", "bkpf.BUDAT", {}),
+        ("currency", "text", "bkpf.WAERS", {}),
+        ("exchange_rate", "decimal", "bkpf.KURSF", {"precision": 9, "scale": 5, "default": "1.00000"}),
+        ("user_name", "text", "bkpf.USNAM", {}),
+        ("document_header_text", "text", "bkpf.BKTXT", {}),
+        ("reference_document", "text", "bkpf.XBLNR", {}),
+        ("transaction_code", "text", "bkpf.TCODE", {}),
+        ("entry_date", "date", "bkpf.CPUDT", {}),
+    ]),
+    ("Status fields", [
+        ("document_status", "blank_to_null", "bkpf.BSTAT", {}),
+        ("reversal_document", "blank_to_null", "bkpf.STBLG", {}),
+        ("reversal_fiscal_year", "blank_to_null", "bkpf.STJAH", {}),
+    ]),
+    ("Line Item Information", [
+        ("debit_credit_indicator", "text", "bseg.SHKZG", {}),
+        ("account_type", "text", "bseg.KOART", {}),
+        ("vendor_number", "blank_to_null", "bseg.LIFNR", {}),
+        ("gl_account", "text", "bseg.HKONT", {}),
+        ("amount_local_currency",) + _amount("bseg.DMBTR"),
+        ("amount_document_currency",) + _amount("bseg.WRBTR"),
+        ("document_currency_key", "blank_to_null", "bseg.PSWSL", {}),
+        ("tax_amount",) + _amount("bseg.MWSTS"),
+        ("cost_center", "blank_to_null", "bseg.KOSTL", {}),
+        ("assignment_reference", "text", "bseg.ZUONR", {}),
+        ("line_item_text", "text", "bseg.SGTXT", {}),
+    ]),
+    ("Payment Terms", [
+        ("baseline_payment_date", "date", "bseg.ZFBDT", {}),
+        ("cash_discount_days_1", "int", "bseg.ZBD1T", {}),
+        ("cash_discount_percent_1", "decimal", "bseg.ZBD1P", {"precision": 5, "scale": 3}),
+        ("cash_discount_days_2", "int", "bseg.ZBD2T", {}),
+        ("net_payment_terms_days", "int", "bseg.ZBD3T", {}),
+        ("payment_terms_code", "blank_to_null", "bseg.ZTERM", {}),
+        ("cash_discount_base_amount",) + _amount("bseg.SKFBT"),
+    ]),
+]
+
+# Vendor master attributes: columns of dim_vendor (not of the fact table)
+VENDOR_COLUMNS = [
+    ("vendor_name", "blank_to_null", "lfa1.NAME1", {}),
+    ("vendor_name_2", "blank_to_null", "lfa1.NAME2", {}),
+    ("vendor_sort_field", "blank_to_null", "lfa1.SORTL", {}),
+    ("vendor_city", "blank_to_null", "lfa1.ORT01", {}),
+    ("vendor_country", "blank_to_null", "lfa1.LAND1", {}),
+    ("vendor_region", "blank_to_null", "lfa1.REGIO", {}),
+    ("vendor_postal_code", "blank_to_null", "lfa1.PSTLZ", {}),
+    ("vendor_street", "blank_to_null", "lfa1.STRAS", {}),
+    ("vendor_tax_number_1", "blank_to_null", "lfa1.STCD1", {}),
+    ("vendor_tax_number_2", "blank_to_null", "lfa1.STCD2", {}),
+    ("vendor_vat_number", "blank_to_null", "lfa1.STCEG", {}),
+    ("vendor_account_group", "blank_to_null", "lfa1.KTOKK", {}),
+    ("vendor_industry", "blank_to_null", "lfa1.BRSCH", {}),
+    ("vendor_deletion_flag", "blank_to_null", "lfa1.LOEVM", {}),
+    ("vendor_posting_block", "blank_to_null", "lfa1.SPERR", {}),
+]
+
+# Columns derived from the join itself
+STAGING_FLAGS = [
+    ("Quality check flag", [
+        ("is_vendor_not_in_master", "CASE WHEN lfa1.LIFNR IS NULL THEN 1 ELSE 0 END"),
+    ]),
+]
+
+# The notebook's fact table (and the semantic model on top of it) has fewer
+# columns and two older names
+NOTEBOOK_EXCLUDED = {
+    "exchange_rate", "document_currency_key", "cost_center", "cash_discount_percent_1",
+}
+NOTEBOOK_RENAMED = {
+    "payment_terms_code": "payment_terms",
+    "cash_discount_base_amount": "cash_discount_amount",
+}
+
+
+def _column_expression(parser, source, options):
+    table, field = source.split(".")
+    if landing_type(table, field) != "text":
+        return sql_landed(parser, source, **options)
+    return SQL_PARSERS[parser](source, **options)
+
+
+def vendor_select_list():
+    """Lines of the generated dim_vendor attribute list (without indentation)"""
+    expressions = [f"{_column_expression(parser, source, options)} AS {target}"
+                   for target, parser, source, options in VENDOR_COLUMNS]
+    return [expression + "," for expression in expressions[:-1]] + expressions[-1:]
+
+
+def staging_select_list(variant="sql"):
+    """Lines of the generated SELECT list (without indentation)"""
+    sections = []
+    for comment, columns in STAGING_COLUMNS:
+        expressions = []
+        for target, parser, source, options in columns:
+            if variant == "notebook":
+                if target in NOTEBOOK_EXCLUDED:
+                    continue
+                target = NOTEBOOK_RENAMED.get(target, target)
+            expressions.append(f"{_column_expression(parser, source, options)} AS {target}")
+        sections.append((comment, expressions))
+    for comment, columns in STAGING_FLAGS:
+        sections.append((comment, [f"{expression} AS {target}" for target, expression in columns]))
+
+    out = []
+    sections = [(comment, expressions) for comment, expressions in sections if expressions]
+    for index, (comment, expressions) in enumerate(sections):
+        last_section = index == len(sections) - 1
+        out.append(f"-- {comment}")
+        for expression_index, expression in enumerate(expressions):
+            last = last_section and expression_index == len(expressions) - 1
+            multi_line = "\n" in expression
+            # Multi-line CASE blocks are set apart by blank lines
+            if multi_line and out[-1] != "" and not out[-1].startswith("-- "):
+                out.append("")
+            out.extend((expression if last else expression + ",").split("\n"))
+            if multi_line and not last and expression_index < len(expressions) - 1:
+                out.append("")
+        if not last_section:
+            out.append("")
+    return out
+
+
+# ============================================================================
+# CODE GENERATION
+# ============================================================================
+
+def render(content, name, lines, prefix="", generator="sap_fields.py"):
+    """content with the lines between the GENERATED markers of name replaced"""
+    content_lines = content.split("\n")
+    begin_marker, end_marker = BEGIN_MARKER.format(name, generator), END_MARKER.format(name)
+    begin = [i for i, line in enumerate(content_lines) if line.endswith(begin_marker)]
+    end = [i for i, line in enumerate(content_lines) if line.endswith(end_marker)]
+    if len(begin) != 1 or len(end) != 1 or end[0] < begin[0]:
+        raise ValueError(f"Expected exactly one pair of '{name}' GENERATED markers")
+
+    indent = content_lines[begin[0]][len(prefix):]
+    indent = indent[:len(indent) - len(indent.lstrip())]
+    generated = [
+        (prefix + indent + line) if line else prefix.rstrip() + (" " if prefix else "")
+        for line in lines
+    ]
+    return "\n".join(content_lines[:begin[0] + 1] + generated + content_lines[end[0]:])
+
+
+# (file, marker name, generated lines, line prefix)
+TARGETS = [
+    (SQL_SCRIPT_PATH, "staging columns", lambda: staging_select_list("sql"), ""),
+    (NOTEBOOK_PATH, "staging columns", lambda: staging_select_list("notebook"), "# MAGIC "),
+    (SQL_SCRIPT_PATH, "vendor columns", vendor_select_list, ""),
+    (NOTEBOOK_PATH, "vendor columns", vendor_select_list, "# MAGIC "),
+    (MASHUP_PATH, "SAP schemas", m_schema_lines, ""),
+    (INGESTION_NOTEBOOK_PATH, "landing SQL", notebook_landing_lines, ""),
+]
+
+
+def update_targets(targets, write=False, generator="sap_fields.py"):
+    """Render every (file, marker name, lines, prefix) target; returns the stale files
+
+    write=True rewrites them.
+    """
+    stale = []
+    for path, name, lines, prefix in targets:
+        with open(path, encoding="utf-8", newline="") as f:
+            content = f.read()
+        # Keep the file's line endings (the Dataflow files use CRLF)
+        newline = "\r\n" if "\r\n" in content else "\n"
+        rendered = render(content.replace(newline, "\n"), name, lines(), prefix, generator)
+        rendered = rendered.replace("\n", newline)
+        if rendered == content:
+            continue
+        stale.append(os.path.relpath(path, REPO_ROOT))
+        if write:
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                f.write(rendered)
+    return list(dict.fromkeys(stale))
+
+
+def main(argv=None, targets=TARGETS, generator="sap_fields.py",
+         description="Generate the staging SELECT lists and the Dataflow schemas"):
+    parser = argparse.ArgumentParser(description=description)
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--check", action="store_true", help="Exit 1 if a file is out of date")
+    mode.add_argument("--write", action="store_true", help="Regenerate the files")
+    args = parser.parse_args(argv)
+
+    stale = update_targets(targets, args.write, generator)
+    for path in stale:
+        print(f"{'Regenerated' if args.write else 'Out of date'}: {path}")
+    if not stale:
+        print("Generated files are up to date")
+    return 1 if stale and args.check else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,19 +3,143 @@
 -- Accounts Payable Fact Table Transformation
 -- TWO-STAGE APPROACH
 -- =====================================================
--- Stage 1: Data Type Casting (Staging Table)
+-- Stage 1: Data Type Casting (Staging View)
+-- Reconciliation: Document balance, lines vs. headers
+-- Dimensions: Vendor, Document Type, Date (surrogate keys)
 -- Stage 2: Business Logic Transformation (Final Fact Table)
 -- =====================================================
+-- Load modes (ap.load_mode):
+--   incremental: MERGE only new/changed documents (default)
+--   full:        rebuild the fact table from all of BSEG/BKPF
+-- =====================================================
+
+SET ap.load_mode = incremental;
 
 -- =====================================================
--- STAGE 1: Data Type Casting Layer
+-- CHANGE DETECTION
 -- =====================================================
--- Purpose: Cast all string columns to proper data types
--- Handles various date formats and null/empty values
+-- Purpose: Limit the refresh to documents entered since
+-- the last run, reversed documents and documents of
+-- vendors added to or removed from the master data
 -- =====================================================
 
-CREATE OR REPLACE TABLE accounts_payable_staging AS
+CREATE TABLE IF NOT EXISTS ap_load_watermark (
+    table_name STRING,
+    last_entry_date STRING,  -- BKPF.CPUDT (YYYYMMDD) of the last load
+    updated_at TIMESTAMP
+) USING DELTA;
+
+CREATE TABLE IF NOT EXISTS ap_vendor_snapshot (
+    MANDT STRING,
+    LIFNR STRING,
+    vendor_hash STRING
+) USING DELTA;
+
+-- No watermark yet (first run) behaves like a full load.
+-- The last 3 entry days are read again to pick up late
+-- postings; the MERGE makes reprocessing them idempotent.
+CREATE OR REPLACE TEMP VIEW ap_load_scope AS
+SELECT
+    '${ap.load_mode}' = 'full' OR w.last_entry_date IS NULL AS is_full_load,
+    DATE_SUB(TO_DATE(w.last_entry_date, 'yyyyMMdd'), 3) AS since_entry_date
+FROM (SELECT 'accounts_payable_staging' AS table_name) t
+LEFT JOIN ap_load_watermark w
+    ON w.table_name = t.table_name;
+
+-- New documents plus the originals of new reversals:
+-- FB08 fills STBLG/STJAH on the reversed header (same key,
+-- old CPUDT), so the new reversal points us to it
+CREATE OR REPLACE TEMP VIEW ap_changed_documents AS
+SELECT DISTINCT MANDT, BUKRS, BELNR, GJAHR
+FROM (
+    SELECT bkpf.MANDT, bkpf.BUKRS, bkpf.BELNR, bkpf.GJAHR
+    FROM bkpf
+    CROSS JOIN ap_load_scope s
+    WHERE s.is_full_load
+        OR bkpf.CPUDT >= s.since_entry_date
+
+    UNION ALL
+
+    SELECT bkpf.MANDT, bkpf.BUKRS, bkpf.STBLG AS BELNR, bkpf.STJAH AS GJAHR
+    FROM bkpf
+    CROSS JOIN ap_load_scope s
+    WHERE NOT s.is_full_load
+        AND bkpf.CPUDT >= s.since_entry_date
+        AND TRIM(bkpf.STBLG) <> ''
+);
+
+-- Vendor master changes: compare LFA1 with the snapshot of
+-- the last load (new, changed and deleted vendors)
+CREATE OR REPLACE TEMP VIEW ap_vendor_hash AS
 SELECT
+    MANDT,
+    LIFNR,
+    SHA2(TO_JSON(ARRAY(
+        NAME1, NAME2, SORTL, ORT01, LAND1,
+        REGIO, PSTLZ, STRAS, STCD1, STCD2,
+        STCEG, KTOKK, BRSCH, LOEVM, SPERR
+    )), 256) AS vendor_hash
+FROM lfa1;
+
+CREATE OR REPLACE TEMP VIEW ap_changed_vendors AS
+SELECT
+    COALESCE(cur.MANDT, prev.MANDT) AS MANDT,
+    COALESCE(cur.LIFNR, prev.LIFNR) AS LIFNR,
+    cur.vendor_hash IS NULL OR prev.vendor_hash IS NULL AS is_added_or_removed
+FROM ap_vendor_hash cur
+FULL OUTER JOIN ap_vendor_snapshot prev
+    ON cur.MANDT = prev.MANDT
+    AND cur.LIFNR = prev.LIFNR
+CROSS JOIN ap_load_scope s
+WHERE NOT s.is_full_load
+    AND (cur.vendor_hash IS NULL
+         OR prev.vendor_hash IS NULL
+         OR cur.vendor_hash <> prev.vendor_hash);
+
+-- BSEG lines to refresh (each line at most once). Only
+-- vendors added to or removed from LFA1 change fact rows
+-- (is_vendor_not_in_master); other master data changes
+-- are written to dim_vendor alone
+CREATE OR REPLACE TEMP VIEW bseg_changes AS
+SELECT bseg.*
+FROM bseg
+LEFT SEMI JOIN ap_changed_documents d
+    ON bseg.MANDT = d.MANDT
+    AND bseg.BUKRS = d.BUKRS
+    AND bseg.BELNR = d.BELNR
+    AND bseg.GJAHR = d.GJAHR
+
+UNION ALL
+
+SELECT bseg.*
+FROM bseg
+LEFT SEMI JOIN ap_changed_vendors v
+    ON bseg.MANDT = v.MANDT
+    AND bseg.LIFNR = v.LIFNR
+    AND v.is_added_or_removed
+LEFT ANTI JOIN ap_changed_documents d
+    ON bseg.MANDT = d.MANDT
+    AND bseg.BUKRS = d.BUKRS
+    AND bseg.BELNR = d.BELNR
+    AND bseg.GJAHR = d.GJAHR;
+
+
+-- =====================================================
+-- STAGE 1: Data Type Casting Layer
+-- =====================================================
+-- Purpose: Clean and name the landing columns. Dates,
+-- amounts and day counts land typed (schema registry
+-- in sap_fields.py); only defaults and exact types are
+-- applied here, text fields are cleaned
+-- Joins: LFA1 (vendor master, small) is broadcast, so
+-- only BSEG and BKPF are shuffled on the document key;
+-- adaptive execution splits skewed document keys and
+-- broadcasts the changed lines of incremental runs
+-- =====================================================
+
+CREATE OR REPLACE TEMP VIEW ap_staging_changes AS
+SELECT /*+ BROADCAST(lfa1) */
+    -- BEGIN GENERATED: staging columns (sample-data/scripts/sap_fields.py)
     -- Document Keys (Text to keep leading zeros)
     bseg.MANDT AS mandt,
     bseg.BUKRS AS company_code,
@@ -25,54 +149,15 @@ SELECT
 
     -- Document Header Information
     bkpf.BLART AS document_type_code,
-
-    -- Dates: Use TRY_CAST with multiple fallback formats
-    TRY_CAST(
-        CASE
-            WHEN bkpf.BLDAT IS NULL OR TRIM(bkpf.BLDAT) = '' THEN NULL
-            WHEN LENGTH(TRIM(bkpf.BLDAT)) = 8 THEN
-                CONCAT(SUBSTRING(bkpf.BLDAT, 1, 4), '-',
-                       SUBSTRING(bkpf.BLDAT, 5, 2), '-',
-                       SUBSTRING(bkpf.BLDAT, 7, 2))
-            ELSE bkpf.BLDAT
-        END AS DATE
-    ) AS document_date,
-
-    TRY_CAST(
-        CASE
-            WHEN bkpf.BUDAT IS NULL OR TRIM(bkpf.BUDAT) = '' THEN NULL
-            WHEN LENGTH(TRIM(bkpf.BUDAT)) = 8 THEN
-                CONCAT(SUBSTRING(bkpf.BUDAT, 1, 4), '-',
-                       SUBSTRING(bkpf.BUDAT, 5, 2), '-',
-                       SUBSTRING(bkpf.BUDAT, 7, 2))
-            ELSE bkpf.BUDAT
-        END AS DATE
-    ) AS posting_date,
-
-    -- Text fields
+    bkpf.BLDAT AS document_date,
+    bkpf.BUDAT AS posting_date,
     bkpf.WAERS AS currency,
-    TRY_CAST(
-        CASE
-            WHEN bkpf.KURSF IS NULL OR TRIM(bkpf.KURSF) = '' THEN '1.00000'
-            ELSE bkpf.KURSF
-        END AS DECIMAL(9,5)
-    ) AS exchange_rate,
+    CAST(COALESCE(bkpf.KURSF, 1.00000) AS DECIMAL(9,5)) AS exchange_rate,
     bkpf.USNAM AS user_name,
     bkpf.BKTXT AS document_header_text,
     bkpf.XBLNR AS reference_document,
     bkpf.TCODE AS transaction_code,
-
-    -- Entry date
-    TRY_CAST(
-        CASE
-            WHEN bkpf.CPUDT IS NULL OR TRIM(bkpf.CPUDT) = '' THEN NULL
-            WHEN LENGTH(TRIM(bkpf.CPUDT)) = 8 THEN
-                CONCAT(SUBSTRING(bkpf.CPUDT, 1, 4), '-',
-                       SUBSTRING(bkpf.CPUDT, 5, 2), '-',
-                       SUBSTRING(bkpf.CPUDT, 7, 2))
-            ELSE bkpf.CPUDT
-        END AS DATE
-    ) AS entry_date,
+    bkpf.CPUDT AS entry_date,
 
     -- Status fields
     CASE WHEN TRIM(bkpf.BSTAT) = '' THEN NULL ELSE bkpf.BSTAT END AS document_status,
@@ -84,85 +169,207 @@ SELECT
     bseg.KOART AS account_type,
     CASE WHEN TRIM(bseg.LIFNR) = '' THEN NULL ELSE bseg.LIFNR END AS vendor_number,
     bseg.HKONT AS gl_account,
-
-    -- Amounts: Handle various decimal formats
-    TRY_CAST(
-        CASE
-            WHEN bseg.DMBTR IS NULL OR TRIM(bseg.DMBTR) = '' THEN '0'
-            ELSE REPLACE(REPLACE(bseg.DMBTR, ',', ''), ' ', '')
-        END AS DECIMAL(15,2)
-    ) AS amount_local_currency,
-
-    TRY_CAST(
-        CASE
-            WHEN bseg.WRBTR IS NULL OR TRIM(bseg.WRBTR) = '' THEN '0'
-            ELSE REPLACE(REPLACE(bseg.WRBTR, ',', ''), ' ', '')
-        END AS DECIMAL(15,2)
-    ) AS amount_document_currency,
-
+    CAST(COALESCE(bseg.DMBTR, 0) AS DECIMAL(15,2)) AS amount_local_currency,
+    CAST(COALESCE(bseg.WRBTR, 0) AS DECIMAL(15,2)) AS amount_document_currency,
     CASE WHEN TRIM(bseg.PSWSL) = '' THEN NULL ELSE bseg.PSWSL END AS document_currency_key,
-
-    TRY_CAST(
-        CASE
-            WHEN bseg.MWSTS IS NULL OR TRIM(bseg.MWSTS) = '' THEN '0'
-            ELSE REPLACE(REPLACE(bseg.MWSTS, ',', ''), ' ', '')
-        END AS DECIMAL(15,2)
-    ) AS tax_amount,
-
+    CAST(COALESCE(bseg.MWSTS, 0) AS DECIMAL(15,2)) AS tax_amount,
     CASE WHEN TRIM(bseg.KOSTL) = '' THEN NULL ELSE bseg.KOSTL END AS cost_center,
     bseg.ZUONR AS assignment_reference,
     bseg.SGTXT AS line_item_text,
 
     -- Payment Terms
-    TRY_CAST(
-        CASE
-            WHEN bseg.ZFBDT IS NULL OR TRIM(bseg.ZFBDT) = '' THEN NULL
-            WHEN LENGTH(TRIM(bseg.ZFBDT)) = 8 THEN
-                CONCAT(SUBSTRING(bseg.ZFBDT, 1, 4), '-',
-                       SUBSTRING(bseg.ZFBDT, 5, 2), '-',
-                       SUBSTRING(bseg.ZFBDT, 7, 2))
-            ELSE bseg.ZFBDT
-        END AS DATE
-    ) AS baseline_payment_date,
-
-    TRY_CAST(
-        CASE
-            WHEN bseg.ZBD1T IS NULL OR TRIM(bseg.ZBD1T) = '' THEN NULL
-            ELSE bseg.ZBD1T
-        END AS INT
-    ) AS cash_discount_days_1,
+    bseg.ZFBDT AS baseline_payment_date,
+    CAST(bseg.ZBD1T AS INT) AS cash_discount_days_1,
+    CAST(bseg.ZBD1P AS DECIMAL(5,3)) AS cash_discount_percent_1,
+    CAST(bseg.ZBD2T AS INT) AS cash_discount_days_2,
+    CAST(bseg.ZBD3T AS INT) AS net_payment_terms_days,
+    CASE WHEN TRIM(bseg.ZTERM) = '' THEN NULL ELSE bseg.ZTERM END AS payment_terms_code,
+    CAST(COALESCE(bseg.SKFBT, 0) AS DECIMAL(15,2)) AS cash_discount_base_amount,
 
-    TRY_CAST(
-        CASE
-            WHEN bseg.ZBD1P IS NULL OR TRIM(bseg.ZBD1P) = '' THEN NULL
-            ELSE bseg.ZBD1P
-        END AS DECIMAL(5,3)
-    ) AS cash_discount_percent_1,
+    -- Quality check flag
+    CASE WHEN lfa1.LIFNR IS NULL THEN 1 ELSE 0 END AS is_vendor_not_in_master
+    -- END GENERATED: staging columns
 
-    TRY_CAST(
-        CASE
-            WHEN bseg.ZBD2T IS NULL OR TRIM(bseg.ZBD2T) = '' THEN NULL
-            ELSE bseg.ZBD2T
-        END AS INT
-    ) AS cash_discount_days_2,
+FROM
+    bseg_changes AS bseg
 
-    TRY_CAST(
-        CASE
-            WHEN bseg.ZBD3T IS NULL OR TRIM(bseg.ZBD3T) = '' THEN NULL
-            ELSE bseg.ZBD3T
-        END AS INT
-    ) AS net_payment_terms_days,
+INNER JOIN bkpf
+    ON bseg.MANDT = bkpf.MANDT
+    AND bseg.BUKRS = bkpf.BUKRS
+    AND bseg.BELNR = bkpf.BELNR
+    AND bseg.GJAHR = bkpf.GJAHR
 
-    CASE WHEN TRIM(bseg.ZTERM) = '' THEN NULL ELSE bseg.ZTERM END AS payment_terms_code,
+LEFT JOIN lfa1
+    ON bseg.MANDT = lfa1.MANDT
+    AND bseg.LIFNR = lfa1.LIFNR
+
+WHERE
+    bseg.KOART IN ('K', 'S');  -- K = Vendor, S = G/L Account
+
+-- Single pass: the cast layer stays a cached view and
+-- feeds Stage 2 directly, without a staging table write
+CACHE TABLE ap_staging_changes;
+
+-- Debug only: uncomment to persist the cast layer as
+-- accounts_payable_staging (identical fact table either way)
+-- CREATE TABLE IF NOT EXISTS accounts_payable_staging AS
+-- SELECT * FROM ap_staging_changes WHERE 1 = 0;
+--
+-- DELETE FROM accounts_payable_staging WHERE '${ap.load_mode}' = 'full';
+--
+-- MERGE INTO accounts_payable_staging AS target
+-- USING ap_staging_changes AS source
+-- ON target.mandt = source.mandt
+--     AND target.company_code = source.company_code
+--     AND target.document_number = source.document_number
+--     AND target.fiscal_year = source.fiscal_year
+--     AND target.line_item_number = source.line_item_number
+-- WHEN MATCHED THEN UPDATE SET *
+-- WHEN NOT MATCHED THEN INSERT *;
+
+-- Key-skew check (the notebook runs it on every load):
+-- documents with far more lines than average, or blank
+-- document numbers, are hot spots of the BSEG x BKPF join
+-- SELECT mandt, company_code, document_number, fiscal_year,
+--        COUNT(*) AS line_count
+-- FROM ap_staging_changes
+-- GROUP BY mandt, company_code, document_number, fiscal_year
+-- ORDER BY line_count DESC
+-- LIMIT 10;
+
+
+-- =====================================================
+-- DOCUMENT RECONCILIATION
+-- =====================================================
+-- Purpose: Check the documents of this run against SAP's
+-- posting rules: every document balances (debits S =
+-- credits H in local currency), every BSEG line has a
+-- BKPF header and every header has lines. Stage 1 drops
+-- lines without a header in its inner join, so they are
+-- only visible here
+-- Approach: BSEG lines and BKPF headers are unioned into
+-- one stream and grouped by document key in a single
+-- aggregation; there is no BSEG x BKPF join. A full load
+-- scans BSEG without any join, an incremental run reads
+-- the lines of the changed documents (semi join with the
+-- changed keys, as in bseg_changes). Lines of vendor
+-- master changes belong to unchanged documents and are
+-- not checked again
+-- Output: ap_document_reconciliation (1 row per document
+-- with an issue; documents that pass are removed)
+-- =====================================================
+
+CREATE TABLE IF NOT EXISTS ap_document_reconciliation (
+    mandt STRING,
+    company_code STRING,
+    document_number STRING,
+    fiscal_year INT,
+    issue STRING,  -- unbalanced, lines_without_header, header_without_lines
+    line_count BIGINT,
+    debit_amount DECIMAL(17,2),
+    credit_amount DECIMAL(17,2),
+    balance DECIMAL(17,2),  -- debit - credit
+    checked_at TIMESTAMP
+) USING DELTA;
+
+CREATE OR REPLACE TEMP VIEW ap_document_checks AS
+SELECT
+    mandt,
+    company_code,
+    document_number,
+    fiscal_year,
+    CASE
+        WHEN header_count = 0 THEN 'lines_without_header'
+        WHEN line_count = 0 THEN 'header_without_lines'
+        WHEN debit_amount <> credit_amount THEN 'unbalanced'
+    END AS issue,
+    line_count,
+    debit_amount,
+    credit_amount,
+    CAST(debit_amount - credit_amount AS DECIMAL(17,2)) AS balance,
+    CURRENT_TIMESTAMP() AS checked_at
+FROM (
+    SELECT
+        MANDT AS mandt,
+        BUKRS AS company_code,
+        BELNR AS document_number,
+        TRY_CAST(GJAHR AS INT) AS fiscal_year,
+        SUM(is_line) AS line_count,
+        SUM(1 - is_line) AS header_count,
+        CAST(SUM(CASE WHEN SHKZG = 'S' THEN DMBTR ELSE 0 END) AS DECIMAL(17,2)) AS debit_amount,
+        CAST(SUM(CASE WHEN SHKZG = 'H' THEN DMBTR ELSE 0 END) AS DECIMAL(17,2)) AS credit_amount
+    FROM (
+        SELECT bseg.MANDT, bseg.BUKRS, bseg.BELNR, bseg.GJAHR,
+               1 AS is_line, bseg.SHKZG, COALESCE(bseg.DMBTR, 0) AS DMBTR
+        FROM bseg
+        CROSS JOIN ap_load_scope s
+        WHERE s.is_full_load
+
+        UNION ALL
+
+        SELECT bseg.MANDT, bseg.BUKRS, bseg.BELNR, bseg.GJAHR,
+               1 AS is_line, bseg.SHKZG, COALESCE(bseg.DMBTR, 0) AS DMBTR
+        FROM bseg
+        LEFT SEMI JOIN ap_changed_documents d
+            ON bseg.MANDT = d.MANDT
+            AND bseg.BUKRS = d.BUKRS
+            AND bseg.BELNR = d.BELNR
+            AND bseg.GJAHR = d.GJAHR
+        CROSS JOIN ap_load_scope s
+        WHERE NOT s.is_full_load
+
+        UNION ALL
+
+        -- Headers of the changed documents (all of BKPF on a
+        -- full load), including the originals of reversals
+        SELECT bkpf.MANDT, bkpf.BUKRS, bkpf.BELNR, bkpf.GJAHR,
+               0 AS is_line, NULL AS SHKZG, 0 AS DMBTR
+        FROM bkpf
+        LEFT SEMI JOIN ap_changed_documents d
+            ON bkpf.MANDT = d.MANDT
+            AND bkpf.BUKRS = d.BUKRS
+            AND bkpf.BELNR = d.BELNR
+            AND bkpf.GJAHR = d.GJAHR
+    ) document_rows
+    GROUP BY MANDT, BUKRS, BELNR, GJAHR
+) documents;
+
+DELETE FROM ap_document_reconciliation WHERE '${ap.load_mode}' = 'full';
+
+-- Documents checked again replace their earlier result
+MERGE INTO ap_document_reconciliation AS target
+USING ap_document_checks AS source
+ON target.mandt = source.mandt
+    AND target.company_code = source.company_code
+    AND target.document_number = source.document_number
+    AND target.fiscal_year <=> source.fiscal_year
+WHEN MATCHED AND source.issue IS NULL THEN DELETE
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED AND source.issue IS NOT NULL THEN INSERT *;
 
-    TRY_CAST(
-        CASE
-            WHEN bseg.SKFBT IS NULL OR TRIM(bseg.SKFBT) = '' THEN '0'
-            ELSE REPLACE(REPLACE(bseg.SKFBT, ',', ''), ' ', '')
-        END AS DECIMAL(15,2)
-    ) AS cash_discount_base_amount,
 
-    -- Vendor Master Data (keep as text, clean only)
+-- =====================================================
+-- DIMENSIONS: Vendor, Document Type, Date
+-- =====================================================
+-- Purpose: Keep descriptive attributes out of the fact
+-- table; it stores integer keys, the dimensions hold the
+-- texts once per vendor, document type and day
+-- Keys: vendor_key and document_type_key are surrogate
+-- keys, assigned once per natural key and kept across
+-- loads (full loads included), so fact rows of earlier
+-- loads stay valid. date_key is the date as yyyyMMdd.
+-- vendor_key -1 stands for lines without a vendor
+-- Output: dim_vendor, dim_document_type, dim_date,
+--         dim_company_code
+-- =====================================================
+
+-- All vendors: the master records, vendor numbers posted
+-- without one, and member -1 (G/L lines)
+CREATE OR REPLACE TEMP VIEW ap_vendor_attributes AS
+SELECT /*+ BROADCAST(lfa1) */
+    v.MANDT,
+    v.LIFNR AS vendor_number,
+    -- BEGIN GENERATED: vendor columns (sample-data/scripts/sap_fields.py)
     CASE WHEN TRIM(lfa1.NAME1) = '' THEN NULL ELSE lfa1.NAME1 END AS vendor_name,
     CASE WHEN TRIM(lfa1.NAME2) = '' THEN NULL ELSE lfa1.NAME2 END AS vendor_name_2,
     CASE WHEN TRIM(lfa1.SORTL) = '' THEN NULL ELSE lfa1.SORTL END AS vendor_sort_field,
@@ -177,45 +384,175 @@ SELECT
     CASE WHEN TRIM(lfa1.KTOKK) = '' THEN NULL ELSE lfa1.KTOKK END AS vendor_account_group,
     CASE WHEN TRIM(lfa1.BRSCH) = '' THEN NULL ELSE lfa1.BRSCH END AS vendor_industry,
     CASE WHEN TRIM(lfa1.LOEVM) = '' THEN NULL ELSE lfa1.LOEVM END AS vendor_deletion_flag,
-    CASE WHEN TRIM(lfa1.SPERR) = '' THEN NULL ELSE lfa1.SPERR END AS vendor_posting_block,
+    CASE WHEN TRIM(lfa1.SPERR) = '' THEN NULL ELSE lfa1.SPERR END AS vendor_posting_block
+    -- END GENERATED: vendor columns
+FROM (
+    SELECT MANDT, LIFNR FROM lfa1
 
-    -- Quality check flag
-    CASE WHEN lfa1.LIFNR IS NULL THEN 1 ELSE 0 END AS is_vendor_not_in_master
+    UNION
 
-FROM
-    bseg
+    SELECT mandt, vendor_number
+    FROM ap_staging_changes
+    WHERE vendor_number IS NOT NULL
+        AND is_vendor_not_in_master = 1
 
-INNER JOIN bkpf
-    ON bseg.MANDT = bkpf.MANDT
-    AND bseg.BUKRS = bkpf.BUKRS
-    AND bseg.BELNR = bkpf.BELNR
-    AND bseg.GJAHR = bkpf.GJAHR
+    UNION
 
+    SELECT NULL, NULL
+) v
 LEFT JOIN lfa1
-    ON bseg.MANDT = lfa1.MANDT
-    AND bseg.LIFNR = lfa1.LIFNR
+    ON v.MANDT = lfa1.MANDT
+    AND v.LIFNR = lfa1.LIFNR;
 
-WHERE
-    bseg.KOART IN ('K', 'S');  -- K = Vendor, S = G/L Account
+CREATE TABLE IF NOT EXISTS dim_vendor
+USING DELTA
+AS SELECT CAST(NULL AS BIGINT) AS vendor_key, * FROM ap_vendor_attributes WHERE 1 = 0;
+
+-- Rewrites new vendors and the master records changed since
+-- the last load (all vendors on a full load). New vendors
+-- are numbered after the highest key in use
+MERGE INTO dim_vendor AS target
+USING (
+    SELECT
+        COALESCE(
+            dim.vendor_key,
+            CASE WHEN a.vendor_number IS NULL THEN -1 END,
+            (SELECT COALESCE(MAX(vendor_key), 0) FROM dim_vendor)
+                + ROW_NUMBER() OVER (
+                    PARTITION BY dim.vendor_key IS NULL
+                    ORDER BY a.MANDT NULLS LAST, a.vendor_number NULLS LAST
+                )
+        ) AS vendor_key,
+        a.*
+    FROM ap_vendor_attributes a
+    CROSS JOIN ap_load_scope s
+    LEFT JOIN dim_vendor dim
+        ON dim.MANDT <=> a.MANDT
+        AND dim.vendor_number <=> a.vendor_number
+    LEFT JOIN ap_changed_vendors c
+        ON c.MANDT = a.MANDT
+        AND c.LIFNR = a.vendor_number
+    WHERE s.is_full_load
+        OR dim.vendor_key IS NULL
+        OR c.LIFNR IS NOT NULL
+) AS source
+ON target.vendor_key = source.vendor_key
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
+
+CREATE TABLE IF NOT EXISTS dim_document_type (
+    document_type_key INT,
+    document_type STRING,
+    document_type_description STRING
+) USING DELTA;
+
+MERGE INTO dim_document_type AS target
+USING (
+    SELECT
+        COALESCE(
+            dim.document_type_key,
+            (SELECT COALESCE(MAX(document_type_key), 0) FROM dim_document_type)
+                + ROW_NUMBER() OVER (
+                    PARTITION BY dim.document_type_key IS NULL
+                    ORDER BY t.document_type
+                )
+        ) AS document_type_key,
+        t.document_type,
+        CASE
+            WHEN t.document_type = 'RE' THEN 'Invoice'
+            WHEN t.document_type = 'KZ' THEN 'Payment'
+            WHEN t.document_type = 'KG' THEN 'Credit Memo'
+            ELSE 'Other'
+        END AS document_type_description
+    FROM (
+        SELECT DISTINCT document_type_code AS document_type
+        FROM ap_staging_changes
+    ) t
+    LEFT JOIN dim_document_type dim
+        ON dim.document_type <=> t.document_type
+) AS source
+ON target.document_type_key = source.document_type_key
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
+
+CREATE TABLE IF NOT EXISTS dim_date (
+    date_key INT,
+    calendar_date DATE,
+    calendar_year INT,
+    calendar_quarter INT,
+    calendar_month INT,
+    month_name STRING,
+    year_month STRING,
+    day_of_month INT,
+    day_name STRING
+) USING DELTA;
+
+-- Whole calendar years around the posting and document
+-- dates of the changed rows and the load day (the aging
+-- snapshot date); days already present are kept
+MERGE INTO dim_date AS target
+USING (
+    SELECT
+        YEAR(calendar_date) * 10000 + MONTH(calendar_date) * 100 + DAY(calendar_date) AS date_key,
+        calendar_date,
+        YEAR(calendar_date) AS calendar_year,
+        QUARTER(calendar_date) AS calendar_quarter,
+        MONTH(calendar_date) AS calendar_month,
+        DATE_FORMAT(calendar_date, 'MMMM') AS month_name,
+        DATE_FORMAT(calendar_date, 'yyyy-MM') AS year_month,
+        DAY(calendar_date) AS day_of_month,
+        DATE_FORMAT(calendar_date, 'EEEE') AS day_name
+    FROM (
+        SELECT EXPLODE(SEQUENCE(first_day, last_day, INTERVAL 1 DAY)) AS calendar_date
+        FROM (
+            SELECT
+                MAKE_DATE(YEAR(LEAST(MIN(posting_date), MIN(document_date), CURRENT_DATE())), 1, 1) AS first_day,
+                MAKE_DATE(YEAR(GREATEST(MAX(posting_date), MAX(document_date), CURRENT_DATE())), 12, 31) AS last_day
+            FROM ap_staging_changes
+        ) date_range
+    ) days
+) AS source
+ON target.date_key = source.date_key
+WHEN NOT MATCHED THEN INSERT *;
+
+-- Company codes, so that the fact and the aggregate tables
+-- (snapshots, clearing, data quality results) share one
+-- company code filter in the semantic model
+CREATE TABLE IF NOT EXISTS dim_company_code (
+    company_code STRING
+) USING DELTA;
+
+MERGE INTO dim_company_code AS target
+USING (
+    SELECT DISTINCT company_code
+    FROM ap_staging_changes
+) AS source
+ON target.company_code = source.company_code
+WHEN NOT MATCHED THEN INSERT *;
 
 
 -- =====================================================
 -- STAGE 2: Business Logic Transformation Layer
 -- =====================================================
 -- Purpose: Apply business rules and calculations
--- Input: Clean, typed data from staging table
+-- Input: Changed rows of the staging table (ap_staging_changes)
 -- Output: Final fact table ready for Power BI
 -- =====================================================
 
-CREATE OR REPLACE TABLE accounts_payable_fact AS
-SELECT
+CREATE OR REPLACE TEMP VIEW ap_fact_changes AS
+SELECT /*+ BROADCAST(v, dt) */
     -- Document Keys
-    mandt AS MANDT,
+    stg.mandt AS MANDT,
     company_code,
     document_number,
     fiscal_year,
     line_item_number,
 
+    -- Dimension Keys
+    COALESCE(v.vendor_key, -1) AS vendor_key,
+    dt.document_type_key,
+    YEAR(posting_date) * 10000 + MONTH(posting_date) * 100 + DAY(posting_date) AS posting_date_key,
+
     -- Document Header Information
     document_type_code AS document_type,
     document_date,
@@ -234,7 +571,7 @@ SELECT
     -- Line Item Information
     debit_credit_indicator,
     account_type,
-    vendor_number,
+    stg.vendor_number,
     gl_account,
     cost_center,
     amount_local_currency,
@@ -253,23 +590,6 @@ SELECT
     payment_terms_code,
     cash_discount_base_amount,
 
-    -- Vendor Master Data
-    vendor_name,
-    vendor_name_2,
-    vendor_sort_field,
-    vendor_city,
-    vendor_country,
-    vendor_region,
-    vendor_postal_code,
-    vendor_street,
-    vendor_tax_number_1,
-    vendor_tax_number_2,
-    vendor_vat_number,
-    vendor_account_group,
-    vendor_industry,
-    vendor_deletion_flag,
-    vendor_posting_block,
-
     -- Calculated Fields
     CASE
         WHEN debit_credit_indicator = 'S' THEN amount_local_currency
@@ -282,14 +602,6 @@ SELECT
         ELSE 0
     END AS vendor_liability_amount,
 
-    -- Document Classification
-    CASE
-        WHEN document_type_code = 'RE' THEN 'Invoice'
-        WHEN document_type_code = 'KZ' THEN 'Payment'
-        WHEN document_type_code = 'KG' THEN 'Credit Memo'
-        ELSE 'Other'
-    END AS document_type_description,
-
     -- Due Date Calculation
     CASE
         WHEN baseline_payment_date IS NOT NULL AND net_payment_terms_days IS NOT NULL
@@ -314,61 +626,729 @@ SELECT
     END AS calculated_discount_amount,
 
     -- Data Quality Flags
-    CASE WHEN vendor_number IS NULL THEN 1 ELSE 0 END AS is_missing_vendor,
+    CASE WHEN stg.vendor_number IS NULL THEN 1 ELSE 0 END AS is_missing_vendor,
     CASE WHEN amount_local_currency = 0 THEN 1 ELSE 0 END AS is_zero_amount,
     is_vendor_not_in_master,
 
     -- Metadata
     CURRENT_TIMESTAMP() AS etl_load_timestamp
 
-FROM accounts_payable_staging;
+FROM ap_staging_changes stg
+LEFT JOIN dim_vendor v
+    ON v.MANDT = stg.mandt
+    AND v.vendor_number = stg.vendor_number
+LEFT JOIN dim_document_type dt
+    ON dt.document_type = stg.document_type_code;
+
+-- Upgrading from the fact table with vendor columns: run
+-- once with ap.load_mode = full after
+--   DROP TABLE accounts_payable_fact; DROP TABLE ap_vendor_stats;
+
+-- First run: create the empty table with the view's schema.
+-- Partitioned by fiscal year and company code so report and
+-- MERGE filters on them skip whole directories
+CREATE TABLE IF NOT EXISTS accounts_payable_fact
+USING DELTA
+PARTITIONED BY (fiscal_year, company_code)
+AS SELECT * FROM ap_fact_changes WHERE 1 = 0;
+
+-- Full load: start from an empty table
+DELETE FROM accounts_payable_fact WHERE '${ap.load_mode}' = 'full';
 
+MERGE INTO accounts_payable_fact AS target
+USING ap_fact_changes AS source
+ON target.MANDT = source.MANDT
+    AND target.company_code = source.company_code
+    AND target.document_number = source.document_number
+    AND target.fiscal_year = source.fiscal_year
+    AND target.line_item_number = source.line_item_number
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
 
+-- Compact the small files written by the MERGE. Bin-packing only
+-- rewrites small files, so it can run after every load.
+-- (The notebook limits this to the fiscal years of the run.)
+OPTIMIZE accounts_payable_fact;
+
+-- Clustering rows by vendor and posting date lets Direct Lake and
+-- SQL endpoint queries skip files by their min/max statistics.
+-- ZORDER rewrites every file it covers, so run it periodically
+-- (e.g. weekly), not after every load. The notebook does this
+-- every zorder_interval_days for the fiscal years loaded since:
+--   OPTIMIZE accounts_payable_fact ZORDER BY (vendor_number, posting_date);
+
+
+-- =====================================================
+-- CLEARING: Invoice-Payment Matching
 -- =====================================================
--- Data Quality Summary View
+-- Purpose: Link vendor debits (payments, credit memos) to
+-- the invoices they settle, per vendor and company code,
+-- FIFO by due date with partial clearing
+-- Method: invoices and debits are laid out on one running
+-- amount axis per vendor. Each stretch between two line
+-- ends belongs to one invoice and one debit, found with
+-- window functions over one sort per vendor (no invoice x
+-- payment join)
+-- Output: ap_clearing_pairs (amount cleared per invoice
+--         line and debit line, days to pay)
+--         ap_open_items (invoice lines not fully cleared)
+-- Rebuilt from the fact table on every load: a new debit
+-- or reversal can move the allocation of older lines
 -- =====================================================
-CREATE OR REPLACE VIEW ap_data_quality_summary AS
+
+-- Vendor lines of documents that are not reversed (the
+-- original and its reversal cancel out). Credits (H) are
+-- the items to pay, in due date order (baseline date or
+-- posting date without payment terms); debits (S) settle
+-- them in posting date order. running_amount is where a
+-- line ends on its side of the axis.
+CREATE OR REPLACE TEMP VIEW ap_clearing_lines AS
 SELECT
-    COUNT(*) AS total_line_items,
-    SUM(is_missing_vendor) AS missing_vendor_count,
-    SUM(is_zero_amount) AS zero_amount_count,
-    SUM(is_vendor_not_in_master) AS vendor_not_in_master_count,
-    COUNT(DISTINCT vendor_number) AS unique_vendors,
-    COUNT(DISTINCT document_number) AS unique_documents,
-    SUM(CASE WHEN document_type = 'RE' THEN 1 ELSE 0 END) AS invoice_count,
-    SUM(CASE WHEN document_type = 'KZ' THEN 1 ELSE 0 END) AS payment_count,
-    MIN(posting_date) AS earliest_posting_date,
-    MAX(posting_date) AS latest_posting_date,
-    SUM(signed_amount) AS net_vendor_liability
-FROM accounts_payable_fact;
+    MANDT,
+    company_code,
+    vendor_number,
+    vendor_key,
+    fiscal_year,
+    document_number,
+    line_item_number,
+    document_type,
+    document_date,
+    posting_date,
+    net_due_date,
+    debit_credit_indicator,
+    amount_local_currency,
+    -- One partitioning for all windows of the stage: credits
+    -- sort before debits, each side sums only its own lines
+    CASE WHEN debit_credit_indicator = 'H'
+        THEN SUM(CASE WHEN debit_credit_indicator = 'H' THEN amount_local_currency ELSE 0 END) OVER (
+            PARTITION BY MANDT, company_code, vendor_number
+            ORDER BY debit_credit_indicator,
+                CASE WHEN debit_credit_indicator = 'H' THEN item_due_date ELSE posting_date END NULLS LAST,
+                fiscal_year, document_number, line_item_number
+            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+        ELSE SUM(CASE WHEN debit_credit_indicator = 'S' THEN amount_local_currency ELSE 0 END) OVER (
+            PARTITION BY MANDT, company_code, vendor_number
+            ORDER BY debit_credit_indicator,
+                CASE WHEN debit_credit_indicator = 'H' THEN item_due_date ELSE posting_date END NULLS LAST,
+                fiscal_year, document_number, line_item_number
+            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+    END AS running_amount,
+    SUM(CASE WHEN debit_credit_indicator = 'S' THEN amount_local_currency ELSE 0 END) OVER (
+        PARTITION BY MANDT, company_code, vendor_number
+    ) AS vendor_debit_amount
+FROM (
+    SELECT
+        *,
+        -- Same due date as in the notebook: net terms (ZBD3T)
+        -- first, then the fact's due date
+        COALESCE(DATEADD(day, net_payment_terms_days, baseline_payment_date),
+                 net_due_date, baseline_payment_date, posting_date) AS item_due_date
+    FROM accounts_payable_fact
+    WHERE account_type = 'K'
+        AND vendor_number IS NOT NULL
+        AND reversal_document IS NULL
+        AND debit_credit_indicator IN ('H', 'S')
+        AND amount_local_currency > 0
+) vendor_lines;
+
+-- Sorted by running amount, the next invoice end at or
+-- after a line end names the invoice of the stretch that
+-- ends there, the next debit end names the debit. Without
+-- a debit the stretch is still open, without an invoice
+-- the debit is unapplied (paid in advance). A debit posted
+-- before its invoice is carried forward: the stretch is
+-- cleared when the invoice is posted (or dated), never
+-- before, so days to pay are not negative.
+CREATE OR REPLACE TEMP VIEW ap_clearing_segments AS
+SELECT
+    MANDT,
+    company_code,
+    vendor_number,
+    vendor_key,
+    running_amount - COALESCE(LAG(running_amount) OVER by_amount, 0) AS segment_amount,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN fiscal_year END, TRUE) OVER ahead AS fiscal_year,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN document_number END, TRUE) OVER ahead AS document_number,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN line_item_number END, TRUE) OVER ahead AS line_item_number,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN document_date END, TRUE) OVER ahead AS document_date,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN net_due_date END, TRUE) OVER ahead AS net_due_date,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN fiscal_year END, TRUE) OVER ahead AS payment_fiscal_year,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN document_number END, TRUE) OVER ahead AS payment_document_number,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN line_item_number END, TRUE) OVER ahead AS payment_line_item_number,
+    FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN document_type END, TRUE) OVER ahead AS payment_document_type,
+    GREATEST(
+        FIRST_VALUE(CASE WHEN debit_credit_indicator = 'S' THEN posting_date END, TRUE) OVER ahead,
+        FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN posting_date END, TRUE) OVER ahead,
+        FIRST_VALUE(CASE WHEN debit_credit_indicator = 'H' THEN document_date END, TRUE) OVER ahead
+    ) AS clearing_date
+FROM ap_clearing_lines
+WINDOW
+    by_amount AS (
+        PARTITION BY MANDT, company_code, vendor_number
+        ORDER BY running_amount, debit_credit_indicator
+    ),
+    ahead AS (
+        PARTITION BY MANDT, company_code, vendor_number
+        ORDER BY running_amount, debit_credit_indicator
+        ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+    );
 
+-- One row per invoice line and debit line that clears it.
+-- cleared_amount_days and on_time_amount let the report
+-- weight days to pay and punctuality by amount with SUMs
+CREATE OR REPLACE TABLE ap_clearing_pairs AS
+SELECT
+    MANDT,
+    company_code,
+    vendor_number,
+    vendor_key,
+    fiscal_year,
+    document_number,
+    line_item_number,
+    document_date,
+    net_due_date,
+    payment_fiscal_year,
+    payment_document_number,
+    payment_line_item_number,
+    payment_document_type,
+    clearing_date,
+    segment_amount AS cleared_amount,
+    DATEDIFF(clearing_date, document_date) AS days_to_pay,
+    DATEDIFF(clearing_date, net_due_date) AS days_past_due,
+    segment_amount * DATEDIFF(clearing_date, document_date) AS cleared_amount_days,
+    CASE
+        WHEN net_due_date IS NULL OR clearing_date <= net_due_date THEN segment_amount
+        ELSE 0
+    END AS on_time_amount
+FROM ap_clearing_segments
+WHERE segment_amount > 0
+    AND document_number IS NOT NULL
+    AND payment_document_number IS NOT NULL;
+
+-- Invariant: no invoice is cleared before it is dated
+SELECT RAISE_ERROR(CONCAT(COUNT(*), ' ap_clearing_pairs rows with negative days_to_pay'))
+FROM ap_clearing_pairs
+WHERE days_to_pay < 0
+HAVING COUNT(*) > 0;
+
+-- Invoice lines with an open balance: the part of the
+-- line beyond the vendor's total debits
+CREATE OR REPLACE TABLE ap_open_items AS
+SELECT
+    MANDT,
+    company_code,
+    vendor_number,
+    vendor_key,
+    fiscal_year,
+    document_number,
+    line_item_number,
+    document_type,
+    document_date,
+    posting_date,
+    net_due_date,
+    amount_local_currency AS item_amount,
+    amount_local_currency - open_amount AS cleared_amount,
+    open_amount
+FROM (
+    SELECT
+        *,
+        LEAST(amount_local_currency, GREATEST(running_amount - vendor_debit_amount, 0)) AS open_amount
+    FROM ap_clearing_lines
+    WHERE debit_credit_indicator = 'H'
+) items
+WHERE open_amount > 0;
+
+
+-- =====================================================
+-- STAGE 3: AP Snapshot Aggregates
 -- =====================================================
--- Vendor Summary View
+-- Purpose: Pre-aggregate aging and payment KPIs so report
+-- measures read small tables instead of scanning the fact
+-- table with TODAY()-relative filters on every render
+-- Output: ap_aging_snapshot (one snapshot per load day)
+--         ap_payment_stats_monthly (changed months merged)
 -- =====================================================
-CREATE OR REPLACE VIEW ap_vendor_summary AS
+
+CREATE TABLE IF NOT EXISTS ap_aging_snapshot (
+    snapshot_date DATE,
+    fiscal_year INT,
+    company_code STRING,
+    vendor_number STRING,
+    aging_bucket STRING,
+    aging_bucket_order INT,
+    open_amount DECIMAL(25,2),
+    invoice_count BIGINT,
+    vendor_key BIGINT
+) USING DELTA;
+
+-- Upgrading from the snapshot without vendor_key (keeps the
+-- snapshot history): run once
+--   ALTER TABLE ap_aging_snapshot ADD COLUMNS (vendor_key BIGINT);
+--   MERGE INTO ap_aging_snapshot t USING dim_vendor d
+--   ON t.vendor_number <=> d.vendor_number
+--   WHEN MATCHED THEN UPDATE SET vendor_key = d.vendor_key;
+
+-- Aging of the open invoice amounts (ap_open_items) as of
+-- the load day; a second run on the same day replaces that
+-- snapshot
+DELETE FROM ap_aging_snapshot WHERE snapshot_date = CURRENT_DATE();
+
+INSERT INTO ap_aging_snapshot
 SELECT
+    CURRENT_DATE() AS snapshot_date,
+    fiscal_year,
+    company_code,
     vendor_number,
-    vendor_name,
-    vendor_city,
-    vendor_country,
-    COUNT(DISTINCT document_number) AS document_count,
-    SUM(CASE WHEN document_type = 'RE' THEN vendor_liability_amount ELSE 0 END) AS total_invoices,
-    SUM(CASE WHEN document_type = 'KZ' THEN vendor_liability_amount ELSE 0 END) AS total_payments,
-    SUM(vendor_liability_amount) AS net_open_amount
-FROM accounts_payable_fact
-WHERE vendor_number IS NOT NULL
+    CASE aging_bucket_order
+        WHEN 0 THEN 'No Due Date'
+        WHEN 1 THEN 'Not Due'
+        WHEN 2 THEN '0-30 Days'
+        WHEN 3 THEN '31-60 Days'
+        WHEN 4 THEN '61-90 Days'
+        ELSE '90+ Days'
+    END AS aging_bucket,
+    aging_bucket_order,
+    SUM(open_amount) AS open_amount,
+    COUNT(DISTINCT document_number) AS invoice_count,
+    vendor_key
+FROM (
+    SELECT
+        fiscal_year,
+        company_code,
+        vendor_number,
+        vendor_key,
+        document_number,
+        open_amount,
+        CASE
+            WHEN net_due_date IS NULL THEN 0
+            WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 0 THEN 1
+            WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 30 THEN 2
+            WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 60 THEN 3
+            WHEN DATEDIFF(CURRENT_DATE(), net_due_date) <= 90 THEN 4
+            ELSE 5
+        END AS aging_bucket_order
+    FROM ap_open_items
+) invoices
 GROUP BY
+    fiscal_year,
+    company_code,
     vendor_number,
-    vendor_name,
-    vendor_city,
-    vendor_country;
+    vendor_key,
+    aging_bucket_order;
+
+CREATE TABLE IF NOT EXISTS ap_payment_stats_monthly (
+    posting_month DATE,
+    fiscal_year INT,
+    company_code STRING,
+    vendor_number STRING,
+    vendor_key BIGINT,
+    payment_line_count BIGINT,
+    total_payment_days BIGINT,
+    min_payment_days INT,
+    max_payment_days INT,
+    invoice_amount DECIMAL(25,2),
+    net_payables_amount DECIMAL(25,2)
+) USING DELTA;
+
+-- Upgrading from the table without vendor_key: run once with
+-- ap.load_mode = full after
+--   DROP TABLE ap_payment_stats_monthly;
+DELETE FROM ap_payment_stats_monthly WHERE '${ap.load_mode}' = 'full';
+
+-- Only months that received changed rows are recomputed
+CREATE OR REPLACE TEMP VIEW ap_changed_months AS
+SELECT DISTINCT
+    fiscal_year,
+    company_code,
+    TRUNC(posting_date, 'MM') AS posting_month
+FROM ap_fact_changes
+WHERE posting_date IS NOT NULL;
+
+MERGE INTO ap_payment_stats_monthly AS target
+USING (
+    SELECT
+        TRUNC(fact.posting_date, 'MM') AS posting_month,
+        fact.fiscal_year,
+        fact.company_code,
+        fact.vendor_number,
+        fact.vendor_key,
+        SUM(CASE WHEN fact.document_type = 'KZ' THEN 1 ELSE 0 END) AS payment_line_count,
+        SUM(CASE WHEN fact.document_type = 'KZ'
+                 THEN DATEDIFF(fact.posting_date, fact.document_date) END) AS total_payment_days,
+        MIN(CASE WHEN fact.document_type = 'KZ'
+                 THEN DATEDIFF(fact.posting_date, fact.document_date) END) AS min_payment_days,
+        MAX(CASE WHEN fact.document_type = 'KZ'
+                 THEN DATEDIFF(fact.posting_date, fact.document_date) END) AS max_payment_days,
+        SUM(CASE WHEN fact.document_type = 'RE' AND fact.debit_credit_indicator = 'H'
+                 THEN fact.amount_local_currency ELSE 0 END) AS invoice_amount,
+        SUM(CASE WHEN fact.account_type = 'K' THEN fact.vendor_liability_amount ELSE 0 END) AS net_payables_amount
+    FROM accounts_payable_fact fact
+    LEFT SEMI JOIN ap_changed_months m
+        ON fact.fiscal_year = m.fiscal_year
+        AND fact.company_code = m.company_code
+        AND TRUNC(fact.posting_date, 'MM') = m.posting_month
+    GROUP BY
+        TRUNC(fact.posting_date, 'MM'),
+        fact.fiscal_year,
+        fact.company_code,
+        fact.vendor_number,
+        fact.vendor_key
+) AS source
+ON target.posting_month = source.posting_month
+    AND target.fiscal_year = source.fiscal_year
+    AND target.company_code = source.company_code
+    AND target.vendor_key = source.vendor_key
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
+
+
+-- =====================================================
+-- Summary Tables
+-- =====================================================
+-- Purpose: Materialize the data quality and vendor
+-- summaries from small per-partition stats tables that
+-- are merged with the rows changed by this run, and
+-- evaluate the data quality rules of sql/dq_rules.json
+-- Output: ap_data_quality_summary (1 row)
+--         ap_vendor_summary (1 row per vendor)
+--         dq_rules (1 row per rule)
+--         dq_results (1 row per rule x posting date)
+-- =====================================================
+-- Upgrading from the view-based summaries: run once
+--   DROP VIEW ap_data_quality_summary; DROP VIEW ap_vendor_summary;
+-- Upgrading from ap_dq_daily_stats with data quality
+-- counts: run once with ap.load_mode = full after
+--   DROP TABLE ap_dq_daily_stats;
+
+-- Exact counts per fiscal year x company code x posting date.
+-- A document has a single posting date, so distinct
+-- document counts add up across rows.
+CREATE TABLE IF NOT EXISTS ap_dq_daily_stats (
+    fiscal_year INT,
+    company_code STRING,
+    posting_date DATE,
+    line_item_count BIGINT,
+    document_count BIGINT,
+    invoice_line_count BIGINT,
+    payment_line_count BIGINT,
+    net_vendor_liability DECIMAL(25,2)
+) USING DELTA;
+
+-- Vendor totals per fiscal year x company code; distinct
+-- vendors are counted exactly on this small table
+CREATE TABLE IF NOT EXISTS ap_vendor_stats (
+    fiscal_year INT,
+    company_code STRING,
+    vendor_number STRING,
+    document_count BIGINT,
+    total_invoices DECIMAL(25,2),
+    total_payments DECIMAL(25,2),
+    net_open_amount DECIMAL(25,2)
+) USING DELTA;
+
+-- Data quality rules, generated from sql/dq_rules.json
+-- (sample-data/scripts/dq_rules.py)
+CREATE OR REPLACE TABLE dq_rules AS
+SELECT
+    rule_id,
+    rule_type,
+    column_name,
+    severity,
+    CAST(min_pass_rate AS DECIMAL(5,4)) AS min_pass_rate,
+    description
+FROM (
+    VALUES
+    -- BEGIN GENERATED: dq rules (sample-data/scripts/dq_rules.py)
+    ('posting_date_present', 'completeness', 'posting_date', 'high', 1.0, 'Posting date (BUDAT) is set'),
+    ('document_date_present', 'completeness', 'document_date', 'medium', 1.0, 'Document date (BLDAT) is set'),
+    ('document_type_present', 'completeness', 'document_type', 'medium', 1.0, 'Document type (BLART) is set'),
+    ('vendor_number_present', 'completeness', 'vendor_number', 'high', 0.95, 'Line item carries a vendor number (LIFNR)'),
+    ('baseline_date_present', 'completeness', 'baseline_payment_date', 'medium', 0.99, 'Vendor line has a baseline payment date (ZFBDT)'),
+    ('payment_terms_present', 'completeness', 'payment_terms_code', 'low', 0.95, 'Vendor line has payment terms (ZTERM)'),
+    ('debit_credit_valid', 'validity', 'debit_credit_indicator', 'high', 1.0, 'Debit/credit indicator (SHKZG) is S or H'),
+    ('account_type_valid', 'validity', 'account_type', 'high', 1.0, 'Account type (KOART) is a known SAP account type'),
+    ('document_type_known', 'validity', 'document_type', 'low', 0.9, 'Document type is an invoice, payment or credit memo'),
+    ('amount_not_zero', 'validity', 'amount_local_currency', 'low', 0.99, 'Amount in local currency (DMBTR) is not zero'),
+    ('posting_not_before_document_date', 'range', 'posting_date', 'medium', 0.99, 'Posting date is not before the document date'),
+    ('cash_discount_days_range', 'range', 'cash_discount_days_1', 'low', 1.0, 'Cash discount days (ZBD1T) are between 0 and 365'),
+    ('cash_discount_percent_range', 'range', 'cash_discount_percent_1', 'low', 1.0, 'Cash discount percentage (ZBD1P) is between 0 and 100'),
+    ('vendor_in_master', 'referential', 'vendor_number', 'high', 1.0, 'Vendor number exists in the vendor master (LFA1)')
+    -- END GENERATED: dq rules
+) AS r(rule_id, rule_type, column_name, severity, min_pass_rate, description);
+
+-- Rows checked and failed per rule x fiscal year x
+-- company code x posting date
+CREATE TABLE IF NOT EXISTS dq_results (
+    rule_id STRING,
+    fiscal_year INT,
+    company_code STRING,
+    posting_date DATE,
+    rows_checked BIGINT,
+    rows_failed BIGINT,
+    evaluated_at TIMESTAMP
+) USING DELTA;
+
+DELETE FROM ap_dq_daily_stats WHERE '${ap.load_mode}' = 'full';
+DELETE FROM ap_vendor_stats WHERE '${ap.load_mode}' = 'full';
+DELETE FROM dq_results WHERE '${ap.load_mode}' = 'full';
+
+-- Results of rules removed from dq_rules.json
+MERGE INTO dq_results AS target
+USING dq_rules AS source
+ON target.rule_id = source.rule_id
+WHEN NOT MATCHED BY SOURCE THEN DELETE;
+
+CREATE OR REPLACE TEMP VIEW ap_changed_days AS
+SELECT DISTINCT fiscal_year, company_code, posting_date
+FROM ap_fact_changes;
+
+CREATE OR REPLACE TEMP VIEW ap_changed_vendor_partitions AS
+SELECT DISTINCT fiscal_year, company_code, vendor_number
+FROM ap_fact_changes
+WHERE vendor_number IS NOT NULL;
+
+-- A rule without results (added to dq_rules.json since the
+-- last run) is evaluated on all days, not only changed ones
+CREATE OR REPLACE TEMP VIEW ap_dq_days AS
+SELECT fiscal_year, company_code, posting_date
+FROM ap_changed_days
+
+UNION
+
+SELECT fiscal_year, company_code, posting_date
+FROM ap_dq_daily_stats
+WHERE (SELECT COUNT(DISTINCT rule_id) FROM dq_results)
+    < (SELECT COUNT(*) FROM dq_rules);
+
+-- One aggregation over the fact rows of those days computes
+-- the daily stats and the counts of every rule
+CREATE OR REPLACE TEMP VIEW ap_dq_day_counts AS
+SELECT
+    fact.fiscal_year,
+    fact.company_code,
+    fact.posting_date,
+    COUNT(*) AS line_item_count,
+    COUNT(DISTINCT fact.document_number) AS document_count,
+    SUM(CASE WHEN fact.document_type = 'RE' THEN 1 ELSE 0 END) AS invoice_line_count,
+    SUM(CASE WHEN fact.document_type = 'KZ' THEN 1 ELSE 0 END) AS payment_line_count,
+    SUM(fact.signed_amount) AS net_vendor_liability,
+    -- BEGIN GENERATED: dq rule counts (sample-data/scripts/dq_rules.py)
+    COUNT(*) AS posting_date_present_checked,
+    SUM(CASE WHEN posting_date IS NULL THEN 1 ELSE 0 END) AS posting_date_present_failed,
+    COUNT(*) AS document_date_present_checked,
+    SUM(CASE WHEN document_date IS NULL THEN 1 ELSE 0 END) AS document_date_present_failed,
+    COUNT(*) AS document_type_present_checked,
+    SUM(CASE WHEN document_type IS NULL THEN 1 ELSE 0 END) AS document_type_present_failed,
+    COUNT(*) AS vendor_number_present_checked,
+    SUM(CASE WHEN vendor_number IS NULL THEN 1 ELSE 0 END) AS vendor_number_present_failed,
+    SUM(CASE WHEN account_type = 'K' THEN 1 ELSE 0 END) AS baseline_date_present_checked,
+    SUM(CASE WHEN account_type = 'K' AND baseline_payment_date IS NULL THEN 1 ELSE 0 END) AS baseline_date_present_failed,
+    SUM(CASE WHEN account_type = 'K' THEN 1 ELSE 0 END) AS payment_terms_present_checked,
+    SUM(CASE WHEN account_type = 'K' AND payment_terms_code IS NULL THEN 1 ELSE 0 END) AS payment_terms_present_failed,
+    SUM(CASE WHEN debit_credit_indicator IS NOT NULL THEN 1 ELSE 0 END) AS debit_credit_valid_checked,
+    SUM(CASE WHEN debit_credit_indicator IS NOT NULL AND debit_credit_indicator NOT IN ('S', 'H') THEN 1 ELSE 0 END) AS debit_credit_valid_failed,
+    SUM(CASE WHEN account_type IS NOT NULL THEN 1 ELSE 0 END) AS account_type_valid_checked,
+    SUM(CASE WHEN account_type IS NOT NULL AND account_type NOT IN ('A', 'D', 'K', 'M', 'S') THEN 1 ELSE 0 END) AS account_type_valid_failed,
+    SUM(CASE WHEN document_type IS NOT NULL THEN 1 ELSE 0 END) AS document_type_known_checked,
+    SUM(CASE WHEN document_type IS NOT NULL AND document_type NOT IN ('RE', 'KZ', 'KG') THEN 1 ELSE 0 END) AS document_type_known_failed,
+    SUM(CASE WHEN amount_local_currency IS NOT NULL THEN 1 ELSE 0 END) AS amount_not_zero_checked,
+    SUM(CASE WHEN amount_local_currency IS NOT NULL AND amount_local_currency = 0 THEN 1 ELSE 0 END) AS amount_not_zero_failed,
+    SUM(CASE WHEN posting_date IS NOT NULL THEN 1 ELSE 0 END) AS posting_not_before_document_date_checked,
+    SUM(CASE WHEN posting_date IS NOT NULL AND posting_date < document_date THEN 1 ELSE 0 END) AS posting_not_before_document_date_failed,
+    SUM(CASE WHEN cash_discount_days_1 IS NOT NULL THEN 1 ELSE 0 END) AS cash_discount_days_range_checked,
+    SUM(CASE WHEN cash_discount_days_1 IS NOT NULL AND (cash_discount_days_1 < 0 OR cash_discount_days_1 > 365) THEN 1 ELSE 0 END) AS cash_discount_days_range_failed,
+    SUM(CASE WHEN cash_discount_percent_1 IS NOT NULL THEN 1 ELSE 0 END) AS cash_discount_percent_range_checked,
+    SUM(CASE WHEN cash_discount_percent_1 IS NOT NULL AND (cash_discount_percent_1 < 0 OR cash_discount_percent_1 > 100) THEN 1 ELSE 0 END) AS cash_discount_percent_range_failed,
+    SUM(CASE WHEN vendor_number IS NOT NULL THEN 1 ELSE 0 END) AS vendor_in_master_checked,
+    SUM(CASE WHEN vendor_number IS NOT NULL AND is_vendor_not_in_master = 1 THEN 1 ELSE 0 END) AS vendor_in_master_failed
+    -- END GENERATED: dq rule counts
+FROM accounts_payable_fact fact
+LEFT SEMI JOIN ap_dq_days d
+    ON fact.fiscal_year = d.fiscal_year
+    AND fact.company_code = d.company_code
+    AND fact.posting_date <=> d.posting_date
+GROUP BY
+    fact.fiscal_year,
+    fact.company_code,
+    fact.posting_date;
+
+CACHE TABLE ap_dq_day_counts;
+
+MERGE INTO ap_dq_daily_stats AS target
+USING (
+    SELECT
+        fiscal_year,
+        company_code,
+        posting_date,
+        line_item_count,
+        document_count,
+        invoice_line_count,
+        payment_line_count,
+        net_vendor_liability
+    FROM ap_dq_day_counts
+) AS source
+ON target.fiscal_year = source.fiscal_year
+    AND target.company_code = source.company_code
+    AND target.posting_date <=> source.posting_date
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
+
+-- One row per rule and day: the (checked, failed) column
+-- pairs of the aggregation above, unpivoted
+MERGE INTO dq_results AS target
+USING (
+    SELECT
+        rule_id,
+        fiscal_year,
+        company_code,
+        posting_date,
+        rows_checked,
+        rows_failed,
+        CURRENT_TIMESTAMP() AS evaluated_at
+    FROM ap_dq_day_counts
+    UNPIVOT ((rows_checked, rows_failed) FOR rule_id IN (
+        -- BEGIN GENERATED: dq rule columns (sample-data/scripts/dq_rules.py)
+        (posting_date_present_checked, posting_date_present_failed) AS posting_date_present,
+        (document_date_present_checked, document_date_present_failed) AS document_date_present,
+        (document_type_present_checked, document_type_present_failed) AS document_type_present,
+        (vendor_number_present_checked, vendor_number_present_failed) AS vendor_number_present,
+        (baseline_date_present_checked, baseline_date_present_failed) AS baseline_date_present,
+        (payment_terms_present_checked, payment_terms_present_failed) AS payment_terms_present,
+        (debit_credit_valid_checked, debit_credit_valid_failed) AS debit_credit_valid,
+        (account_type_valid_checked, account_type_valid_failed) AS account_type_valid,
+        (document_type_known_checked, document_type_known_failed) AS document_type_known,
+        (amount_not_zero_checked, amount_not_zero_failed) AS amount_not_zero,
+        (posting_not_before_document_date_checked, posting_not_before_document_date_failed) AS posting_not_before_document_date,
+        (cash_discount_days_range_checked, cash_discount_days_range_failed) AS cash_discount_days_range,
+        (cash_discount_percent_range_checked, cash_discount_percent_range_failed) AS cash_discount_percent_range,
+        (vendor_in_master_checked, vendor_in_master_failed) AS vendor_in_master
+        -- END GENERATED: dq rule columns
+    ))
+) AS source
+ON target.rule_id = source.rule_id
+    AND target.fiscal_year = source.fiscal_year
+    AND target.company_code = source.company_code
+    AND target.posting_date <=> source.posting_date
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
+
+UNCACHE TABLE IF EXISTS ap_dq_day_counts;
+
+
+MERGE INTO ap_vendor_stats AS target
+USING (
+    SELECT
+        fact.fiscal_year,
+        fact.company_code,
+        fact.vendor_number,
+        COUNT(DISTINCT fact.document_number) AS document_count,
+        SUM(CASE WHEN fact.document_type = 'RE' THEN fact.vendor_liability_amount ELSE 0 END) AS total_invoices,
+        SUM(CASE WHEN fact.document_type = 'KZ' THEN fact.vendor_liability_amount ELSE 0 END) AS total_payments,
+        SUM(fact.vendor_liability_amount) AS net_open_amount
+    FROM accounts_payable_fact fact
+    LEFT SEMI JOIN ap_changed_vendor_partitions v
+        ON fact.fiscal_year = v.fiscal_year
+        AND fact.company_code = v.company_code
+        AND fact.vendor_number = v.vendor_number
+    GROUP BY
+        fact.fiscal_year,
+        fact.company_code,
+        fact.vendor_number
+) AS source
+ON target.fiscal_year = source.fiscal_year
+    AND target.company_code = source.company_code
+    AND target.vendor_number = source.vendor_number
+WHEN MATCHED THEN UPDATE SET *
+WHEN NOT MATCHED THEN INSERT *;
+
+-- Both summaries read only the stats tables above (and
+-- the vendor names of dim_vendor)
+CREATE OR REPLACE TABLE ap_data_quality_summary AS
+SELECT
+    SUM(line_item_count) AS total_line_items,
+    (SELECT SUM(rows_failed) FROM dq_results WHERE rule_id = 'vendor_number_present') AS missing_vendor_count,
+    (SELECT SUM(rows_failed) FROM dq_results WHERE rule_id = 'amount_not_zero') AS zero_amount_count,
+    (SELECT SUM(rows_failed) FROM dq_results WHERE rule_id = 'vendor_in_master') AS vendor_not_in_master_count,
+    (SELECT COUNT(DISTINCT vendor_number) FROM ap_vendor_stats) AS unique_vendors,
+    SUM(document_count) AS unique_documents,
+    SUM(invoice_line_count) AS invoice_count,
+    SUM(payment_line_count) AS payment_count,
+    MIN(posting_date) AS earliest_posting_date,
+    MAX(posting_date) AS latest_posting_date,
+    SUM(net_vendor_liability) AS net_vendor_liability
+FROM ap_dq_daily_stats;
+
+CREATE OR REPLACE TABLE ap_vendor_summary AS
+SELECT
+    s.vendor_number,
+    v.vendor_name,
+    v.vendor_city,
+    v.vendor_country,
+    s.document_count,
+    s.total_invoices,
+    s.total_payments,
+    s.net_open_amount
+FROM (
+    SELECT
+        vendor_number,
+        SUM(document_count) AS document_count,
+        SUM(total_invoices) AS total_invoices,
+        SUM(total_payments) AS total_payments,
+        SUM(net_open_amount) AS net_open_amount
+    FROM ap_vendor_stats
+    GROUP BY vendor_number
+) s
+LEFT JOIN (
+    SELECT
+        vendor_number,
+        MAX(vendor_name) AS vendor_name,
+        MAX(vendor_city) AS vendor_city,
+        MAX(vendor_country) AS vendor_country
+    FROM dim_vendor
+    GROUP BY vendor_number
+) v
+    ON v.vendor_number = s.vendor_number;
+
+
+-- =====================================================
+-- Advance Watermark
+-- =====================================================
+-- Runs only after both MERGEs succeeded, so a failed run
+-- is picked up again by the next one
+-- =====================================================
+
+MERGE INTO ap_load_watermark AS target
+USING (
+    SELECT
+        'accounts_payable_staging' AS table_name,
+        DATE_FORMAT(MAX(CPUDT), 'yyyyMMdd') AS last_entry_date
+    FROM bkpf
+) AS source
+ON target.table_name = source.table_name
+WHEN MATCHED THEN UPDATE SET
+    last_entry_date = COALESCE(source.last_entry_date, target.last_entry_date),
+    updated_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED THEN INSERT (table_name, last_entry_date, updated_at)
+    VALUES (source.table_name, source.last_entry_date, CURRENT_TIMESTAMP());
+
+INSERT OVERWRITE TABLE ap_vendor_snapshot
+SELECT MANDT, LIFNR, vendor_hash FROM ap_vendor_hash;
+
+UNCACHE TABLE IF EXISTS ap_staging_changes;
+
 
 -- =====================================================
 -- Usage Instructions
 -- =====================================================
 -- 1. Run this entire script in your Lakehouse SQL endpoint
--- 2. Stage 1 creates: accounts_payable_staging (typed data)
--- 3. Stage 2 creates: accounts_payable_fact (business logic)
+-- 2. Stage 1 casts into: ap_staging_changes (cached view;
+--    uncomment the debug block to keep accounts_payable_staging)
+--    Dimensions merge into: dim_vendor, dim_document_type, dim_date
+-- 3. Stage 2 merges into: accounts_payable_fact (business logic)
+--    Clearing rebuilds: ap_clearing_pairs, ap_open_items
+--    Stage 3 refreshes: ap_aging_snapshot, ap_payment_stats_monthly
+--    Summary tables: ap_data_quality_summary, ap_vendor_summary
 -- 4. Verify: SELECT * FROM ap_data_quality_summary;
--- 5. Publish 'accounts_payable_fact' to your semantic model
+-- 5. Publish 'accounts_payable_fact' and the dim_* tables to
+--    your semantic model
+-- 6. Rebuild everything: SET ap.load_mode = full; at the top
 -- =====================================================